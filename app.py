@@ -1,8 +1,13 @@
 import streamlit as st
 import pandas as pd
-from plotly.subplots import make_subplots
-import numpy as np
 import helper as h
+import pipeline
+import visualization as vis
+import profiling
+from refresher import Refresher
+import json
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
 from datetime import timedelta
 
@@ -14,7 +19,8 @@ load_dotenv()
 st.set_page_config(layout="wide")
 
 
-TZ = "Europe/Berlin"  # 'America/Los_Angeles'
+TZ = "Europe/Berlin"  # home timezone, the sessions are computed once for it
+TIMEZONES = [TZ, "UTC", "America/Los_Angeles", "America/New_York", "Asia/Tokyo"]
 TARGET_DELTA_FASTING = (3, 4)
 TARGET_DELTA_FIRST_MEAL = (1, 1)
 TARGET_DELTA_LAST_MEAL = (2, 3)
@@ -23,13 +29,107 @@ DT_DEEP_FAST_IN_HOURS = 12  # this is the time after which the deep fasting stat
 MIN_GAP_BETWEEN_SESSIONS_IN_MINUTES = DT_DEEP_FAST_IN_HOURS * 60
 ROLLING_WINDOW_DAYS = 14
 GAMMA = 0.9
+DB_BACKEND = "supabase"  # or "postgres" for a direct, pooled connection
+DATA_CACHE_DIR = ".cache"  # local copy of the Supabase tables, synced incrementally
+DATA_STORE_DIR = None  # e.g. ".store", history in memory-mapped interval stores
+PLOT_START = pd.Timestamp("2024-10-15")
+# data before the plotted range is only needed to warm up the rolling windows
+FETCH_START = PLOT_START - timedelta(days=ROLLING_WINDOW_DAYS + 7)
+REFRESH_INTERVAL_IN_SECONDS = 5 * 60  # how often new rows are fetched (background)
+ADVANCE_INTERVAL_IN_SECONDS = 60  # how often the ongoing deep fast moves on
+DERIVED_CACHE_MAX_ENTRIES = 4  # figures (ranges) kept for the latest snapshot (LRU)
+PROFILE = False  # record time and rows per stage, see "Performance"
+PROFILE_MEMORY = False  # also allocations, traces the whole process (slow)
+RENDER_MARGIN_DAYS = 60  # days plotted beyond the shown range, to pan into
+RENDER_WEBGL = True  # draw the daily lines with WebGL
+HEADER_TAIL_DAYS = ROLLING_WINDOW_DAYS + 7  # history loaded for the header first
 
 # Functions
 # ---------
 
 
-# @st.cache_data
-def load_data():
+def fetch_data(full_resync=False):
+    """Fetch tier: the raw tables, see `get_refresher`."""
+    if full_resync:
+        h.clear_table_cache(DATA_CACHE_DIR)
+        if DATA_STORE_DIR is not None:
+            h.clear_interval_store(DATA_STORE_DIR)
+    if DATA_STORE_DIR is not None:
+        h.sync_interval_store(DATA_STORE_DIR, backend=DB_BACKEND)
+        df_sleep = h.load_sleep_data_from_store(DATA_STORE_DIR, ts_from=FETCH_START)
+        df_eat = h.load_eat_data_from_store(DATA_STORE_DIR, ts_from=FETCH_START)
+    else:
+        df_sleep = h.load_sleep_data_from_supabase(
+            cache_dir=DATA_CACHE_DIR, ts_from=FETCH_START, backend=DB_BACKEND
+        )
+        df_eat = h.load_eat_data_from_supabase(
+            cache_dir=DATA_CACHE_DIR, ts_from=FETCH_START, backend=DB_BACKEND
+        )
+    return df_sleep, df_eat
+
+
+# Derived tier: one refresher per process, shared by all sessions. It fetches
+# new rows every `REFRESH_INTERVAL_IN_SECONDS` and updates the derived frames in
+# a background thread, page loads read its latest snapshot. The ongoing deep
+# fast and today's scores are moved on to the current time every
+# `ADVANCE_INTERVAL_IN_SECONDS`, also if no new rows arrive.
+@st.cache_resource
+def get_refresher():
+    return Refresher(
+        fetch_data,
+        interval_in_seconds=REFRESH_INTERVAL_IN_SECONDS,
+        advance_interval_in_seconds=ADVANCE_INTERVAL_IN_SECONDS,
+        tz=TZ,
+        target_delta_fasting=TARGET_DELTA_FASTING,
+        target_delta_first_meal=TARGET_DELTA_FIRST_MEAL,
+        target_delta_last_meal=TARGET_DELTA_LAST_MEAL,
+        target_delta_sleep=TARGET_DELTA_SLEEP,
+        rolling_window_days=ROLLING_WINDOW_DAYS,
+        gamma=GAMMA,
+        dt_deep_fast_in_hours=DT_DEEP_FAST_IN_HOURS,
+        min_gap_between_sessions_in_minutes=MIN_GAP_BETWEEN_SESSIONS_IN_MINUTES,
+    ).start()
+
+
+# Frames derived from a snapshot are cached for its version only. The version
+# changes with the data and with the time the ongoing deep fast ends (at least
+# every minute), so once a new version is stored, the entries of all others are
+# dropped. Thus only the latest snapshot (and what is derived from it) is kept
+# in memory, however many versions there were.
+@st.cache_resource
+def _derived_cache(name):
+    return {"lock": threading.Lock(), "version": None, "entries": OrderedDict()}
+
+
+def _cached(name, version, key, compute, max_entries):
+    cache = _derived_cache(name)
+    with cache["lock"]:
+        if cache["version"] == version and key in cache["entries"]:
+            cache["entries"].move_to_end(key)
+            return cache["entries"][key]
+    value = compute()
+    with cache["lock"]:
+        if cache["version"] != version:
+            cache["version"], cache["entries"] = version, OrderedDict()
+        cache["entries"][key] = value
+        while len(cache["entries"]) > max_entries:
+            cache["entries"].popitem(last=False)
+    return value
+
+
+# Views in other timezones share the sessions of the snapshot and only
+# recompute the localized frames.
+def localize_data(ret, version, params, tz):
+    def compute():
+        with st.spinner("Localizing..."):
+            return pipeline.localize(ret, tz)
+
+    key = (tz, tuple(sorted(params.items())))
+    return _cached("localized", version, key, compute, len(TIMEZONES))
+
+
+@profiling.profiled
+def load_data(tz=TZ):
 
     # import pickle
     # with open("dev_data.pkl", "rb") as f:
@@ -51,127 +151,72 @@ def load_data():
 
     # return ret
 
-    # load sleep data
-    df_sleep = h.load_sleep_data_from_supabase()
-    df_sleep_sessions = h.identify_sessions(
-        df_sleep,
-        min_gap_between_sessions_in_minutes=30,
-        min_duration_of_session_in_minutes=60,
-        add_sleep_duration_in_hours=True,
-    )
-
-    # load food data
-    df_eat = h.load_eat_data_from_supabase()
-    df_eat_sessions = h.identify_sessions(
-        df_eat,
-        min_gap_between_sessions_in_minutes=MIN_GAP_BETWEEN_SESSIONS_IN_MINUTES,
-        min_duration_of_session_in_minutes=0,
-    )
-
-    # evaluate deep fasting sessions
-    df_deep_fast_sessions = h.evaluate_deep_fast_sessions(
-        df_eat_sessions, DT_DEEP_FAST_IN_HOURS
-    )
-
-    # evaluate delta to first and last meal
-    df_first_and_last_meal = h.evaluate_delta_to_first_and_last_meal(
-        df_sleep_sessions, df_eat
-    )
-
-    # evaluate data for visualization
-    df_sleep_sessions_viz = h.process_for_visualization(df_sleep_sessions, TZ)
-    df_eat_viz = h.process_for_visualization(df_eat, TZ)
-    df_eat_sessions_viz = h.process_for_visualization(df_eat_sessions, TZ)
-    df_deep_fast_sessions_viz = h.process_for_visualization(df_deep_fast_sessions, TZ)
+    with st.spinner("Fetching data..."):
+        snapshot = get_refresher().snapshot()  # only waits for the first one
+    if snapshot is None:
+        return None, None
+    ret = snapshot.ret
+    return localize_data(ret, snapshot.version, ret["params"], tz), snapshot
 
-    df_deep_fast_viz = h.process_deep_fast_sessions_for_viz(
-        df_deep_fast_sessions, timezone=TZ
-    )
-    df_first_meal_viz, df_last_meal_viz = h.process_first_and_last_meal_data_for_viz(
-        df_first_and_last_meal, timezone=TZ
-    )
-    df_sleep_duration_viz = h.process_sleep_sessions_for_viz(df_sleep_sessions, TZ)
-
-    # calculate score
-    df_score, debug_info = h.calculate_score(
-        df_deep_fast_viz,
-        df_first_meal_viz,
-        df_last_meal_viz,
-        df_sleep_duration_viz,
-        target_delta_fasting=TARGET_DELTA_FASTING,
-        target_delta_first_meal=TARGET_DELTA_FIRST_MEAL,
-        target_delta_last_meal=TARGET_DELTA_LAST_MEAL,
-        target_delta_sleep=TARGET_DELTA_SLEEP,
-        rolling_window_days=ROLLING_WINDOW_DAYS,
-        gamma=GAMMA,
-    )
-
-    return {
-        "df_sleep": df_sleep,
-        "df_sleep_sessions": df_sleep_sessions,
-        "df_eat": df_eat,
-        "df_eat_sessions": df_eat_sessions,
-        "df_deep_fast_sessions": df_deep_fast_sessions,
-        "df_first_and_last_meal": df_first_and_last_meal,
-        "df_sleep_sessions_viz": df_sleep_sessions_viz,
-        "df_eat_viz": df_eat_viz,
-        "df_eat_sessions_viz": df_eat_sessions_viz,
-        "df_deep_fast_sessions_viz": df_deep_fast_sessions_viz,
-        "df_deep_fast_viz": df_deep_fast_viz,
-        "df_first_meal_viz": df_first_meal_viz,
-        "df_last_meal_viz": df_last_meal_viz,
-        "df_sleep_duration_viz": df_sleep_duration_viz,
-        "df_score": df_score,
-        "debug_info": debug_info,
-    }
 
-
-def _get_current_scores(df_score):
-    ret = {}
-    cols = ["score_fasting", "score_first_meal", "score_last_meal", "score_sleep"]
-    for c in cols:
-        ser_tmp = df_score[c].dropna()
-        if len(ser_tmp) > 0:
-            ret[c] = ser_tmp.iloc[-1]
-        else:
-            ret[c] = np.nan
-    ret["score"] = np.mean(list(ret.values()))
-    return ret
-
-
-def _get_current_and_last_score(df_score):
-
-    score_current = _get_current_scores(df_score)["score"]
-    ts_current = df_score.date.dropna().iloc[-1]
-
-    # Last valid
-    row = df_score.dropna().iloc[-1]
-    score_last = row.score
-    ts_last = row.date
-
-    return score_current, ts_current, score_last, ts_last
-
-
-@st.cache_data
-def _get_current_deep_fast_state(df_deep_fast_sessions):
-    ts_now = pd.Timestamp.now(tz=TZ)
-    mask_current_deep_fast_session = (
-        ts_now - df_deep_fast_sessions.ts_end
-    ) < pd.Timedelta(seconds=10)
-    e = df_deep_fast_sessions[mask_current_deep_fast_session]
-    ts_now_str = ts_now.strftime("%Y-%m-%d %H:%M %Z")
-    if len(e) > 0:
-        hours = int(e.iloc[0].delta_in_hours)
-        minutes = int((e.iloc[0].delta_in_hours - hours) * 60)
-        return (
-            ts_now_str,
-            f"{hours}h {minutes}min",
-            e.iloc[0].ts_start.strftime("%Y-%m-%d %H:%M %Z"),
+# The header only needs the latest meal and the last days of the daily metrics,
+# so it is computed from the tail of the history and shown before the full
+# history is loaded (and replaced with the values of the full result then).
+@st.cache_data(
+    ttl=REFRESH_INTERVAL_IN_SECONDS, max_entries=len(TIMEZONES), show_spinner=False
+)
+@profiling.profiled
+def load_header(tz=TZ):
+    """Fast path: the current scores and the end of the latest meal.
+
+    The tail is widened until it covers the windows of the current scores
+    (see `pipeline.covers_current_scores`). Returns None if it doesn't after a
+    few tries, then the header waits for `load_data`.
+    """
+    days = HEADER_TAIL_DAYS
+    while days <= 4 * HEADER_TAIL_DAYS:
+        tail = h.load_tail_from_supabase(days, backend=DB_BACKEND)
+        if tail is None:
+            return None
+        df_sleep, df_eat = tail
+        ret = pipeline.run_pipeline(
+            df_sleep,
+            df_eat,
+            tz=tz,
+            target_delta_fasting=TARGET_DELTA_FASTING,
+            target_delta_first_meal=TARGET_DELTA_FIRST_MEAL,
+            target_delta_last_meal=TARGET_DELTA_LAST_MEAL,
+            target_delta_sleep=TARGET_DELTA_SLEEP,
+            rolling_window_days=ROLLING_WINDOW_DAYS,
+            gamma=GAMMA,
+            dt_deep_fast_in_hours=DT_DEEP_FAST_IN_HOURS,
+            min_gap_between_sessions_in_minutes=MIN_GAP_BETWEEN_SESSIONS_IN_MINUTES,
+            scores_only=True,
         )
-    return ts_now_str, "-", None
+        if pipeline.covers_current_scores(ret):
+            return vis.get_current_scores(ret["df_score"]), df_eat.ts_end.max()
+        days *= 2
+    return None
+
+
+# Only the shown range plus a margin is plotted, so the figure doesn't grow with
+# the history. It is rebuilt when the data, the parameters or the range change.
+def render_figure(ret, version, params, tz, x_range):
+    def compute():
+        margin = timedelta(days=RENDER_MARGIN_DAYS)
+        with st.spinner("Rendering..."):
+            return vis.visualize_data(
+                **ret,
+                x_range=x_range,
+                window=[x_range[0] - margin, x_range[1] + margin],
+                webgl=RENDER_WEBGL,
+            )
+
+    key = (tz, tuple(sorted(params.items())), tuple(x_range))
+    return _cached("figure", version, key, compute, DERIVED_CACHE_MAX_ENTRIES)
 
 
-def _get_current_fasting_duration(df_eat):
+def _get_current_fasting_duration(ts_last_meal, tz=TZ):
 
     def _dt2str(dt):
         if dt.total_seconds() < 0:
@@ -180,8 +225,8 @@ def _get_current_fasting_duration(df_eat):
         minutes = int((dt.total_seconds() % 3600) / 60)
         return f"{hours}h {minutes}min"
 
-    ts_now = pd.Timestamp.now(tz=TZ)
-    ts_last_meal = df_eat.ts_end.max()
+    ts_now = pd.Timestamp.now(tz=tz)
+    ts_last_meal = ts_last_meal.tz_convert(tz)
 
     # fasting
     ts_now_str = ts_now.strftime("%Y-%m-%d %H:%M %Z")
@@ -195,313 +240,57 @@ def _get_current_fasting_duration(df_eat):
     return ts_now_str, ts_last_meal_str, fasting_str, deep_fasting_str
 
 
-def visualize_data(
-    df_sleep_sessions_viz=None,
-    df_eat_viz=None,
-    df_eat_sessions_viz=None,
-    df_deep_fast_sessions_viz=None,
-    df_deep_fast_viz=None,
-    df_first_meal_viz=None,
-    df_last_meal_viz=None,
-    df_sleep_duration_viz=None,
-    df_score=None,
-    **kwargs,
-):
-
-    fig = make_subplots(rows=6, cols=1, shared_xaxes=True, vertical_spacing=0.025)
-
-    # Adding annotations to each subplot using the layout annotations list
-    fig.update_layout(
-        annotations=[
-            dict(
-                text="Deep Fast",
-                x=0,
-                y=1,
-                xref="x2 domain",
-                yref="y2 domain",
-                showarrow=False,
-                font=dict(color="aqua", size=12),
-            ),
-            dict(
-                text="First Meal After Sleep",
-                x=0,
-                y=1,
-                xref="x3 domain",
-                yref="y3 domain",
-                showarrow=False,
-                font=dict(color="orange", size=12),
-            ),
-            dict(
-                text="Last Meal Before Sleep",
-                x=0,
-                y=1,
-                xref="x4 domain",
-                yref="y4 domain",
-                showarrow=False,
-                font=dict(color="yellow", size=12),
-            ),
-            dict(
-                text="Sleep Duration",
-                x=0,
-                y=1,
-                xref="x5 domain",
-                yref="y5 domain",
-                showarrow=False,
-                font=dict(color="white", size=12),
-            ),
-            dict(
-                text="Score",
-                x=0,
-                y=1,
-                xref="x6 domain",
-                yref="y6 domain",
-                showarrow=False,
-                font=dict(color="red", size=12),
-            ),
-        ]
+def _show_header(c_overall_score, c_fasting, c_individual_scores, header, tz=TZ):
+    scores_current, ts_last_meal = header
+    ts_now_str, ts_last_meal_str, fasting_str, deep_fasting_str = (
+        _get_current_fasting_duration(ts_last_meal, tz)
     )
 
-    # Sleep sessions
-    fig.add_bar(
-        x=pd.to_datetime(df_sleep_sessions_viz.date),
-        y=df_sleep_sessions_viz.dh,
-        base=df_sleep_sessions_viz.h1,
-        opacity=0.8,
-        marker_color="gray",
-        hovertemplate=df_sleep_sessions_viz.info_html,
-        name="Asleep",
-        row=1,
-        col=1,
-    )
-
-    # East Sessions
-    fig.add_bar(
-        x=pd.to_datetime(df_eat_sessions_viz.date),
-        y=df_eat_sessions_viz.dh,
-        base=df_eat_sessions_viz.h1,
-        opacity=0.2,
-        marker_color="darkgreen",
-        hovertemplate=df_eat_sessions_viz.info_html,
-        name="Feeding Windows",
-        row=1,
-        col=1,
-    )
-
-    fig.add_bar(
-        x=pd.to_datetime(df_eat_viz.date),
-        y=df_eat_viz.dh,
-        base=df_eat_viz.h1,
-        opacity=1.0,
-        marker_color="darkgreen",
-        hovertemplate=df_eat_viz.info_html,
-        name="Meals",
-        row=1,
-        col=1,
-    )
-
-    # Fast windows
-    fig.add_bar(
-        x=pd.to_datetime(df_deep_fast_sessions_viz.date),
-        y=df_deep_fast_sessions_viz.dh,
-        base=df_deep_fast_sessions_viz.h1,
-        opacity=0.5,
-        marker_color="aqua",
-        hovertemplate=df_deep_fast_sessions_viz.info_html,
-        name="Deep Fast",
-        row=1,
-        col=1,
-    )
-
-    fig.add_hline(y=7, line_dash="dot", line_color="white", row=5, col=1)
-
-    for df, name, color, row in zip(
-        [df_deep_fast_viz, df_first_meal_viz, df_last_meal_viz, df_sleep_duration_viz],
-        [
-            "Deep Fasting Duration",
-            "First Meal After Sleep",
-            "Last Meal Before Sleep",
-            "Sleep Duration",
-        ],
-        ["aqua", "orange", "yellow", "white"],
-        [2, 3, 4, 5],
-    ):
-
-        fig.add_scatter(
-            x=df.date,
-            y=df.delta_in_hours,
-            mode="lines+markers",
-            name=name,
-            opacity=0.2,
-            marker_color=color,
-            row=row,
-            col=1,
-        )
-
-        fig.add_scatter(
-            x=df.date,
-            y=df.mean_delta_in_hours,
-            mode="lines",
-            name=name + (" Weekly Average"),
-            marker_color=color,
-            row=row,
-            col=1,
+    with c_overall_score:
+        st.metric(
+            label="Overall Score",
+            value=f"{scores_current['score']:.1%}",
+            border=True,
+            delta=f"updated at {ts_now_str}",
+            delta_color="off",
         )
 
-    # Add target lines
-    for y, row in zip(
-        [
-            TARGET_DELTA_FASTING,
-            TARGET_DELTA_FIRST_MEAL,
-            TARGET_DELTA_LAST_MEAL,
-            TARGET_DELTA_SLEEP,
-        ],
-        [2, 3, 4, 5],
-    ):
-
-        if not isinstance(y, tuple):
-            y = [y]
-
-        for _y in y:
-            fig.add_hline(
-                y=_y, line_dash="dot", line_color="white", line_width=1, row=row, col=1
-            )
-
-    # Add max and min score lines
-    max_score = df_score.score.max()
-    min_score = df_score.score.min()
-
-    # Add the score line first
-    fig.add_scatter(
-        x=df_score.date,
-        y=df_score.score,
-        mode="lines",
-        name="Score",
-        opacity=1,
-        marker_color="red",
-        row=6,
-        col=1,
-    )
-
-    fig.add_hline(
-        y=0.80,
-        line_dash="dot",
-        line_color="white",
-        line_width=0.5,
-        row=6,
-        col=1,
-    )
-
-    # Then add the max and min lines on top
-    fig.add_hline(
-        y=max_score,
-        line_dash="dot",
-        line_color="red",
-        line_width=0.5,
-        row=6,
-        col=1,
-        annotation=dict(
-            text=f"Max: {max_score:.1%}",
-            font=dict(color="red"),
-            yshift=0,
-            xanchor="right",
-            yanchor="bottom",
-        ),
-    )
-
-    fig.add_hline(
-        y=min_score,
-        line_dash="dot",
-        line_color="red",
-        line_width=0.5,
-        row=6,
-        col=1,
-        annotation=dict(
-            text=f"Min: {min_score:.1%}",
-            font=dict(color="red"),
-            yshift=0,
-            xanchor="right",
-            yanchor="top",
-        ),
-    )
-
-    score_current, ts_current, score_last, ts_last = _get_current_and_last_score(
-        df_score
-    )
-
-    fig.add_scatter(
-        x=[ts_last, ts_current],
-        y=[score_last, score_current],
-        mode="lines",
-        line=dict(color="red", dash="dot"),
-        row=6,
-        col=1,
-        showlegend=False,
-    )
-
-    fig.add_scatter(
-        x=[ts_current],
-        y=[score_current],
-        mode="markers",
-        name="Current Score",
-        marker=dict(color="red", size=6),
-        row=6,
-        col=1,
-    )
-
-    # Disable zooming
-    fig.update_yaxes(fixedrange=True)
-    fig.update_xaxes(
-        showline=True,
-        mirror=True,
-        showgrid=True,
-        range=[pd.Timestamp("2024-10-15"), pd.Timestamp.now()],
-    )
-    fig.update_yaxes(
-        showline=True, mirror=True, showgrid=False, range=[0, 24], row=1, col=1
-    )
-    for row in [2, 3, 4]:
-        fig.update_yaxes(
-            showline=True, mirror=True, showgrid=False, range=[0, 8], row=row, col=1
+    with c_fasting:
+        st.metric(
+            label="Current Fasting Time",
+            value=fasting_str,
+            border=True,
+            delta=f"deep fast duration: {deep_fasting_str}",
+            delta_color="off",
         )
-    fig.update_yaxes(
-        showline=True, mirror=True, showgrid=False, range=[4, 10], row=5, col=1
-    )
-
-    ymin = max(min_score - 0.05, 0)
-    ymax = min(max_score + 0.05, 1)
-    fig.update_yaxes(
-        showline=True,
-        mirror=True,
-        showgrid=True,
-        range=[ymin, ymax],
-        tickformat=",.0%",
-        row=6,
-        col=1,
-    )
-
-    fig.update_yaxes(
-        automargin=False  # prevents extra margin adjustments, because of e.g. yticklabels
-    )
-
-    fig.update_layout(
-        margin=dict(l=40, r=40, t=40, b=10),
-        showlegend=True,
-        legend=dict(orientation="h", yanchor="top", y=-0.05, xanchor="left", x=0.0),
-    )
-
-    # Layout
-    fig.update_layout(
-        barmode="overlay",
-        template="plotly_dark",
-        bargap=0.05,
-        width=1000,
-        height=1000,
-    )
-
-    # Set default drag mode to pan
-    fig.update_layout(dragmode="pan")
 
-    return fig
+    with c_individual_scores.container():
+        k = ["score_fasting", "score_first_meal", "score_last_meal", "score_sleep"]
+        n = ["Fasting", "First Meal", "Last Meal", "Sleep"]
+        v = [scores_current[k] for k in k]
+        c = st.columns(len(k))
+        for i, (k, v, n) in enumerate(zip(k, v, n)):
+            with c[i]:
+                st.metric(label=n, value=f"{v:.0%}", border=False)
+
+
+# Checks for a new snapshot every few seconds, and reruns the page once there
+# is one (new data or a later current time). Also keeps the age of the shown
+# snapshot up to date.
+@st.fragment(run_every=timedelta(seconds=5))
+def _show_status(version):
+    refresher = get_refresher()
+    snapshot = refresher.snapshot(timeout=0)
+    if snapshot.version != version:
+        st.rerun()
+
+    minutes = int(snapshot.age().total_seconds() / 60)
+    status = f"Data fetched {minutes} min ago"
+    if refresher.is_refreshing():
+        status += ", refreshing..."
+    if refresher.error is not None:
+        status += f" (the last refresh failed: {refresher.error})"
+    st.caption(status)
 
 
 # Main
@@ -509,51 +298,51 @@ def visualize_data(
 
 st.title("Eat-Sleep-Repeat")
 
-if st.button("Refresh Data", use_container_width=True):
-    st.cache_data.clear()
+if PROFILE:
+    profiling.enable(trace_memory=PROFILE_MEMORY)
+    # only show the stages of this run (other sessions run in other threads),
+    # the refresher keeps its own on its snapshots
+    page_trace = profiling.start_capture()
+
+refresher = get_refresher()
+
+c_refresh, c_resync, c_tz = st.columns([3, 1, 1])
+with c_refresh:
+    # the refresh runs in the background, the page keeps the current snapshot
+    if st.button("Refresh Data", use_container_width=True):
+        refresher.refresh()
+with c_resync:
+    if st.button("Full Resync", use_container_width=True):
+        refresher.refresh(full_resync=True)
+with c_tz:
+    tz = st.selectbox("Timezone", TIMEZONES, label_visibility="collapsed")
+c_status = st.container(border=False)
 
 
 t1, t2 = st.tabs(["Metrics", "Graph"])
 with t1:
-    c_overall_score, c_fasting = st.columns([1, 1])
-    c_individual_scores = st.container(border=True)
+    # placeholders, filled from the tail first and from the full result then
+    c_overall_score, c_fasting = (c.empty() for c in st.columns([1, 1]))
+    c_individual_scores = st.container(border=True).empty()
     c_debug = st.container(border=False)
 with t2:
     c_figure = st.container(border=False)
 
-ret = load_data()
-scores_current = _get_current_scores(ret["df_score"])
-ts_now_str, ts_last_meal_str, fasting_str, deep_fasting_str = (
-    _get_current_fasting_duration(ret["df_eat"])
-)
-
-
-with c_overall_score:
-    st.metric(
-        label=f"Overall Score",
-        value=f"{scores_current['score']:.1%}",
-        border=True,
-        delta=f"updated at {ts_now_str}",
-        delta_color="off",
-    )
+# the tail is only needed until the first snapshot is ready
+if not refresher.is_ready():
+    header = load_header(tz)
+    if header is not None:
+        _show_header(c_overall_score, c_fasting, c_individual_scores, header, tz)
 
-with c_fasting:
-    st.metric(
-        label="Current Fasting Time",
-        value=fasting_str,
-        border=True,
-        delta=f"deep fast duration: {deep_fasting_str}",
-        delta_color="off",
-    )
+ret, snapshot = load_data(tz)
+if ret is None:
+    st.error(f"Loading the data failed: {refresher.error}")
+    st.stop()
+header = vis.get_current_scores(ret["df_score"]), ret["index"].last_end("eat")
+_show_header(c_overall_score, c_fasting, c_individual_scores, header, tz)
 
-with c_individual_scores:
-    k = ["score_fasting", "score_first_meal", "score_last_meal", "score_sleep"]
-    n = ["Fasting", "First Meal", "Last Meal", "Sleep"]
-    v = [scores_current[k] for k in k]
-    c = st.columns(len(k))
-    for i, (k, v, n) in enumerate(zip(k, v, n)):
-        with c[i]:
-            st.metric(label=n, value=f"{v:.0%}", border=False)
+with c_status:
+    _show_status(snapshot.version)
 
 with c_debug:
     for name, df_debug in ret["debug_info"].items():
@@ -561,12 +350,34 @@ with c_debug:
             row_height = 35
             height = int(row_height * (1.05 + ROLLING_WINDOW_DAYS))
             st.dataframe(
-                df_debug, height=height, row_height=row_height, hide_index=True
+                h.style_debug_frame(df_debug),
+                height=height,
+                row_height=row_height,
+                hide_index=True,
             )
 
+    with st.expander("Debug connections"):
+        st.json(h.CONNECTION_STATS)
+        st.json(refresher.stats)
+
+    c_performance = st.container(border=False)  # filled once the figure is done
+
 
 with c_figure:
-    fig = visualize_data(**ret)
+    today = pd.Timestamp.now().normalize()
+    date_range = st.date_input(
+        "Range",
+        value=(PLOT_START, today),
+        max_value=today,
+        label_visibility="collapsed",
+    )
+    if len(date_range) < 2:  # while the end date is being picked
+        date_range = (date_range[0], today)
+    x_range = [
+        pd.Timestamp(date_range[0]),
+        pd.Timestamp(date_range[1]) + timedelta(days=1),
+    ]
+    fig = render_figure(ret, snapshot.version, ret["params"], tz, x_range)
     config = {
         "modeBarButtons": [
             ["pan2d", "zoomIn2d", "zoomOut2d", "resetScale2d"]
@@ -575,3 +386,21 @@ with c_figure:
         "modeBarPosition": "top",  # Attempts to position the modebar above the plot (may depend on your Plotly version)
     }
     st.plotly_chart(fig, config=config)
+
+
+if PROFILE:
+    with c_performance:
+        with st.expander("Performance"):
+            for name, recs in [
+                ("Page load", page_trace),
+                ("Background refresh (of the shown snapshot)", snapshot.trace),
+            ]:
+                st.markdown(f"**{name}**")
+                st.dataframe(profiling.records(recs), hide_index=True)
+                st.download_button(
+                    "Download trace",
+                    json.dumps(profiling.chrome_trace(recs)),
+                    file_name="trace.json",
+                    mime="application/json",
+                    key=f"trace {name}",
+                )
@@ -0,0 +1,140 @@
+import os
+import numpy as np
+import pandas as pd
+import pipeline
+from concurrent.futures import ProcessPoolExecutor
+from interval_store import to_epoch_ns
+
+SCORE_COLUMNS = [
+    "score_fasting",
+    "score_first_meal",
+    "score_last_meal",
+    "score_sleep",
+    "score",
+]
+
+# Batch processing
+# ----------------
+#
+# The frames of all users are packed into flat numpy arrays (epoch ns and
+# integer codes) once. Every task only carries the slices of one user, which
+# pickle as raw buffers, and returns the scores as arrays, too.
+
+
+def run_batch(df_sleep, df_eat, n_workers=None, chunksize=8, ts_now=None, **params):
+    """Compute the daily scores of many users in parallel.
+
+    Args:
+        df_sleep (pd.DataFrame): Sleep stages of all users, as returned by the
+            sleep loaders plus a user_id column.
+        df_eat (pd.DataFrame): Meals of all users, as returned by the eat
+            loaders plus a user_id column.
+        n_workers (int, optional): Number of worker processes, 1 computes in
+            this process. Defaults to the number of cores.
+        chunksize (int, optional): Users sent to a worker at once. Defaults to 8.
+        ts_now (pd.Timestamp, optional): End of the ongoing deep fast sessions,
+            the same for all users. Defaults to now.
+        **params: Parameters of `pipeline.run_pipeline`.
+
+    Returns:
+        pd.DataFrame: Columns user_id, date and the scores (see
+            `helper.calculate_score`), sorted by user and date. Users without
+            sleep or without meals are skipped.
+    """
+    if ts_now is None:
+        ts_now = pd.Timestamp.now(tz="UTC")
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    sleep = pack_frames(df_sleep)
+    eat = pack_frames(df_eat)
+    users = np.intersect1d(sleep["users"], eat["users"])
+    tasks = (
+        (user_id, _user_arrays(sleep, user_id), _user_arrays(eat, user_id))
+        for user_id in users
+    )
+    initargs = (sleep["categories"], params, ts_now)
+
+    if n_workers == 1:
+        _init_worker(*initargs)
+        results = list(map(_score_user, tasks))
+    else:
+        with ProcessPoolExecutor(
+            n_workers, initializer=_init_worker, initargs=initargs
+        ) as executor:
+            results = list(executor.map(_score_user, tasks, chunksize=chunksize))
+
+    if len(results) == 0:
+        return pd.DataFrame(columns=["user_id", "date"] + SCORE_COLUMNS)
+    user_ids, dates, scores = zip(*results)
+    df = pd.DataFrame(np.concatenate(scores), columns=SCORE_COLUMNS)
+    df.insert(0, "date", np.concatenate(dates).view("datetime64[ns]"))
+    df.insert(0, "user_id", np.repeat(user_ids, [len(d) for d in dates]))
+    return df
+
+
+def pack_frames(df):
+    """Pack the intervals of all users into flat arrays, sorted by user and start.
+
+    Returns a dict with the users, the offset of the rows of every user, the
+    columns ts_start and ts_end (epoch ns), code (position of the value in
+    the sorted categories) and the categories.
+    """
+    codes, categories = pd.factorize(df["value"], sort=True)
+    user_ids = df["user_id"].to_numpy()
+    ts_start = to_epoch_ns(df["ts_start"])
+    order = np.lexsort([codes, to_epoch_ns(df["ts_end"]), ts_start, user_ids])
+    user_ids = user_ids[order]
+    users, offsets = np.unique(user_ids, return_index=True)
+    return {
+        "users": users,
+        "offsets": np.append(offsets, len(order)),
+        "ts_start": ts_start[order],
+        "ts_end": to_epoch_ns(df["ts_end"])[order],
+        "code": codes[order].astype(np.int32),
+        "categories": np.asarray(categories, dtype=object),
+    }
+
+
+def _user_arrays(packed, user_id):
+    i = np.searchsorted(packed["users"], user_id)
+    i0, i1 = packed["offsets"][i], packed["offsets"][i + 1]
+    return tuple(packed[c][i0:i1] for c in ["ts_start", "ts_end", "code"])
+
+
+# Workers
+# -------
+
+_WORKER = {}
+
+
+def _init_worker(sleep_categories, params, ts_now):
+    _WORKER.update(sleep_categories=sleep_categories, params=params, ts_now=ts_now)
+
+
+def _score_user(task):
+    user_id, (ts_start, ts_end, code), eat = task
+    # the sleep stages are needed by name, for the meals the codes will do (they
+    # sort like the descriptions)
+    df_score = pipeline.run_pipeline(
+        _to_frame(ts_start, ts_end, _WORKER["sleep_categories"][code]),
+        _to_frame(*eat),
+        ts_now=_WORKER["ts_now"],
+        scores_only=True,
+        **_WORKER["params"],
+    )["df_score"]
+    return (
+        user_id,
+        df_score.date.values.astype("datetime64[ns]").view(np.int64),
+        df_score[SCORE_COLUMNS].to_numpy(dtype=np.float64),
+    )
+
+
+def _to_frame(ts_start, ts_end, value):
+    return pd.DataFrame(
+        {
+            "ts_start": pd.DatetimeIndex(ts_start.view("datetime64[ns]"), tz="UTC"),
+            "ts_end": pd.DatetimeIndex(ts_end.view("datetime64[ns]"), tz="UTC"),
+            "value": value,
+        }
+    )
@@ -0,0 +1,1554 @@
+import os
+import json
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import helper as h
+import pipeline
+import batch
+import visualization as vis
+import health_export as he
+from interval_index import IntervalIndex
+from refresher import Refresher
+from datetime import timedelta
+from types import SimpleNamespace
+
+# Synthetic data
+# --------------
+
+
+def make_intervals(n, seed=0, values=("Core", "REM", "Deep", "InBed")):
+    """Create `n` random intervals with a mix of short and long gaps.
+
+    Intervals are kept short (a few minutes) so that 10M of them still fit
+    into the range of nanosecond timestamps.
+    """
+    rng = np.random.default_rng(seed)
+    durations = rng.integers(1, 10, size=n) * 60
+    gaps = np.where(rng.random(n) < 0.005, 12 * 3600, rng.integers(0, 2, size=n) * 60)
+    ts_start = np.cumsum(durations + gaps) - durations
+    ts_start = pd.Timestamp("1970-01-01", tz="UTC") + pd.to_timedelta(
+        ts_start, unit="s"
+    )
+    return pd.DataFrame(
+        {
+            "ts_start": ts_start,
+            "ts_end": ts_start + pd.to_timedelta(durations, unit="s"),
+            "value": rng.choice(values, size=n),
+        }
+    )
+
+
+def make_sleep_sessions_and_meals(years, seed=0):
+    """Create one sleep session and three meals per day over `years` years."""
+    rng = np.random.default_rng(seed)
+    n_days = int(365 * years)
+    days = pd.Timestamp("2020-01-01", tz="UTC") + pd.to_timedelta(
+        np.arange(n_days), unit="D"
+    )
+
+    def hours(mean, size):
+        return pd.to_timedelta(rng.normal(mean, 0.75, size=size), unit="h")
+
+    ts_start = days + hours(23, n_days)
+    df_sleep_sessions = pd.DataFrame(
+        {"ts_start": ts_start, "ts_end": ts_start + hours(7.5, n_days)}
+    )
+
+    meal_days = np.repeat(days, 3)
+    meal_hours = np.tile(pd.to_timedelta([8, 13, 19], unit="h"), n_days)
+    ts_start = meal_days + meal_hours + hours(0, 3 * n_days)
+    df_eat = pd.DataFrame(
+        {"ts_start": ts_start, "ts_end": ts_start + pd.Timedelta(minutes=30)}
+    )
+    return df_sleep_sessions, df_eat
+
+
+SLEEP_CYCLE = ["Core", "Deep", "Core", "REM"]
+MEAL_DESCRIPTIONS = ["Breakfast", "Lunch", "Dinner", "Snack", "Coffee with milk"]
+
+
+def make_health_data(
+    n_days,
+    n_users=1,
+    seed=0,
+    noise=1.0,
+    p_missing_night=0.03,
+    p_missing_meal=0.05,
+    p_gap=0.05,
+    p_overlap=0.05,
+    start="2020-01-01",
+):
+    """Create realistic raw sleep stages and meals of `n_users` over `n_days`.
+
+    Every night has an InBed interval and ~90 minute cycles of Core, Deep,
+    Core and REM stages (Deep gets shorter and REM longer towards the morning)
+    with short Awake phases. There are three meals a day plus occasional
+    snacks, some shorter than the minimal eat duration.
+
+    Args:
+        n_days (int): Number of days per user.
+        n_users (int, optional): Number of users. Defaults to 1.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+        noise (float, optional): Scale of the day to day variation of bed and
+            meal times and of the stage durations. Defaults to 1.0.
+        p_missing_night (float, optional): Probability that a night wasn't
+            recorded. Defaults to 0.03.
+        p_missing_meal (float, optional): Probability that a meal wasn't
+            logged. Defaults to 0.05.
+        p_gap (float, optional): Probability that a sleep stage is missing,
+            leaving a gap in the night. Defaults to 0.05.
+        p_overlap (float, optional): Probability that a stage overlaps the next
+            one or that a meal was logged twice. Defaults to 0.05.
+        start (str, optional): First day. Defaults to "2020-01-01".
+
+    Returns:
+        tuple: df_sleep (user_id, ts_start, ts_end, value) and df_eat (user_id,
+            id, ts_start, ts_end, description) as stored in the tables, i.e.
+            before the loaders drop Awake stages and process the meals.
+    """
+    rng = np.random.default_rng(seed)
+    days = pd.Timestamp(start, tz="UTC") + pd.to_timedelta(np.arange(n_days), unit="D")
+
+    dfs_sleep, dfs_eat = [], []
+    for user_id in range(n_users):
+        # every user has their own habits
+        shift = rng.normal(0, 1)
+        df_sleep = _make_sleep_stages(
+            rng, days, 23 + shift, noise, p_missing_night, p_gap, p_overlap
+        )
+        df_eat = _make_meals(rng, days, shift / 2, noise, p_missing_meal, p_overlap)
+        df_eat.insert(1, "id", user_id * 10 * n_days + np.arange(len(df_eat)))
+        dfs_sleep.append(df_sleep.assign(user_id=user_id))
+        dfs_eat.append(df_eat.assign(user_id=user_id))
+
+    def to_frame(dfs, columns):
+        df = pd.concat(dfs, ignore_index=True)
+        df = df.sort_values(["user_id", "ts_start"], kind="stable", ignore_index=True)
+        return df[["user_id"] + columns]
+
+    return (
+        to_frame(dfs_sleep, h.SLEEP_COLUMNS),
+        to_frame(dfs_eat, h.EAT_COLUMNS),
+    )
+
+
+def _make_sleep_stages(rng, days, bedtime, noise, p_missing_night, p_gap, p_overlap):
+    days = days[rng.random(len(days)) >= p_missing_night]
+    n, n_cycles = len(days), 8
+    second = np.timedelta64(1, "s")
+
+    ts_bed = days + pd.to_timedelta(bedtime + rng.normal(0, 0.75 * noise, n), unit="h")
+    ts_bed = ts_bed.floor("s")
+    in_bed = np.clip(7.5 + rng.normal(0, noise, n), 3, 11) * 60  # minutes
+    latency = rng.uniform(5, 30, n)
+
+    # mean stage durations in minutes, one row per night
+    cycle = np.arange(n_cycles)
+    mean = np.stack(
+        [
+            np.full(n_cycles, 25.0),
+            25 * np.exp(-cycle / 2) + 3,
+            np.full(n_cycles, 20.0),
+            10 + 5 * cycle,
+        ],
+        axis=1,
+    ).ravel()
+    values = np.tile(np.array(SLEEP_CYCLE * n_cycles, dtype=object), (n, 1))
+    durations = mean * np.exp(rng.normal(0, 0.3 * noise, (n, len(mean))))
+    is_awake = rng.random(values.shape) < 0.05
+    values[is_awake] = "Awake"
+    durations[is_awake] = rng.uniform(1, 6, is_awake.sum())
+
+    # cut the stages at the end of the night
+    ends = latency[:, None] + np.cumsum(durations, axis=1)
+    starts = ends - durations
+    ends = np.minimum(ends, in_bed[:, None] - rng.uniform(0, 20, n)[:, None])
+    keep = (starts < ends) & (rng.random(values.shape) >= p_gap)
+    ends = ends + (rng.random(values.shape) < p_overlap) * rng.uniform(
+        1, 10, ends.shape
+    )
+
+    rows = np.nonzero(keep)
+    ts_night = ts_bed.values[rows[0]]
+    df_stages = pd.DataFrame(
+        {
+            "ts_start": ts_night + (starts[keep] * 60).astype("int64") * second,
+            "ts_end": ts_night + (ends[keep] * 60).astype("int64") * second,
+            "value": values[keep],
+        }
+    )
+    df_in_bed = pd.DataFrame(
+        {
+            "ts_start": ts_bed.values,
+            "ts_end": ts_bed.values + (in_bed * 60).astype("int64") * second,
+            "value": "InBed",
+        }
+    )
+    df = pd.concat([df_in_bed, df_stages], ignore_index=True)
+    for c in ["ts_start", "ts_end"]:
+        df[c] = df[c].dt.tz_localize("UTC")
+    return df.sort_values("ts_start", kind="stable", ignore_index=True)
+
+
+def _make_meals(rng, days, shift, noise, p_missing_meal, p_overlap):
+    n = len(days)
+    meal_hours = [8 + shift, 13 + shift, 19 + shift]
+    hours = np.tile(meal_hours, (n, 1)) + rng.normal(0, 0.75 * noise, (n, 3))
+    logged = rng.random(hours.shape) >= p_missing_meal
+    descriptions = np.tile(np.array(MEAL_DESCRIPTIONS[:3], dtype=object), (n, 1))
+
+    # afternoon snacks and late night snacks
+    snack_hours = np.stack([rng.uniform(15, 17, n), rng.uniform(21, 23, n)], axis=1)
+    is_snack = rng.random(snack_hours.shape) < [0.3, 0.1]
+    hours = np.concatenate([hours, snack_hours], axis=1)
+    logged = np.concatenate([logged, is_snack], axis=1)
+    descriptions = np.concatenate(
+        [descriptions, rng.choice(MEAL_DESCRIPTIONS[3:], snack_hours.shape)], axis=1
+    )
+
+    ts_start = np.repeat(days.values, hours.shape[1]).reshape(hours.shape)[logged]
+    ts_start = ts_start + pd.to_timedelta(hours[logged], unit="h").values
+    durations = pd.to_timedelta(rng.uniform(5, 45, len(ts_start)), unit="min").values
+    descriptions = descriptions[logged]
+
+    # meals that were logged twice, slightly shifted
+    is_dup = rng.random(len(ts_start)) < p_overlap
+    shifts = pd.to_timedelta(rng.uniform(0, 20, is_dup.sum()), unit="min").values
+    ts_start = np.concatenate([ts_start, ts_start[is_dup] + shifts])
+    durations = np.concatenate([durations, durations[is_dup]])
+    descriptions = np.concatenate([descriptions, descriptions[is_dup]])
+
+    df = pd.DataFrame(
+        {
+            "ts_start": pd.DatetimeIndex(ts_start).floor("s").tz_localize("UTC"),
+            "ts_end": pd.DatetimeIndex(ts_start + durations)
+            .floor("s")
+            .tz_localize("UTC"),
+            "description": descriptions,
+        }
+    )
+    return df.sort_values("ts_start", kind="stable", ignore_index=True)
+
+
+# Reference implementations
+# -------------------------
+
+
+def _identify_sessions_loop(
+    df,
+    min_gap_between_sessions_in_minutes=60 * 12,
+    min_duration_of_session_in_minutes=0,
+    add_sleep_duration_in_hours=False,
+):
+    """`helper.identify_sessions` as of the baseline, unchanged, as a reference
+    (see `_adapt_sessions_loop` for the changes of the returned frame)."""
+
+    df_agg = df.copy()
+
+    # calculate gap to next sleep period
+    df_agg = df_agg.sort_values("ts_start").reset_index(drop=True)
+    df_agg["gap_to_next_in_minutes"] = (
+        df_agg["ts_start"].shift(-1) - df_agg["ts_end"]
+    ).dt.total_seconds() / 60
+    df_agg["sleep_duration_in_hours"] = np.where(
+        df_agg["value"] != "InBed",
+        (df_agg["ts_end"] - df_agg["ts_start"]).dt.total_seconds() / 60 / 60,
+        np.nan,
+    )
+
+    # assign sleep session
+    df_agg["session"] = np.nan
+    current_session = 0
+    for i in range(len(df_agg)):
+        df_agg.loc[i, "session"] = current_session
+        if (
+            df_agg.loc[i, "gap_to_next_in_minutes"]
+            > min_gap_between_sessions_in_minutes
+        ):
+            current_session += 1
+    df_agg["session"] = df_agg["session"].astype(int)
+
+    # group by sleep-session
+    df_agg = (
+        df_agg.groupby("session")
+        .agg(
+            ts_start=("ts_start", "min"),
+            ts_end=("ts_end", "max"),
+            sleep_duration_in_hours=(
+                "sleep_duration_in_hours",
+                lambda x: x.sum() if not x.isna().all() else np.nan,
+            ),
+        )
+        .reset_index()
+        .sort_values("ts_start")
+    )
+
+    # remove sessions that are too short (whatever the threshold is)
+    df_agg["duration_in_hours"] = (
+        (df_agg["ts_end"] - df_agg["ts_start"]).dt.total_seconds() / 60 / 60
+    )
+    df_agg = df_agg[df_agg.duration_in_hours >= min_duration_of_session_in_minutes / 60]
+
+    if add_sleep_duration_in_hours:
+        df_agg["info_dict"] = df_agg.apply(
+            lambda row: {
+                "session": row.session,
+                "duration_in_hours": row.duration_in_hours,
+                "sleep_duration_in_hours": row.sleep_duration_in_hours,
+            },
+            axis=1,
+        )
+    else:
+        df_agg["info_dict"] = df_agg.apply(
+            lambda row: {
+                "session": row.session,
+                "duration_in_hours": row.duration_in_hours,
+            },
+            axis=1,
+        )
+        df_agg.drop(columns=["sleep_duration_in_hours"], inplace=True)
+
+    return df_agg
+
+
+def _adapt_sessions_loop(df_agg):
+    """The frame of `_identify_sessions_loop` as `helper.identify_sessions`
+    returns it now: indexed by session, and without the info_dict column (the
+    hover text is built from the columns, see `helper.hover_info`)."""
+    df_agg = df_agg.drop(columns="info_dict")
+    df_agg.index = df_agg.session.to_numpy()
+    return df_agg
+
+
+def _evaluate_delta_to_first_and_last_meal_loop(df_sleep_sessions, df_eat):
+    """The former row-by-row implementation, kept as a baseline."""
+
+    df = df_sleep_sessions.copy()
+
+    df["ts_start_first_meal_after"] = None
+    df["ts_end_last_meal_before"] = None
+
+    for idx, row in df.iterrows():
+
+        ser = df_eat.ts_start - row.ts_end
+        ser = ser[ser > timedelta(seconds=0)]
+        if len(ser) == 0:
+            ts_start_first_meal_after = pd.to_datetime(np.nan)
+        else:
+            ts_start_first_meal_after = df_eat.loc[ser.idxmin()].ts_start
+
+        ser = row.ts_start - df_eat.ts_end
+        ser = ser[ser > timedelta(seconds=0)]
+        if len(ser) == 0:
+            ts_end_last_meal_before = pd.to_datetime(np.nan)
+        else:
+            ts_end_last_meal_before = df_eat.loc[ser.idxmin()].ts_end
+
+        df.loc[idx, "ts_start_first_meal_after"] = ts_start_first_meal_after
+        df.loc[idx, "ts_end_last_meal_before"] = ts_end_last_meal_before
+
+    for k in ["ts_start_first_meal_after", "ts_end_last_meal_before"]:
+        df[k] = pd.to_datetime(df[k])
+
+    df["delta_first_meal_after_in_hours"] = (
+        (df.ts_start_first_meal_after - df.ts_end).dt.total_seconds() / 60 / 60
+    )
+    df["delta_last_meal_before_in_hours"] = (
+        (df.ts_start - df.ts_end_last_meal_before).dt.total_seconds() / 60 / 60
+    )
+
+    return df
+
+
+def _process_for_visualization_loop(df_sleep, tz):
+    """The former row-by-row implementation, kept as a baseline (with the
+    interval times and hover columns instead of the HTML hover text)."""
+
+    hover_columns = [c for c in h.HOVER_COLUMNS if c in df_sleep]
+    data = []
+
+    for _, row in df_sleep.iterrows():
+
+        t1 = row["ts_start"].tz_convert(tz)
+        t2 = row["ts_end"].tz_convert(tz)
+        assert t1 <= t2, "t1 is larger or equal to t2!!!"
+
+        d1 = t1.date()
+        h1 = t1.hour + t1.minute / 60
+        d2 = t2.date()
+        h2 = t2.hour + t2.minute / 60
+        info = {"ts_start": t1, "ts_end": t2, **{c: row[c] for c in hover_columns}}
+
+        if d1 != d2:
+            data.append({"date": d1, "h1": h1, "h2": 24, "dh": 24 - h1, **info})
+            for i in range(1, (d2 - d1).days):
+                d = d1 + i * timedelta(days=1)
+                data.append({"date": d, "h1": 0, "h2": 24, "dh": 24, **info})
+            data.append({"date": d2, "h1": 0, "h2": h2, "dh": h2, **info})
+        else:
+            data.append({"date": d1, "h1": h1, "h2": h2, "dh": h2 - h1, **info})
+
+    return pd.DataFrame(data).astype(
+        {"h1": float, "h2": float, "dh": float, **df_sleep.dtypes[hover_columns]}
+    )
+
+
+# The former ingest trigger, one INSERT per datapoint
+_TRANSFORM_SLEEP_ANALYSIS_LOOP_SQL = """
+CREATE OR REPLACE FUNCTION transform_sleep_analysis()
+RETURNS TRIGGER AS $$
+DECLARE
+  metric    JSONB;
+  datapoint JSONB;
+BEGIN
+  -- Loop over each metric in NEW.data (cast to jsonb)
+  FOR metric IN
+    SELECT * FROM jsonb_array_elements(NEW.data::jsonb->'metrics')
+  LOOP
+    IF metric->>'name' = 'sleep_analysis' THEN
+      FOR datapoint IN
+        SELECT * FROM jsonb_array_elements(metric->'data')
+      LOOP
+        INSERT INTO apple_health_sleep_analysis (ts_start, ts_end, value)
+        VALUES (
+          (datapoint->>'startDate')::timestamptz,
+          (datapoint->>'endDate')::timestamptz,
+          datapoint->>'value'
+        )
+        ON CONFLICT DO NOTHING;
+      END LOOP;
+    END IF;
+  END LOOP;
+
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+# Benchmarks
+# ----------
+
+
+def _timeit(func, *args, repeat=3, **kwargs):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def bench_identify_sessions(
+    sizes=(1_000, 10_000, 100_000, 1_000_000, 10_000_000), n_check=5_000
+):
+    """Time `helper.identify_sessions`.
+
+    First, `n_check` intervals are checked against the baseline loop for a few
+    parameter combinations (after adapting its frame, see
+    `_adapt_sessions_loop`).
+    """
+    print("identify_sessions")
+    df = make_intervals(n_check)
+    for kwargs in [
+        dict(min_gap_between_sessions_in_minutes=30),
+        dict(
+            min_gap_between_sessions_in_minutes=30,
+            min_duration_of_session_in_minutes=60,
+            add_sleep_duration_in_hours=True,
+        ),
+        dict(min_gap_between_sessions_in_minutes=0, add_sleep_duration_in_hours=True),
+    ]:
+        pd.testing.assert_frame_equal(
+            h.identify_sessions(df, **kwargs),
+            _adapt_sessions_loop(_identify_sessions_loop(df, **kwargs)),
+        )
+
+    for n in sizes:
+        df = make_intervals(n)
+        t = _timeit(
+            h.identify_sessions,
+            df,
+            min_gap_between_sessions_in_minutes=30,
+            min_duration_of_session_in_minutes=60,
+            add_sleep_duration_in_hours=True,
+            repeat=1 if n >= 1_000_000 else 3,
+        )
+        print(f"  n={n:>10,d}  {t * 1000:10.1f} ms  {n / t / 1e6:6.2f} M rows/s")
+
+
+def bench_evaluate_delta_to_first_and_last_meal(years=(1, 2, 5, 10)):
+    print("evaluate_delta_to_first_and_last_meal")
+    for y in years:
+        df_sleep_sessions, df_eat = make_sleep_sessions_and_meals(y)
+        pd.testing.assert_frame_equal(
+            _evaluate_delta_to_first_and_last_meal_loop(df_sleep_sessions, df_eat),
+            h.evaluate_delta_to_first_and_last_meal(df_sleep_sessions, df_eat),
+        )
+        t_loop = _timeit(
+            _evaluate_delta_to_first_and_last_meal_loop,
+            df_sleep_sessions,
+            df_eat,
+            repeat=1,
+        )
+        t_sorted = _timeit(
+            h.evaluate_delta_to_first_and_last_meal, df_sleep_sessions, df_eat
+        )
+        print(
+            f"  years={y:>3d}  loop {t_loop * 1000:10.1f} ms  "
+            f"sorted search {t_sorted * 1000:8.1f} ms  "
+            f"speedup {t_loop / t_sorted:8.1f}x"
+        )
+
+
+def bench_process_for_visualization(
+    sizes=(1_000, 10_000, 100_000, 1_000_000), n_check=2_000, seed=0
+):
+    """Time `helper.process_for_visualization`.
+
+    First, `n_check` sessions (some spanning several days) are checked against
+    the former loop in a few timezones.
+    """
+    print("process_for_visualization")
+    rng = np.random.default_rng(seed)
+    df = h.identify_sessions(
+        make_intervals(n_check, seed=seed), min_gap_between_sessions_in_minutes=0
+    )
+    is_long = rng.random(len(df)) < 0.1
+    df.loc[is_long, "ts_end"] += pd.to_timedelta(
+        rng.integers(0, 4 * 24 * 60, is_long.sum()), unit="min"
+    )
+    for tz in ["UTC", "Europe/Berlin", "America/Los_Angeles", "Asia/Kolkata"]:
+        pd.testing.assert_frame_equal(
+            h.process_for_visualization(df, tz),
+            _process_for_visualization_loop(df, tz),
+            obj=tz,
+        )
+
+    for n in sizes:
+        df = h.identify_sessions(
+            make_intervals(n), min_gap_between_sessions_in_minutes=0
+        )
+        t = _timeit(h.process_for_visualization, df, "Europe/Berlin")
+        print(f"  n={len(df):>10,d}  {t * 1000:10.1f} ms")
+
+
+def _assert_results_equal(ret, ret_expected):
+    assert list(ret) == list(ret_expected)
+    for k, v in ret_expected.items():
+        if k == "debug_info":
+            for name, df_debug in v.items():
+                pd.testing.assert_frame_equal(ret[k][name], df_debug)
+        elif k == "daily":
+            pd.testing.assert_index_equal(ret[k]["date"], v["date"])
+            for c in ["delta_in_hours", "mean_delta_in_hours"]:
+                np.testing.assert_allclose(ret[k][c], v[c], rtol=1e-12, err_msg=c)
+        elif isinstance(v, pd.DataFrame):
+            pd.testing.assert_frame_equal(ret[k], v, obj=k)
+        else:
+            assert ret[k] == v, k
+
+
+def bench_update_pipeline(years=(1, 5, 20), n_checks=20, seed=0):
+    """Time `update_pipeline` for one new night and meal, and for moving on to
+    the next minute (like the refresher), against a full run.
+
+    Before timing, the incremental result is checked against a full recompute
+    for random appends, edits and deletions (`n_checks` cases per size).
+    """
+    print("update_pipeline")
+    rng = np.random.default_rng(seed)
+    for y in years:
+        df_sleep, df_eat = make_sleep_sessions_and_meals(y, seed=seed)
+        df_sleep["value"] = "Core"
+        df_eat["value"] = "Meal"
+        ts_now = df_eat.ts_end.max() + pd.Timedelta(hours=1)
+
+        for _ in range(n_checks):
+            ret = pipeline.run_pipeline(
+                df_sleep.iloc[: rng.integers(len(df_sleep) // 2, len(df_sleep))],
+                df_eat.iloc[: rng.integers(len(df_eat) // 2, len(df_eat))],
+                ts_now=ts_now,
+            )
+            df_sleep_new, df_eat_new = df_sleep.copy(), df_eat.copy()
+            for df in [df_sleep_new, df_eat_new]:
+                idx = rng.choice(df.index[-60:], size=5, replace=False)
+                df.loc[idx[:3], "ts_end"] += pd.Timedelta(minutes=20)
+                df.drop(index=idx[3:], inplace=True)
+            _assert_results_equal(
+                pipeline.update_pipeline(ret, df_sleep_new, df_eat_new, ts_now=ts_now),
+                pipeline.run_pipeline(df_sleep_new, df_eat_new, ts_now=ts_now),
+            )
+
+        ret = pipeline.run_pipeline(df_sleep.iloc[:-1], df_eat.iloc[:-3], ts_now=ts_now)
+        t_full = _timeit(pipeline.run_pipeline, df_sleep, df_eat, ts_now=ts_now)
+        t_update = _timeit(
+            pipeline.update_pipeline, ret, df_sleep, df_eat, ts_now=ts_now
+        )
+        # the refresher moving on a minute (same frames, a deep fast is ongoing)
+        ts_fasting = ts_now + pd.Timedelta(hours=13)
+        ret = pipeline.run_pipeline(df_sleep, df_eat, ts_now=ts_fasting)
+        ts_next = ts_fasting + pd.Timedelta(minutes=1)
+        _assert_results_equal(
+            pipeline.update_pipeline(
+                ret, ret["df_sleep"], ret["df_eat"], ts_now=ts_next
+            ),
+            pipeline.run_pipeline(df_sleep, df_eat, ts_now=ts_next),
+        )
+        t_advance = _timeit(
+            pipeline.update_pipeline,
+            ret,
+            ret["df_sleep"],
+            ret["df_eat"],
+            ts_now=ts_next,
+        )
+        print(
+            f"  years={y:>3d}  full {t_full * 1000:10.1f} ms  "
+            f"update {t_update * 1000:8.1f} ms ({t_full / t_update:5.1f}x)  "
+            f"advance {t_advance * 1000:8.1f} ms ({t_full / t_advance:5.1f}x)"
+        )
+
+
+# The stages of `app.load_data`, each computing new frames from the ones
+# computed before (same arguments as the app)
+LOAD_DATA_STAGES = [
+    (
+        "process_eat_data",
+        lambda d: {"df_eat": h._process_eat_data(d["df_eat_raw"])},
+    ),
+    (
+        "identify_sessions (sleep)",
+        lambda d: {
+            "df_sleep_sessions": h.identify_sessions(
+                d["df_sleep"], **pipeline.SLEEP_SESSION_KWARGS
+            )
+        },
+    ),
+    (
+        "identify_sessions (eat)",
+        lambda d: {
+            "df_eat_sessions": h.identify_sessions(
+                d["df_eat"],
+                min_gap_between_sessions_in_minutes=60 * 12,
+                min_duration_of_session_in_minutes=0,
+            )
+        },
+    ),
+    (
+        "evaluate_deep_fast_sessions",
+        lambda d: {
+            "df_deep_fast_sessions": h.evaluate_deep_fast_sessions(
+                d["df_eat_sessions"], 12, ts_now=d["ts_now"]
+            )
+        },
+    ),
+    (
+        "evaluate_delta_to_first_and_last_meal",
+        lambda d: {
+            "df_first_and_last_meal": h.evaluate_delta_to_first_and_last_meal(
+                d["df_sleep_sessions"], d["df_eat"]
+            )
+        },
+    ),
+    (
+        "process_for_visualization",
+        lambda d: {
+            f"{k}_viz": h.process_for_visualization(d[k], d["tz"])
+            for k in [
+                "df_sleep_sessions",
+                "df_eat",
+                "df_eat_sessions",
+                "df_deep_fast_sessions",
+            ]
+        },
+    ),
+    (
+        "daily_cube",
+        lambda d: {
+            "daily": h.daily_cube(
+                d["df_deep_fast_sessions"],
+                d["df_first_and_last_meal"],
+                d["df_sleep_sessions"],
+                d["tz"],
+            )
+        },
+    ),
+    (
+        "calculate_score",
+        lambda d: dict(
+            zip(
+                ["df_score", "debug_info"],
+                h.calculate_score(d["daily"], **d["targets"]),
+            )
+        ),
+    ),
+    (
+        "visualize_data",
+        lambda d: {
+            "fig": vis.visualize_data(
+                **{k: v for k, v in d.items() if k.endswith("_viz")},
+                daily=d["daily"],
+                df_score=d["df_score"],
+                params=d["targets"],
+            )
+        },
+    ),
+]
+
+
+def bench_load_data(years=(1, 5, 20), n_users=1, tz="Europe/Berlin", seed=0):
+    """Time and measure the peak memory of every stage of `app.load_data`.
+
+    The input is realistic synthetic data (see `make_health_data`). Memory is
+    the peak of the allocations (traced with tracemalloc) on top of the
+    frames that existed before the stage, measured in a separate untimed run.
+    """
+    print("load_data")
+    targets = dict(
+        target_delta_fasting=4,
+        target_delta_first_meal=1,
+        target_delta_last_meal=3,
+        target_delta_sleep=7,
+    )
+    for y in years:
+        df_sleep, df_eat = make_health_data(int(365 * y), n_users=n_users, seed=seed)
+        for user_id, df_sleep_user in df_sleep.groupby("user_id"):
+            data = {
+                "df_sleep": df_sleep_user[df_sleep_user.value != "Awake"]
+                .drop(columns="user_id")
+                .reset_index(drop=True),
+                "df_eat_raw": df_eat[df_eat.user_id == user_id]
+                .drop(columns="user_id")
+                .reset_index(drop=True),
+                "tz": tz,
+                "ts_now": df_eat.ts_end.max() + pd.Timedelta(hours=1),
+                "targets": targets,
+            }
+            print(
+                f"  years={y:>3d}  user={user_id}  sleep stages {len(data['df_sleep']):,d}"
+                f"  meals {len(data['df_eat_raw']):,d}"
+            )
+            t_total, peak_total = 0, 0
+            for name, stage in LOAD_DATA_STAGES:
+                t = _timeit(stage, data)
+                tracemalloc.start()
+                out = stage(data)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                data.update(out)
+                t_total += t
+                peak_total = max(peak_total, peak)
+                print(f"    {name:<40s}{t * 1000:10.1f} ms  {peak / 2**20:8.1f} MiB")
+            print(
+                f"    {'total':<40s}{t_total * 1000:10.1f} ms  "
+                f"{peak_total / 2**20:8.1f} MiB"
+            )
+
+
+def bench_visualize_data(years=(1, 5, 20), window_days=90, margin_days=60, seed=0):
+    """Size and build/serialization time of the figure, whole history vs a window.
+
+    The window mode plots the last `window_days` plus a margin on both sides
+    (like the app does), with WebGL lines.
+    """
+    import plotly.io as pio
+
+    print("visualize_data")
+    for y in years:
+        df_sleep, df_eat = make_sleep_sessions_and_meals(y, seed=seed)
+        df_sleep["value"] = "Core"
+        df_eat["value"] = "Meal"
+        ts_now = df_eat.ts_end.max() + pd.Timedelta(hours=1)
+        ret = pipeline.run_pipeline(df_sleep, df_eat, ts_now=ts_now)
+        x_to = ts_now.tz_localize(None).ceil("D")
+        x_range = [x_to - timedelta(days=window_days), x_to]
+        margin = timedelta(days=margin_days)
+        window = [x_range[0] - margin, x_range[1] + margin]
+
+        for mode, kwargs in [
+            ("full", {}),
+            ("window", dict(window=window, webgl=True)),
+        ]:
+
+            def render():
+                fig = vis.visualize_data(**ret, x_range=x_range, **kwargs)
+                return pio.to_json(fig, validate=False)
+
+            t = _timeit(render)
+            print(
+                f"  years={y:>3d}  {mode:<8s}{t * 1000:10.1f} ms  "
+                f"{len(render()) / 2**20:8.2f} MiB json"
+            )
+
+
+def bench_sweep_scores(years=(1, 20), n_targets=(2, 5), n_workers=(1, None), seed=0):
+    """Time `helper.sweep_scores` for grids of n targets per metric, 3 windows
+    and 3 gammas.
+
+    Some combinations are checked against `helper.calculate_score` first.
+    """
+    print("sweep_scores")
+    rng = np.random.default_rng(seed)
+    for y in years:
+        df_sleep, df_eat = make_sleep_sessions_and_meals(y, seed=seed)
+        df_sleep["value"] = "Core"
+        df_eat["value"] = "Meal"
+        ts_now = df_eat.ts_end.max() + pd.Timedelta(hours=1)
+        daily = pipeline.run_pipeline(df_sleep, df_eat, ts_now=ts_now)["daily"]
+
+        for n in n_targets:
+            grid = dict(
+                target_delta_fasting=[(2, 2 + d) for d in np.linspace(0.5, 3, n)],
+                target_delta_first_meal=list(np.linspace(0.5, 2, n)),
+                target_delta_last_meal=[(1, 1 + d) for d in np.linspace(0.5, 3, n)],
+                target_delta_sleep=[(6, 6 + d) for d in np.linspace(0.5, 2, n)],
+                rolling_window_days=[7, 14, 28],
+                gamma=[0.8, 0.9, 1],
+            )
+            df_sweep, scores = h.sweep_scores(daily, **grid)
+            for i in rng.choice(len(df_sweep), size=5, replace=False):
+                params = df_sweep.iloc[i][list(grid)].to_dict()
+                df_score, _ = h.calculate_score(daily, **params)
+                np.testing.assert_allclose(
+                    scores[i], df_score.score, rtol=1e-6, atol=1e-6
+                )
+                np.testing.assert_allclose(
+                    df_sweep.score.iloc[i], vis.get_current_scores(df_score)["score"]
+                )
+
+            for w in n_workers:
+                t = _timeit(h.sweep_scores, daily, **grid, n_workers=w, repeat=1)
+                print(
+                    f"  years={y:>3d}  combinations={len(df_sweep):>8,d}  "
+                    f"workers={w or os.cpu_count():>3d}  {t:8.2f} s  "
+                    f"{len(df_sweep) / t:10,.0f} combinations/s"
+                )
+
+
+def bench_interval_index(sizes=(1_000, 100_000, 1_000_000), n_queries=100_000, seed=0):
+    """Time point-in-time queries of `IntervalIndex` against a mask scan, and
+    appends against a rebuild.
+
+    The intervals overlap, the results are checked against the scan first.
+    """
+    print("interval_index")
+    rng = np.random.default_rng(seed)
+    for n in sizes:
+        df = make_intervals(n, seed=seed)
+        df["ts_end"] += pd.to_timedelta(rng.integers(0, 30, size=n), unit="min")
+        ts = df.ts_start.min() + (df.ts_end.max() - df.ts_start.min()) * rng.random(
+            n_queries
+        )
+        index = IntervalIndex.from_frames(x=df)
+
+        def scan(t):
+            mask = (df.ts_start <= t) & (t < df.ts_end)
+            return mask.any()
+
+        pos = index.find("x", ts)
+        for i in rng.choice(n_queries, size=100, replace=False):
+            assert (pos[i] >= 0) == scan(ts[i])
+            assert pos[i] < 0 or df.ts_start[pos[i]] <= ts[i] < df.ts_end[pos[i]]
+            assert index.find("x", ts[i]) == pos[i]
+
+        t_scan = _timeit(scan, ts[0])
+        t_scalar = _timeit(index.find, "x", ts[0])
+        t_bulk = _timeit(index.find, "x", ts)
+        t_build = _timeit(IntervalIndex.from_frames, x=df)
+
+        # re-appending the last intervals leaves the index as it is
+        tail = df.iloc[-10:]
+        t_append = _timeit(index.append, "x", tail.ts_start, tail.ts_end, pos=n - 10)
+        assert index == IntervalIndex.from_frames(x=df)
+        t_copy = _timeit(index.copy)
+        print(
+            f"  n={n:>10,d}  scan {t_scan * 1e6:9.1f} us  "
+            f"find {t_scalar * 1e6:6.1f} us  "
+            f"bulk {t_bulk / n_queries * 1e9:6.1f} ns/query  "
+            f"build {t_build * 1e3:7.2f} ms  append {t_append * 1e6:6.1f} us  "
+            f"copy {t_copy * 1e3:6.2f} ms"
+        )
+
+
+def bench_header(years=(1, 5, 20), tail_days=21, n_checks=20, seed=0):
+    """Time the current scores from a tail of the history (the header of the
+    app) against the full pipeline.
+
+    The tail is sliced like `helper.load_tail_from_supabase` does. For random
+    ends of the history, covered tails are checked against the full history.
+    """
+    print("header")
+    rng = np.random.default_rng(seed)
+    params = dict(tz="Europe/Berlin", rolling_window_days=14, gamma=0.9)
+
+    def tail(df_sleep, df_eat, days):
+        ts_from = min(df_sleep.ts_end.max(), df_eat.ts_end.max()) - timedelta(days=days)
+        return df_sleep[df_sleep.ts_end >= ts_from], df_eat[df_eat.ts_end >= ts_from]
+
+    for y in years:
+        df_sleep, df_eat = make_sleep_sessions_and_meals(y, seed=seed)
+        df_sleep["value"] = "Core"
+        df_eat["value"] = "Meal"
+        ts_now = df_eat.ts_end.max() + pd.Timedelta(hours=1)
+
+        n_covered = 0
+        for _ in range(n_checks):
+            ts_cut = df_sleep.ts_end.quantile(rng.uniform(0.2, 1))
+            sleep, eat = (
+                df_sleep[df_sleep.ts_start < ts_cut],
+                df_eat[
+                    df_eat.ts_start < ts_cut + pd.Timedelta(hours=rng.uniform(-30, 30))
+                ],
+            )
+            ret = pipeline.run_pipeline(
+                *tail(sleep, eat, tail_days), ts_now=ts_now, scores_only=True, **params
+            )
+            if not pipeline.covers_current_scores(ret):
+                continue
+            n_covered += 1
+            ret_full = pipeline.run_pipeline(
+                sleep, eat, ts_now=ts_now, scores_only=True, **params
+            )
+            scores = vis.get_current_scores(ret["df_score"])
+            for k, v in vis.get_current_scores(ret_full["df_score"]).items():
+                np.testing.assert_allclose(scores[k], v, rtol=1e-12, err_msg=k)
+
+        df_sleep_tail, df_eat_tail = tail(df_sleep, df_eat, tail_days)
+
+        def header(df_sleep, df_eat):
+            ret = pipeline.run_pipeline(
+                df_sleep, df_eat, ts_now=ts_now, scores_only=True, **params
+            )
+            return vis.get_current_scores(ret["df_score"])
+
+        t_tail = _timeit(header, df_sleep_tail, df_eat_tail)
+        t_full = _timeit(header, df_sleep, df_eat, repeat=1)
+        print(
+            f"  years={y:>3d}  tail {t_tail * 1e3:7.1f} ms  full {t_full * 1e3:8.1f} ms"
+            f"  covered {n_covered}/{n_checks}"
+        )
+
+
+def bench_run_batch(n_users=(8, 32, 128), years=1, seed=0):
+    """Throughput of `batch.run_batch` in users per second.
+
+    The scores of the first users are checked against `pipeline.run_pipeline`.
+    """
+    print("run_batch")
+    for n in n_users:
+        df_sleep, df_eat = make_health_data(int(365 * years), n_users=n, seed=seed)
+        # as returned by the loaders
+        df_sleep = df_sleep[df_sleep.value != "Awake"]
+        min_end = df_eat.ts_start + pd.Timedelta(minutes=15)
+        df_eat = df_eat.assign(
+            ts_end=df_eat.ts_end.where(df_eat.ts_end >= min_end, min_end),
+            value=df_eat.description,
+        )
+        ts_now = df_eat.ts_end.max() + pd.Timedelta(hours=1)
+
+        df_score = batch.run_batch(df_sleep, df_eat, n_workers=1, ts_now=ts_now)
+        for user_id in range(2):
+            pd.testing.assert_frame_equal(
+                df_score[df_score.user_id == user_id]
+                .drop(columns="user_id")
+                .reset_index(drop=True),
+                pipeline.run_pipeline(
+                    df_sleep[df_sleep.user_id == user_id],
+                    df_eat[df_eat.user_id == user_id],
+                    ts_now=ts_now,
+                )["df_score"],
+            )
+
+        for n_workers in sorted({1, os.cpu_count()}):
+            t = _timeit(
+                batch.run_batch,
+                df_sleep,
+                df_eat,
+                n_workers=n_workers,
+                ts_now=ts_now,
+                repeat=1,
+            )
+            print(
+                f"  users={n:>5d}  years={years}  workers={n_workers:>3d}  "
+                f"{t:8.2f} s  {n / t:8.1f} users/s"
+            )
+
+
+class _FakeSource:
+    """Data source of a `Refresher`: the synthetic rows that start before `ts_to`.
+
+    Every fetch takes `delay_in_seconds` (like a slow database) and raises
+    while `fail` is set.
+    """
+
+    def __init__(self, df_sleep, df_eat, ts_to, delay_in_seconds=0.0):
+        self.df_sleep, self.df_eat = df_sleep, df_eat
+        self.ts_to = ts_to
+        self.delay_in_seconds = delay_in_seconds
+        self.fail = False
+        self.calls = []  # full_resync of every fetch
+
+    def data(self):
+        return (
+            self.df_sleep[self.df_sleep.ts_start < self.ts_to],
+            self.df_eat[self.df_eat.ts_start < self.ts_to],
+        )
+
+    def __call__(self, full_resync=False):
+        self.calls.append(full_resync)
+        time.sleep(self.delay_in_seconds)
+        if self.fail:
+            raise ConnectionError("fake source is down")
+        return self.data()
+
+
+def _wait_until(condition, timeout=60):
+    t0 = time.perf_counter()
+    while not condition():
+        assert time.perf_counter() - t0 < timeout, "timed out"
+        time.sleep(0.001)
+
+
+def check_refresher(years=1, delay_in_seconds=0.5, seed=0):
+    """Check `refresher.Refresher` against a fake data source.
+
+    Snapshots are compared with a full recompute. While a refresh is running,
+    readers get the previous snapshot at once. Prints the time a reader waits
+    for a snapshot against the time of a blocking fetch and update.
+    """
+    print("refresher")
+    df_sleep, df_eat = make_sleep_sessions_and_meals(years, seed=seed)
+    df_sleep["value"] = "Core"
+    df_eat["value"] = "Meal"
+    ts_now = df_eat.ts_end.max() + pd.Timedelta(hours=1)
+    source = _FakeSource(
+        df_sleep, df_eat, df_sleep.ts_start.quantile(0.5), delay_in_seconds
+    )
+    refresher = Refresher(source, interval_in_seconds=3600, ts_now=ts_now).start()
+    try:
+        # first snapshot
+        snapshot = refresher.snapshot(timeout=60)
+        ret_expected = pipeline.run_pipeline(*source.data(), ts_now=ts_now)
+        _assert_results_equal(snapshot.ret, ret_expected)
+
+        # new rows: readers keep the previous snapshot until the next is published
+        source.ts_to += pd.Timedelta(days=2)
+        t0 = time.perf_counter()
+        refresher.refresh()
+        assert refresher.is_refreshing()
+        t_read = _timeit(refresher.snapshot)
+        assert refresher.snapshot() is snapshot
+        _wait_until(lambda: refresher.snapshot() is not snapshot)
+        t_refresh = time.perf_counter() - t0
+        snapshot_new = refresher.snapshot()
+        ret_expected = pipeline.run_pipeline(*source.data(), ts_now=ts_now)
+        _assert_results_equal(snapshot_new.ret, ret_expected)
+        assert refresher.stats["updates"] == 1
+        assert snapshot_new.ts_fetched > snapshot.ts_fetched
+        snapshot = snapshot_new
+
+        # unchanged rows: same frames, younger snapshot
+        refresher.refresh()
+        _wait_until(lambda: refresher.snapshot() is not snapshot)
+        _assert_results_equal(refresher.snapshot().ret, ret_expected)
+        assert refresher.snapshot().version == snapshot.version
+        assert refresher.stats["updates"] == 1
+        snapshot = refresher.snapshot()
+
+        # failing source: the snapshot is kept until a refresh succeeds again
+        source.fail = True
+        refresher.refresh()
+        _wait_until(lambda: refresher.stats["errors"] == 1)
+        assert refresher.snapshot() is snapshot
+        assert isinstance(refresher.error, ConnectionError)
+        source.fail = False
+        refresher.refresh(full_resync=True)
+        _wait_until(lambda: refresher.snapshot() is not snapshot)
+        assert refresher.error is None and source.calls[-1] is True
+    finally:
+        refresher.stop()
+
+    # the schedule
+    source.delay_in_seconds = 0
+    refresher = Refresher(source, interval_in_seconds=0.05, ts_now=ts_now).start()
+    try:
+        _wait_until(lambda: refresher.stats["refreshes"] >= 3)
+    finally:
+        refresher.stop()
+
+    # the current time: the ongoing deep fast moves on between two fetches
+    source.ts_to = df_eat.ts_end.max()
+    refresher = Refresher(
+        source, interval_in_seconds=3600, advance_interval_in_seconds=0.05
+    ).start()
+    try:
+        snapshot = refresher.snapshot(timeout=60)
+        n_calls = len(source.calls)
+        _wait_until(lambda: refresher.snapshot().ts_now > snapshot.ts_now)
+        snapshot_new = refresher.snapshot()
+        assert len(source.calls) == n_calls
+        assert snapshot_new.version != snapshot.version
+        assert snapshot_new.ts_fetched == snapshot.ts_fetched
+        ret_expected = pipeline.run_pipeline(*source.data(), ts_now=snapshot_new.ts_now)
+        _assert_results_equal(snapshot_new.ret, ret_expected)
+        assert (
+            snapshot_new.ret["df_deep_fast_sessions"].ts_end.iloc[-1]
+            == snapshot_new.ts_now
+        )
+    finally:
+        refresher.stop()
+
+    print(
+        f"  years={years:>3d}  read during a refresh {t_read * 1e6:6.1f} us  "
+        f"refresh (fetch and update) {t_refresh * 1e3:7.1f} ms"
+    )
+
+
+class _FakeClient:
+    """Supabase client serving the rows of `df`, for `helper.fetch_table`.
+
+    Returns at most `max_rows` rows per request (like the server's max rows
+    setting) and records the filters of every query in `filters`.
+    """
+
+    def __init__(self, df, max_rows=1000):
+        self.df = df
+        self.max_rows = max_rows
+        self.filters = []
+
+    def table(self, table):
+        return _FakeQuery(self)
+
+
+class _FakeQuery:
+    _OPERATORS = {"eq": "__eq__", "neq": "__ne__", "gte": "__ge__", "lte": "__le__"}
+
+    def __init__(self, client):
+        self.client = client
+        self.columns = None
+        self.count = None
+        self.filters = []
+        self.order_by = []
+
+    def select(self, *columns, count=None):
+        self.columns = None if columns == ("*",) else list(columns)
+        self.count = count
+        return self
+
+    def __getattr__(self, op):
+        if op not in self._OPERATORS:
+            raise AttributeError(op)
+
+        def _filter(column, value):
+            self.filters.append((op, column, value))
+            return self
+
+        return _filter
+
+    def order(self, column):
+        self.order_by.append(column)
+        return self
+
+    def range(self, start, end):
+        self.start, self.end = start, min(end, start + self.client.max_rows - 1)
+        return self
+
+    def execute(self):
+        df = self.client.df
+        for op, column, value in self.filters:
+            if column.startswith("ts_"):
+                value = pd.Timestamp(value)
+            df = df[getattr(df[column], self._OPERATORS[op])(value)]
+        if self.order_by:
+            df = df.sort_values(self.order_by, kind="stable")
+        if self.count is not None:
+            self.client.filters.append(self.filters)
+        page = df.iloc[self.start : self.end + 1][self.columns or df.columns]
+        data = [
+            {c: v.isoformat() if c.startswith("ts_") else v for c, v in row.items()}
+            for row in page.to_dict("records")
+        ]
+        return SimpleNamespace(
+            data=data, count=len(df) if self.count is not None else None
+        )
+
+
+def check_sync_table(n=5_000, seed=0):
+    """Check `helper.sync_table` against a fake Supabase client.
+
+    Covers the filter on the high-water mark, rows that arrive late within
+    and before the lookback, a row edited within the lookback, duplicates in
+    the overlap of two fetches and a full resync. The client returns fewer
+    rows per request than a page.
+    """
+    import tempfile
+
+    print("sync_table")
+    df = make_intervals(n, seed=seed).rename(columns={"value": "description"})
+    df.insert(0, "id", np.arange(n))
+    key = h.EAT_KEY
+    lookback = timedelta(hours=1)
+
+    def expected(df_server):
+        return df_server.sort_values(["ts_start", "id"])
+
+    def sync(client, cache_dir, full_resync=False):
+        df_synced = h.sync_table(
+            client,
+            h.EAT_TABLE,
+            key,
+            cache_dir,
+            columns=h.EAT_COLUMNS,
+            lookback=lookback,
+            full_resync=full_resync,
+        )
+        assert not df_synced.duplicated(subset=key).any()
+        return df_synced.reset_index(drop=True)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # first sync: no local copy, everything is fetched
+        client = _FakeClient(df.iloc[: n // 2], max_rows=300)
+        df_synced = sync(client, cache_dir)
+        pd.testing.assert_frame_equal(
+            df_synced, expected(client.df).reset_index(drop=True)
+        )
+        assert client.filters == [[]]
+
+        # new rows, one late row within the lookback and one before it, and
+        # the last meal of the local copy edited
+        ts_max = df_synced.ts_start.max()
+        late = df.iloc[[n - 2, n - 1]].assign(
+            ts_start=[ts_max - lookback / 2, ts_max - 2 * lookback]
+        )
+        late["ts_end"] = late.ts_start + pd.Timedelta(minutes=1)
+        client.df = pd.concat([df.iloc[: 3 * n // 4], late])
+        i_edited = client.df.index[client.df.ts_start == ts_max][0]
+        client.df.loc[i_edited, ["ts_end", "description"]] = [
+            client.df.ts_end[i_edited] + pd.Timedelta(minutes=5),
+            "edited",
+        ]
+        df_synced = sync(client, cache_dir)
+        assert client.filters[-1] == [
+            ("gte", "ts_start", (ts_max - lookback).isoformat())
+        ]
+        pd.testing.assert_frame_equal(
+            df_synced, expected(client.df.iloc[:-1]).reset_index(drop=True)
+        )
+
+        # nothing new: the overlap with the local copy is not duplicated
+        df_again = sync(client, cache_dir)
+        pd.testing.assert_frame_equal(df_again, df_synced)
+
+        # full resync: the local copy is ignored, the row before the lookback
+        # is fetched as well
+        df_synced = sync(client, cache_dir, full_resync=True)
+        assert client.filters[-1] == []
+        pd.testing.assert_frame_equal(
+            df_synced, expected(client.df).reset_index(drop=True)
+        )
+    print(f"  rows={n:,d}  ok")
+
+
+def _write_export(fp, n_records, n_trailing, seed=0):
+    """Write a synthetic export.xml: `n_records` sleep and step records, then
+    `n_trailing` workouts and activity summaries (like at the end of a real
+    export). Returns the sleep records as `(ts_start, ts_end, value)`."""
+    rng = np.random.default_rng(seed)
+    values = list(he.SLEEP_VALUES)
+    ts = pd.Timestamp("2024-01-01 22:00", tz="Europe/Berlin")
+    expected = []
+    with open(fp, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<HealthData locale="en_US">\n')
+        for i in range(n_records):
+            ts_start = ts + pd.Timedelta(minutes=5 * i)
+            ts_end = ts_start + pd.Timedelta(minutes=5)
+            start, end = ts_start.strftime(he.DATE_FORMAT), ts_end.strftime(
+                he.DATE_FORMAT
+            )
+            if i % 4 == 0:
+                f.write(
+                    f' <Record type="HKQuantityTypeIdentifierStepCount" '
+                    f'startDate="{start}" endDate="{end}" value="12"/>\n'
+                )
+                continue
+            value = values[rng.integers(len(values))]
+            f.write(
+                f' <Record type="{he.SLEEP_TYPE}" startDate="{start}" '
+                f'endDate="{end}" value="{value}">\n'
+                f'  <MetadataEntry key="HKTimeZone" value="Europe/Berlin"/>\n'
+                " </Record>\n"
+            )
+            expected.append((start, end, value))
+        for i in range(n_trailing):
+            f.write(
+                ' <Workout workoutActivityType="HKWorkoutActivityTypeRunning" '
+                'duration="30" startDate="2024-01-01 08:00:00 +0100">\n'
+                '  <MetadataEntry key="HKIndoorWorkout" value="0"/>\n'
+                '  <WorkoutEvent type="HKWorkoutEventTypeSegment" duration="10"/>\n'
+                " </Workout>\n"
+                ' <ActivitySummary dateComponents="2024-01-01" '
+                'activeEnergyBurned="500"/>\n'
+            )
+        f.write("</HealthData>\n")
+    return expected
+
+
+def check_health_export(n_records=20_000, n_trailing=(10_000, 100_000), seed=0):
+    """Check `health_export.iter_category_records` against `ET.parse`.
+
+    The records are followed by many workouts and activity summaries. Peak
+    traced memory must not grow with their number.
+    """
+    import tempfile
+    import xml.etree.ElementTree as ET
+
+    print("health_export")
+    peaks = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fp = os.path.join(tmp_dir, "export.xml")
+        for n in n_trailing:
+            _write_export(fp, n_records, n, seed=seed)
+
+            tracemalloc.start()
+            df = he.concat_chunks(he.iter_category_records(fp, chunk_size=1_000))
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+            records = [
+                r.attrib
+                for r in ET.parse(fp).getroot().iter("Record")
+                if r.attrib["type"] == he.SLEEP_TYPE
+            ]
+            assert len(df) == len(records)
+            for c, attr in [("ts_start", "startDate"), ("ts_end", "endDate")]:
+                expected = pd.to_datetime(
+                    [r[attr] for r in records], format=he.DATE_FORMAT, utc=True
+                )
+                assert (df[c].values == expected.values).all()
+            assert list(df.value) == [r["value"] for r in records]
+            print(
+                f"  records={n_records:,d}  trailing={n:>9,d}  "
+                f"peak {peaks[-1] / 2**20:6.1f} MiB"
+            )
+    assert peaks[-1] < 1.5 * peaks[0], "memory grows with the trailing elements"
+
+
+def check_sql_sessions(backend="postgres"):
+    """Check the sessions computed by the database against `identify_sessions`.
+
+    Uses the data in the database of `backend`, with the default parameters in
+    the session_params table (see supabase_setup.sql).
+    """
+    key = ["ts_start", "ts_end", "value"]
+    df_sleep = h.load_sleep_data_from_supabase(backend=backend).sort_values(key)
+    df_eat = h.load_eat_data_from_supabase(backend=backend).sort_values(key)
+    for df_expected, df in [
+        (
+            h.identify_sessions(df_sleep, **pipeline.SLEEP_SESSION_KWARGS),
+            h.load_sleep_sessions_from_supabase(backend=backend),
+        ),
+        (
+            h.identify_sessions(df_eat, min_gap_between_sessions_in_minutes=720),
+            h.load_eat_sessions_from_supabase(backend=backend),
+        ),
+    ]:
+        pd.testing.assert_frame_equal(df, df_expected)
+    print(f"sql sessions ok ({len(df_sleep):,d} sleep stages, {len(df_eat):,d} meals)")
+
+
+def _make_sleep_payload(n, seed=0):
+    """A Health Auto Export payload with `n` sleep analysis datapoints."""
+    df_sleep, _ = make_health_data(n // 20 + 1, seed=seed)
+    df_sleep = df_sleep.drop_duplicates(h.SLEEP_KEY).iloc[:n]
+    fmt = "%Y-%m-%d %H:%M:%S %z"
+    datapoints = [
+        {"startDate": ts_start, "endDate": ts_end, "value": value, "source": "Watch"}
+        for ts_start, ts_end, value in zip(
+            df_sleep.ts_start.dt.strftime(fmt),
+            df_sleep.ts_end.dt.strftime(fmt),
+            df_sleep.value,
+        )
+    ]
+    metrics = [
+        {"name": "step_count", "units": "count", "data": [{"qty": 1}]},
+        {"name": "sleep_analysis", "units": "hr", "data": datapoints},
+    ]
+    return json.dumps({"metrics": metrics}), len(df_sleep)
+
+
+def bench_ingest(
+    sizes=(10_000, 100_000, 1_000_000), loop_max=100_000, dbname="bench_ingest"
+):
+    """Time the ingest trigger for a single payload of n sleep datapoints.
+
+    Needs a local Postgres, connected to like the "postgres" backend (see
+    `helper._postgres_settings` for the environment variables). The database
+    `dbname` is dropped and recreated from supabase_setup.sql. The former
+    row by row trigger is only timed up to `loop_max` datapoints.
+    """
+    import psycopg2
+
+    settings = h._postgres_settings()
+
+    def connect(dbname):
+        conn = psycopg2.connect(**{**settings, "dbname": dbname})
+        conn.autocommit = True
+        return conn
+
+    conn = connect(settings["dbname"])
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS {dbname}")
+        cursor.execute(f"CREATE DATABASE {dbname}")
+    conn.close()
+    with open(os.path.join(os.path.dirname(__file__), "supabase_setup.sql")) as f:
+        setup_sql = f.read()
+
+    print("ingest")
+    conn = connect(dbname)
+    cursor = conn.cursor()
+    cursor.execute(setup_sql)
+    for n in sizes:
+        payload, n_rows = _make_sleep_payload(n)
+        t = {}
+        for name, sql in [
+            ("loop", _TRANSFORM_SLEEP_ANALYSIS_LOOP_SQL),
+            ("set-based", setup_sql),
+        ]:
+            if name == "loop" and n > loop_max:
+                continue
+            cursor.execute(sql)
+            cursor.execute("TRUNCATE apple_health_raw, apple_health_sleep_analysis")
+            t0 = time.perf_counter()
+            cursor.execute("INSERT INTO apple_health_raw (data) VALUES (%s)", [payload])
+            t[name] = time.perf_counter() - t0
+            cursor.execute("SELECT count(*) FROM apple_health_sleep_analysis")
+            assert cursor.fetchone()[0] == n_rows
+
+        # reprocess the raw payload with the backfill function
+        cursor.execute("TRUNCATE apple_health_sleep_analysis")
+        t0 = time.perf_counter()
+        cursor.execute("SELECT * FROM backfill_sleep_analysis(0, 100)")
+        assert cursor.fetchone()[1] == n_rows
+        t["backfill"] = time.perf_counter() - t0
+
+        loop = f"loop {t['loop']:8.2f} s  " if "loop" in t else " " * 17
+        speedup = f"speedup {t['loop'] / t['set-based']:6.1f}x" if "loop" in t else ""
+        print(
+            f"  n={n:>10,d}  {loop}set-based {t['set-based']:8.2f} s  "
+            f"{n / t['set-based'] / 1e3:8.1f} k rows/s  "
+            f"backfill {t['backfill']:8.2f} s  {speedup}"
+        )
+    conn.close()
+
+
+def bench_ingest_server(
+    n_clients=(1, 8, 32),
+    n_requests=200,
+    rows_per_request=100,
+    backend=None,
+    chunk_bytes=2**14,
+    max_delay_in_seconds=0.01,
+):
+    """Load test the ingest server with concurrent clients on keep-alive connections.
+
+    Every client posts `n_requests` payloads of `rows_per_request` sleep
+    datapoints, sent in chunks of `chunk_bytes` (like a slow upload). Reports
+    the requests per second, the latency percentiles and the rows written per
+    second (until all batches are flushed). Responses wait for the write of
+    their batch, so the latency includes up to `max_delay_in_seconds`. Rows are written to interval stores
+    in a temporary directory, or with `backend="postgres"` to the database of
+    the "postgres" backend (see `bench_ingest` for the environment variables).
+    """
+    import asyncio
+    import tempfile
+    import ingest_server
+
+    def make_payloads(n_payloads, seed):
+        payload, _ = _make_sleep_payload(n_payloads * rows_per_request, seed=seed)
+        datapoints = json.loads(payload)["metrics"][1]["data"]
+        return [
+            json.dumps(
+                {
+                    "data": {
+                        "metrics": [
+                            {
+                                "name": "sleep_analysis",
+                                "units": "hr",
+                                "data": datapoints[i : i + rows_per_request],
+                            }
+                        ]
+                    }
+                }
+            ).encode()
+            for i in range(0, len(datapoints), rows_per_request)
+        ]
+
+    async def client(port, payloads, latencies):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for body in payloads:
+            t0 = time.perf_counter()
+            writer.write(
+                f"POST / HTTP/1.1\r\nHost: localhost\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode()
+            )
+            for i in range(0, len(body), chunk_bytes):
+                writer.write(body[i : i + chunk_bytes])
+                await writer.drain()
+            head = await reader.readuntil(b"\r\n\r\n")
+            assert head.startswith(b"HTTP/1.1 200"), head
+            length = int(head.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - t0)
+        writer.close()
+
+    async def run(sink, n, payloads):
+        server = ingest_server.IngestServer(
+            sink, max_delay_in_seconds=max_delay_in_seconds
+        )
+        port = await server.start(port=0)
+        latencies = []
+        per_client = [payloads[i::n] for i in range(n)]
+        t0 = time.perf_counter()
+        await asyncio.gather(*(client(port, p, latencies) for p in per_client))
+        t_requests = time.perf_counter() - t0
+        await server.stop()
+        t_written = time.perf_counter() - t0
+        n_rows = sum(b.stats["rows_written"] for b in server.batchers.values())
+        return np.array(latencies), t_requests, t_written, n_rows
+
+    print("ingest server")
+    for seed, n in enumerate(n_clients):
+        payloads = make_payloads(n * n_requests, seed)
+        with tempfile.TemporaryDirectory() as store_dir:
+            if backend is None:
+                sink = ingest_server.StoreSink(store_dir)
+            else:
+                sink = ingest_server.PostgresSink(h.get_client(backend).pool)
+            latencies, t_requests, t_written, n_rows = asyncio.run(
+                run(sink, n, payloads)
+            )
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1e3
+        print(
+            f"  clients={n:>4d}  {len(payloads) / t_requests:8.0f} req/s  "
+            f"p50 {p50:7.2f} ms  p99 {p99:7.2f} ms  "
+            f"{n_rows / t_written / 1e3:8.1f} k rows/s written"
+        )
+
+
+if __name__ == "__main__":
+    bench_identify_sessions()
+    bench_evaluate_delta_to_first_and_last_meal()
+    bench_process_for_visualization()
+    bench_update_pipeline()
+    bench_load_data()
+    bench_visualize_data()
+    bench_run_batch()
+    bench_sweep_scores()
+    bench_interval_index()
+    bench_header()
+    check_refresher()
+    check_sync_table()
+    check_health_export()
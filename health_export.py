@@ -0,0 +1,164 @@
+import zipfile
+import xml.etree.ElementTree as ET
+import pandas as pd
+from datetime import timedelta
+from pandas.api.types import union_categoricals
+
+SLEEP_TYPE = "HKCategoryTypeIdentifierSleepAnalysis"
+
+# Sleep stages as they are named by Health Auto Export (and thus in Supabase)
+SLEEP_VALUES = {
+    "HKCategoryValueSleepAnalysisInBed": "InBed",
+    "HKCategoryValueSleepAnalysisAsleep": "Asleep",
+    "HKCategoryValueSleepAnalysisAsleepUnspecified": "Asleep",
+    "HKCategoryValueSleepAnalysisAsleepCore": "Core",
+    "HKCategoryValueSleepAnalysisAsleepREM": "REM",
+    "HKCategoryValueSleepAnalysisAsleepDeep": "Deep",
+    "HKCategoryValueSleepAnalysisAwake": "Awake",
+}
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"  # e.g. "2024-10-21 08:00:40 +0200"
+
+
+# Reading
+# -------
+
+
+def open_export(fp):
+    """Open the `export.xml` of an Apple Health export.
+
+    `fp` can be the zip file as exported by the Health app (the XML is read
+    straight from the archive without extracting it) or the extracted XML.
+    """
+    if not zipfile.is_zipfile(fp):
+        return open(fp, "rb")
+    archive = zipfile.ZipFile(fp)
+    names = [n for n in archive.namelist() if n.split("/")[-1] == "export.xml"]
+    if len(names) == 0:
+        archive.close()
+        raise FileNotFoundError(f"No export.xml found in {fp}")
+    return archive.open(names[0])
+
+
+def iter_category_records(fp, types=(SLEEP_TYPE,), ts_from=None, chunk_size=100_000):
+    """Stream the category records of an Apple Health export in chunks.
+
+    The XML is parsed incrementally and every record is dropped from the tree
+    once it has been read, so memory only depends on `chunk_size` and not on
+    the size of the export.
+
+    Args:
+        fp (str): Path to the export zip or to the extracted `export.xml`.
+        types (tuple, optional): `HKCategoryTypeIdentifier*` types to keep.
+            Defaults to sleep analysis only.
+        ts_from (pd.Timestamp, optional): Only keep records starting at or
+            after this time (naive timestamps are taken as UTC). Defaults to None.
+        chunk_size (int, optional): Max number of records per chunk.
+            Defaults to 100_000.
+
+    Yields:
+        pd.DataFrame: Columns type and value (categorical), ts_start and
+            ts_end (UTC).
+    """
+    types = set(types)
+    if ts_from is not None:
+        ts_from = pd.Timestamp(ts_from)
+        if ts_from.tz is None:
+            ts_from = ts_from.tz_localize("UTC")
+        # cheap pre-filter on the date string, local dates differ from UTC by
+        # less than a day (the exact filter is applied after parsing)
+        date_from = (ts_from - timedelta(days=1)).strftime("%Y-%m-%d")
+
+    cols = {"type": [], "ts_start": [], "ts_end": [], "value": []}
+    with open_export(fp) as f:
+        # the attributes are complete at the start tag, so the end events (and
+        # the children of the records, e.g. metadata entries) aren't needed
+        root = None
+        for _, elem in ET.iterparse(f, events=("start",)):
+            if root is None:
+                root = elem
+                continue
+
+            # detach everything that has been read so far from the tree, of
+            # any tag (workouts, activity summaries, ... come after the records)
+            root.clear()
+            if elem.tag != "Record":
+                continue
+
+            attrib = elem.attrib
+            if attrib.get("type") in types and (
+                ts_from is None or attrib["startDate"][:10] >= date_from
+            ):
+                cols["type"].append(attrib["type"])
+                cols["ts_start"].append(attrib["startDate"])
+                cols["ts_end"].append(attrib["endDate"])
+                cols["value"].append(attrib.get("value"))
+
+            if len(cols["type"]) >= chunk_size:
+                yield _to_chunk(cols, ts_from)
+                cols = {k: [] for k in cols}
+
+    if len(cols["type"]) > 0:
+        yield _to_chunk(cols, ts_from)
+
+
+def _to_chunk(cols, ts_from):
+    df = pd.DataFrame(
+        {
+            "type": pd.Categorical(cols["type"]),
+            "ts_start": pd.to_datetime(cols["ts_start"], format=DATE_FORMAT, utc=True),
+            "ts_end": pd.to_datetime(cols["ts_end"], format=DATE_FORMAT, utc=True),
+            "value": pd.Categorical(cols["value"]),
+        }
+    )
+    if ts_from is not None:
+        df = df[df.ts_start >= ts_from].reset_index(drop=True)
+    return df
+
+
+def concat_chunks(chunks):
+    """Concatenate chunks of `iter_category_records` keeping categorical columns."""
+    chunks = list(chunks)
+    if len(chunks) == 0:
+        return pd.DataFrame(
+            {
+                "type": pd.Categorical([]),
+                "ts_start": pd.DatetimeIndex([], tz="UTC"),
+                "ts_end": pd.DatetimeIndex([], tz="UTC"),
+                "value": pd.Categorical([]),
+            }
+        )
+    df = pd.concat(chunks, ignore_index=True)
+    for c in ["type", "value"]:
+        df[c] = union_categoricals([chunk[c] for chunk in chunks])
+    return df
+
+
+# Sleep data
+# ----------
+
+
+def load_sleep_data_from_export(
+    fp, ts_from=None, exclude_values=("Awake",), chunk_size=100_000
+):
+    """Load the sleep stages of an Apple Health export.
+
+    Returns the same columns as `helper.load_sleep_data_from_supabase`, so
+    the result can be used in place of the synced data.
+
+    Args:
+        fp (str): Path to the export zip or to the extracted `export.xml`.
+        ts_from (pd.Timestamp, optional): Only keep stages starting at or after
+            this time. Defaults to None.
+        exclude_values (tuple, optional): Stages to drop. Defaults to ("Awake",).
+        chunk_size (int, optional): See `iter_category_records`.
+    """
+    dfs = [concat_chunks([])]
+    for df in iter_category_records(fp, (SLEEP_TYPE,), ts_from, chunk_size):
+        # mapping a categorical only maps its categories, not every row
+        df["value"] = df.value.map(lambda c: SLEEP_VALUES.get(c, c))
+        dfs.append(df[~df.value.isin(exclude_values)])
+
+    cols = ["ts_start", "ts_end", "value"]
+    df_sleep = pd.concat([df[cols].astype({"value": object}) for df in dfs])
+    return df_sleep.sort_values(cols, kind="stable", ignore_index=True)
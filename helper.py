@@ -1,10 +1,500 @@
 import json
+import hashlib
 import pandas as pd
 import numpy as np
 import pytz
 from datetime import timedelta, datetime
 from supabase import create_client
 import os
+import threading
+import shutil
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor
+from interval_store import IntervalStore, to_epoch_ns
+from profiling import profiled
+
+SLEEP_TABLE = "apple_health_sleep_analysis"
+SLEEP_COLUMNS = ["ts_start", "ts_end", "value"]
+SLEEP_KEY = ["ts_start", "ts_end", "value"]  # see idx_sleep_analysis_unique
+EAT_TABLE = "foodlog"
+EAT_COLUMNS = ["id", "ts_start", "ts_end", "description"]
+EAT_KEY = ["id"]  # a meal that is edited on the server keeps its id
+# sessions computed by the database, see refresh_sessions() in supabase_setup.sql
+SLEEP_SESSIONS_TABLE = "sleep_sessions"
+SLEEP_SESSIONS_COLUMNS = [
+    "session",
+    "ts_start",
+    "ts_end",
+    "sleep_duration_in_hours",
+    "duration_in_hours",
+]
+EAT_SESSIONS_TABLE = "eat_sessions"
+EAT_SESSIONS_COLUMNS = ["session", "ts_start", "ts_end", "duration_in_hours"]
+# columns shown when hovering a session or meal (those a frame has, in this order)
+HOVER_COLUMNS = [
+    "description",
+    "id",
+    "rating",
+    "session",
+    "duration_in_hours",
+    "sleep_duration_in_hours",
+    "delta_in_hours",
+]
+
+# Database clients
+# ----------------
+
+CONNECTION_STATS = {
+    "clients_created": 0,
+    "clients_reused": 0,
+    "postgres_connections_opened": 0,
+    "postgres_connection_checkouts": 0,
+}
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(backend="supabase"):
+    """Return the database client shared by all loaders of this process.
+
+    `"supabase"` returns a Supabase client; its HTTP session keeps connections
+    alive, so all requests after the first one reuse the same connections.
+    `"postgres"` connects directly with psycopg2 (see `_postgres_settings`) and
+    hands out connections from a pool. Both offer the query builder
+    interface used by `fetch_table` and `sync_table`.
+
+    Args:
+        backend (str, optional): "supabase" or "postgres". Defaults to "supabase".
+    """
+    with _CLIENTS_LOCK:
+        if backend in _CLIENTS:
+            CONNECTION_STATS["clients_reused"] += 1
+            return _CLIENTS[backend]
+
+        if backend == "supabase":
+            client = create_client(
+                os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY")
+            )
+        elif backend == "postgres":
+            client = PostgresClient(_create_postgres_pool(**_postgres_settings()))
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
+
+        CONNECTION_STATS["clients_created"] += 1
+        _CLIENTS[backend] = client
+        return client
+
+
+def _postgres_settings():
+    """Connection settings of the "postgres" backend.
+
+    Taken from the libpq variables `PGHOST`, `PGPORT`, `PGDATABASE`, `PGUSER`
+    and `PGPASSWORD`. As a fallback, the names of `query.ipynb` (`HOST`,
+    `PORT`, `DBNAME`, `USER`, `PASSWORD`) are read from the .env file, but
+    never from the environment, where `USER` is the login name of the shell.
+    Settings that are missing in both are left to libpq's defaults.
+    """
+    from dotenv import dotenv_values
+
+    dotenv = dotenv_values()
+    return {
+        key: os.environ.get(pg_name, dotenv.get(name))
+        for key, pg_name, name in [
+            ("host", "PGHOST", "HOST"),
+            ("port", "PGPORT", "PORT"),
+            ("dbname", "PGDATABASE", "DBNAME"),
+            ("user", "PGUSER", "USER"),
+            ("password", "PGPASSWORD", "PASSWORD"),
+        ]
+    }
+
+
+def _create_postgres_pool(minconn=1, maxconn=4, **kwargs):
+    # psycopg2 is only needed for the direct connection, so import it lazily
+    from psycopg2.pool import ThreadedConnectionPool
+
+    class _CountingConnectionPool(ThreadedConnectionPool):
+        def _connect(self, key=None):
+            CONNECTION_STATS["postgres_connections_opened"] += 1
+            conn = super()._connect(key)
+            conn.autocommit = True
+            return conn
+
+        def getconn(self, key=None):
+            CONNECTION_STATS["postgres_connection_checkouts"] += 1
+            return super().getconn(key)
+
+    return _CountingConnectionPool(minconn, maxconn, **kwargs)
+
+
+_SQL_OPERATORS = {
+    "eq": "=",
+    "neq": "<>",
+    "gt": ">",
+    "gte": ">=",
+    "lt": "<",
+    "lte": "<=",
+}
+
+
+class PostgresClient:
+    """Subset of the Supabase query builder on top of a psycopg2 connection pool."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def table(self, table):
+        return _PostgresQuery(self.pool, table)
+
+    def rpc(self, fn, params=None):
+        return _PostgresRpc(self.pool, fn, params or {})
+
+
+class _PostgresQuery:
+    def __init__(self, pool, table):
+        self.pool = pool
+        self.table = table
+        self.columns = ["*"]
+        self.count = None
+        self.filters = []
+        self.order_by = []
+        self.offset = 0
+        self.n_rows = None
+
+    def select(self, *columns, count=None):
+        self.columns = list(columns)
+        self.count = count
+        return self
+
+    def order(self, column, desc=False):
+        self.order_by.append((column, desc))
+        return self
+
+    def range(self, start, end):
+        self.offset = start
+        self.n_rows = end - start + 1
+        return self
+
+    def limit(self, size):
+        self.n_rows = size
+        return self
+
+    def __getattr__(self, op):
+        if op not in _SQL_OPERATORS:
+            raise AttributeError(op)
+
+        def _filter(column, value):
+            self.filters.append((column, _SQL_OPERATORS[op], value))
+            return self
+
+        return _filter
+
+    def execute(self):
+        from psycopg2 import sql
+
+        columns = sql.SQL("*")
+        if self.columns != ["*"]:
+            columns = sql.SQL(", ").join(map(sql.Identifier, self.columns))
+        where = sql.SQL("")
+        if self.filters:
+            where = sql.SQL(" WHERE ") + sql.SQL(" AND ").join(
+                sql.SQL("{} {} %s").format(sql.Identifier(c), sql.SQL(op))
+                for c, op, _ in self.filters
+            )
+        params = [v for _, _, v in self.filters]
+
+        query = sql.SQL("SELECT {} FROM {}").format(columns, sql.Identifier(self.table))
+        query += where
+        if self.order_by:
+            query += sql.SQL(" ORDER BY ") + sql.SQL(", ").join(
+                sql.SQL("{} DESC" if desc else "{}").format(sql.Identifier(c))
+                for c, desc in self.order_by
+            )
+        if self.n_rows is not None:
+            query += sql.SQL(" LIMIT {} OFFSET {}").format(
+                sql.Literal(self.n_rows), sql.Literal(self.offset)
+            )
+
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, params)
+                names = [d.name for d in cursor.description]
+                data = [dict(zip(names, row)) for row in cursor.fetchall()]
+                count = None
+                if self.count is not None:
+                    count_query = sql.SQL("SELECT count(*) FROM {}").format(
+                        sql.Identifier(self.table)
+                    )
+                    cursor.execute(count_query + where, params)
+                    count = cursor.fetchone()[0]
+        finally:
+            self.pool.putconn(conn)
+
+        return SimpleNamespace(data=data, count=count)
+
+
+class _PostgresRpc:
+    def __init__(self, pool, fn, params):
+        self.pool = pool
+        self.fn = fn
+        self.params = params
+
+    def execute(self):
+        from psycopg2 import sql
+
+        query = sql.SQL("SELECT * FROM {}({})").format(
+            sql.Identifier(self.fn),
+            sql.SQL(", ").join(
+                sql.SQL("{} => %s").format(sql.Identifier(k)) for k in self.params
+            ),
+        )
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, list(self.params.values()))
+                names = [d.name for d in cursor.description]
+                data = [dict(zip(names, row)) for row in cursor.fetchall()]
+        finally:
+            self.pool.putconn(conn)
+
+        return SimpleNamespace(data=data, count=None)
+
+
+# Fetching
+# --------
+
+
+@profiled
+def fetch_table(
+    supabase_client, table, columns=None, filters=(), order_by=(), page_size=1000
+):
+    """Fetch the rows of `table` page by page into column arrays.
+
+    Only `columns` are selected and all `filters` are evaluated by the server.
+    The exact row count returned with the first page is used to preallocate
+    one array per column, and every page of `page_size` rows is written into
+    these arrays. Paging also avoids the silent truncation of long histories
+    by the server's default row limit: pages may come back shorter than
+    `page_size` (if the server caps the rows per request), so paging goes on
+    until the row count is reached or a page comes back empty. Columns starting
+    with `ts_` are parsed to UTC timestamps.
+
+    Args:
+        supabase_client: Anything with the query builder interface of a
+            Supabase client (`table`, `select`, `eq`/`neq`/`gte`/..., `order`,
+            `range`, `execute`).
+        table (str): Name of the table.
+        columns (list, optional): Columns to select. Defaults to all columns.
+        filters (list, optional): Tuples `(operator, column, value)`, e.g.
+            `("neq", "value", "Awake")` or `("gte", "ts_end", "2024-10-15")`.
+        order_by (list, optional): Columns giving the rows a stable order
+            across pages, e.g. the natural key. Defaults to no ordering.
+        page_size (int, optional): Rows per request. Defaults to 1000.
+    """
+
+    def _query(offset):
+        query = supabase_client.table(table).select(
+            *(columns or ["*"]), count="exact" if offset == 0 else None
+        )
+        for op, column, value in filters:
+            query = getattr(query, op)(column, value)
+        for column in order_by:
+            query = query.order(column)
+        return query.range(offset, offset + page_size - 1)
+
+    arrays = {}
+    n = 0
+    total = None
+    while total is None or n < total:
+        response = _query(n).execute()
+        rows = response.data
+        if len(rows) == 0:
+            break
+
+        if not arrays:
+            total = response.count
+            size = max(total or 0, len(rows))
+            arrays = {
+                c: np.empty(size, dtype=np.int64 if c.startswith("ts_") else object)
+                for c in rows[0]
+            }
+        elif n + len(rows) > len(next(iter(arrays.values()))):
+            # rows were added since the first page
+            arrays = {
+                c: np.concatenate([a, np.empty(len(rows), dtype=a.dtype)])
+                for c, a in arrays.items()
+            }
+
+        for c, a in arrays.items():
+            values = [row[c] for row in rows]
+            if c.startswith("ts_"):
+                values = to_epoch_ns(pd.to_datetime(values, format="ISO8601", utc=True))
+            a[n : n + len(rows)] = values
+        n += len(rows)
+
+    if not arrays:
+        return pd.DataFrame(columns=columns)
+
+    return pd.DataFrame(
+        {
+            c: _from_epoch_ns(a[:n], "UTC") if c.startswith("ts_") else a[:n]
+            for c, a in arrays.items()
+        }
+    ).infer_objects()
+
+
+# Incremental sync
+# ----------------
+
+
+@profiled
+def sync_table(
+    supabase_client,
+    table,
+    key,
+    cache_dir=".cache",
+    columns=None,
+    filters=(),
+    watermark_column="ts_start",
+    lookback=timedelta(days=2),
+    full_resync=False,
+):
+    """Return all rows of `table`, downloading only rows newer than the local copy.
+
+    A local copy of the table is kept in `cache_dir`. On every call only rows
+    with `watermark_column >= high-water mark - lookback` are fetched and
+    merged into the local copy, deduplicated on the natural `key`. The
+    lookback catches rows that arrive late, e.g. a night of sleep that is
+    synced from the watch a day later.
+
+    Args:
+        supabase_client: See `fetch_table`.
+        table (str): Name of the table.
+        key (list): Columns identifying a row.
+        cache_dir (str, optional): Directory of the local copy. Defaults to ".cache".
+        columns (list, optional): See `fetch_table`.
+        filters (list, optional): See `fetch_table`. They should not change
+            between calls, since the local copy is not filtered again.
+        watermark_column (str, optional): Timestamp column that is used as
+            high-water mark, e.g. `ts_start` or `ts_ingestion`. Defaults to "ts_start".
+        lookback (timedelta, optional): Overlap of each incremental fetch.
+            Defaults to 2 days.
+        full_resync (bool, optional): Ignore the local copy and download the
+            whole table. Defaults to False.
+    """
+    fp = os.path.join(cache_dir, f"{table}.pkl")
+    df_cache = None
+    if not full_resync and os.path.exists(fp):
+        df_cache = pd.read_pickle(fp)
+
+    filters = list(filters)
+    if df_cache is not None and len(df_cache) > 0:
+        watermark = df_cache[watermark_column].max() - lookback
+        filters.append(("gte", watermark_column, watermark.isoformat()))
+    df_new = fetch_table(
+        supabase_client, table, columns=columns, filters=filters, order_by=key
+    )
+
+    df = df_new
+    if df_cache is not None:
+        df = pd.concat([df_cache, df_new]) if len(df_new) > 0 else df_cache
+    if len(df) > 0:
+        order = [watermark_column] + [k for k in key if k != watermark_column]
+        df = (
+            df.drop_duplicates(subset=key, keep="last")
+            .sort_values(order)
+            .reset_index(drop=True)
+        )
+
+    # write to a temporary file first, so that readers never see a partial copy
+    os.makedirs(cache_dir, exist_ok=True)
+    df.to_pickle(fp + ".tmp")
+    os.replace(fp + ".tmp", fp)
+
+    return df
+
+
+def clear_table_cache(cache_dir=".cache"):
+    """Remove all local table copies, the next sync downloads everything again."""
+    for table in [SLEEP_TABLE, EAT_TABLE]:
+        fp = os.path.join(cache_dir, f"{table}.pkl")
+        if os.path.exists(fp):
+            os.remove(fp)
+
+
+# Interval store
+# --------------
+
+
+def open_interval_store(store_dir, table):
+    """Open (or create) the local interval store of `table`."""
+    fp = os.path.join(store_dir, table)
+    if table == EAT_TABLE:
+        # one category per meal description, the id is kept as extra column
+        return IntervalStore(fp, code_dtype="int32", extra_columns=("id",))
+    return IntervalStore(fp)
+
+
+@profiled
+def sync_interval_store(
+    store_dir=".store", backend="supabase", lookback=timedelta(days=2)
+):
+    """Append the new rows of the sleep and eat tables to the local interval stores.
+
+    Only rows starting after the last stored interval minus `lookback` are
+    downloaded (see `sync_table`). Returns the number of added rows per table.
+    """
+    supabase_client = get_client(backend)
+    n_added = {}
+    for table, columns, key, value_column in [
+        (SLEEP_TABLE, SLEEP_COLUMNS, SLEEP_KEY, "value"),
+        (EAT_TABLE, EAT_COLUMNS, EAT_KEY, "description"),
+    ]:
+        store = open_interval_store(store_dir, table)
+        filters = []
+        ts_last = store.last_ts_start()
+        if ts_last is not None:
+            filters.append(("gte", "ts_start", (ts_last - lookback).isoformat()))
+        df = fetch_table(supabase_client, table, columns, filters, order_by=key)
+        n_added[table] = store.append(df, value_column=value_column)
+    return n_added
+
+
+def clear_interval_store(store_dir=".store"):
+    """Remove the local interval stores, the next sync downloads everything again."""
+    for table in [SLEEP_TABLE, EAT_TABLE]:
+        shutil.rmtree(os.path.join(store_dir, table), ignore_errors=True)
+
+
+# Backfill
+# --------
+
+
+@profiled
+def backfill_sleep_analysis(batch_size=100, backend="supabase"):
+    """Extract the sleep stages of all raw payloads again, batch by batch.
+
+    Stages that already exist are skipped, so this is safe to run at any time
+    (e.g. after a change of the transformation in supabase_setup.sql). Returns
+    the number of inserted stages.
+
+    Args:
+        batch_size (int, optional): Raw payloads per transaction. Defaults to 100.
+        backend (str, optional): See `get_client`. Defaults to "supabase".
+    """
+    supabase_client = get_client(backend)
+    after_id, n_inserted = 0, 0
+    while True:
+        response = supabase_client.rpc(
+            "backfill_sleep_analysis", {"after_id": after_id, "batch_size": batch_size}
+        ).execute()
+        batch = response.data[0]
+        if batch["last_id"] is None:
+            return n_inserted
+        after_id = batch["last_id"]
+        n_inserted += batch["n_inserted"]
+
 
 # Sleep data
 # ----------
@@ -15,20 +505,37 @@ def load_sleep_data_from_json(fp):
         return json.load(f)
 
 
-def load_sleep_data_from_supabase():
-    supabase_client = create_client(
-        os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY")
-    )
-    response = (
-        supabase_client.table("apple_health_sleep_analysis").select("*").execute()
-    )
-    df_sleep = pd.DataFrame(response.data)
-    df_sleep = df_sleep[df_sleep.value != "Awake"]
+@profiled
+def load_sleep_data_from_supabase(cache_dir=None, ts_from=None, backend="supabase"):
+    supabase_client = get_client(backend)
+    filters = [("neq", "value", "Awake")]
+    if ts_from is not None:
+        filters.append(("gte", "ts_end", pd.Timestamp(ts_from).isoformat()))
+    if cache_dir is None:
+        df_sleep = fetch_table(
+            supabase_client, SLEEP_TABLE, SLEEP_COLUMNS, filters, order_by=SLEEP_KEY
+        )
+    else:
+        df_sleep = sync_table(
+            supabase_client,
+            SLEEP_TABLE,
+            SLEEP_KEY,
+            cache_dir,
+            columns=SLEEP_COLUMNS,
+            filters=filters,
+        )
     df_sleep["ts_start"] = pd.to_datetime(df_sleep["ts_start"])
     df_sleep["ts_end"] = pd.to_datetime(df_sleep["ts_end"])
     return df_sleep
 
 
+@profiled
+def load_sleep_data_from_store(store_dir=".store", ts_from=None, ts_to=None):
+    """Load the sleep stages overlapping [ts_from, ts_to) from the interval store."""
+    df_sleep = open_interval_store(store_dir, SLEEP_TABLE).read(ts_from, ts_to)
+    return df_sleep[df_sleep.value != "Awake"].reset_index(drop=True)
+
+
 def process_raw_sleep_data(sleep_data):
 
     df_sleep = pd.DataFrame(sleep_data)
@@ -50,19 +557,49 @@ def process_raw_sleep_data(sleep_data):
 # -------
 
 
-def load_eat_data_from_supabase(min_eat_duration_in_min=15):
+@profiled
+def load_eat_data_from_supabase(
+    min_eat_duration_in_min=15, cache_dir=None, ts_from=None, backend="supabase"
+):
 
-    supabase_client = create_client(
-        os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY")
-    )
-    response = supabase_client.table("foodlog").select("*").execute()
-    df_eat = pd.DataFrame(response.data)
+    supabase_client = get_client(backend)
+    filters = []
+    if ts_from is not None:
+        filters.append(("gte", "ts_end", pd.Timestamp(ts_from).isoformat()))
+    if cache_dir is None:
+        df_eat = fetch_table(
+            supabase_client, EAT_TABLE, EAT_COLUMNS, filters, order_by=EAT_KEY
+        )
+    else:
+        df_eat = sync_table(
+            supabase_client,
+            EAT_TABLE,
+            EAT_KEY,
+            cache_dir,
+            columns=EAT_COLUMNS,
+            filters=filters,
+        )
     # df_eat["ts_start"] = pd.to_datetime(df_eat["ts_start"])
     # df_eat["ts_end"] = pd.to_datetime(df_eat["ts_end"])
     
     df_eat["ts_start"] = pd.to_datetime(df_eat["ts_start"], format="ISO8601")
     df_eat["ts_end"]   = pd.to_datetime(df_eat["ts_end"],   format="ISO8601")
     
+    return _process_eat_data(df_eat, min_eat_duration_in_min)
+
+
+@profiled
+def load_eat_data_from_store(
+    store_dir=".store", min_eat_duration_in_min=15, ts_from=None, ts_to=None
+):
+    """Load the meals overlapping [ts_from, ts_to) from the interval store."""
+    df_eat = open_interval_store(store_dir, EAT_TABLE).read(ts_from, ts_to)
+    df_eat = df_eat.rename(columns={"value": "description"})[EAT_COLUMNS]
+    return _process_eat_data(df_eat, min_eat_duration_in_min)
+
+
+@profiled
+def _process_eat_data(df_eat, min_eat_duration_in_min=15):
     eat_data = df_eat.to_dict("records")
 
     dt = timedelta(minutes=min_eat_duration_in_min)
@@ -70,10 +607,6 @@ def load_eat_data_from_supabase(min_eat_duration_in_min=15):
         if e["ts_end"] - e["ts_start"] < dt:
             e["ts_end"] = e["ts_start"] + dt
     df_eat = pd.DataFrame(eat_data)
-    df_eat["info_dict"] = df_eat.apply(
-        lambda row: {"description": row.description, "id": row.id}, axis=1
-    )
-
     df_eat["value"] = df_eat["description"]
 
     return df_eat
@@ -98,206 +631,367 @@ def process_raw_eat_data(eat_data, min_eat_duration_in_min=15):
     for e in eat_data:
         if e["ts_end"] - e["ts_start"] < dt:
             e["ts_end"] = e["ts_start"] + dt
-    df_eat = pd.DataFrame(eat_data)
-    df_eat["info_dict"] = df_eat.apply(
-        lambda row: {"description": row.description, "rating": row.rating}, axis=1
-    )
-    return df_eat
+    return pd.DataFrame(eat_data)
 
 
-# Sleep Durations
-# ---------------
+# Tail of the history
+# -------------------
+#
+# The current scores only depend on the last days of every metric, and the
+# fasting clock on the latest meal. Both are loaded with a few small queries
+# ordered by ts_end, which the ts_end indices (see supabase_setup.sql) answer
+# without reading the rest of the history.
 
 
-def process_sleep_sessions_for_viz(df_sleep_sessions, timezone="UTC"):
+def fetch_latest(supabase_client, table, columns=None, filters=(), column="ts_end"):
+    """The row of `table` with the latest `column` (None if the table is empty).
 
-    df_sleep_duration_viz = df_sleep_sessions.copy()
-    df_sleep_duration_viz["ts_end"] = df_sleep_duration_viz.ts_end.apply(
-        lambda x: x.tz_convert(timezone)
-    )
-    df_sleep_duration_viz["date"] = df_sleep_duration_viz.ts_end.dt.date
-    df_sleep_duration_viz["delta_in_hours"] = df_sleep_duration_viz[
-        "sleep_duration_in_hours"
+    Args:
+        supabase_client: See `fetch_table`.
+        table (str): Name of the table.
+        columns (list, optional): Columns to select. Defaults to all columns.
+        filters (list, optional): See `fetch_table`.
+        column (str, optional): Column to order by. Defaults to "ts_end".
+    """
+    query = supabase_client.table(table).select(*(columns or ["*"]))
+    for op, c, value in filters:
+        query = getattr(query, op)(c, value)
+    rows = query.order(column, desc=True).limit(1).execute().data
+    if len(rows) == 0:
+        return None
+    return {
+        c: pd.to_datetime(v, utc=True) if c.startswith("ts_") else v
+        for c, v in rows[0].items()
+    }
+
+
+@profiled
+def load_tail_from_supabase(days, backend="supabase"):
+    """Load the sleep stages and meals of the last `days` days of the history.
+
+    The tail ends with the latest sleep stage or the latest meal, whichever
+    ends first (e.g. the meals of today are logged while last night's sleep is
+    not synced yet). Returns `(df_sleep, df_eat)` like the loaders, or None if
+    a table is empty.
+    """
+    supabase_client = get_client(backend)
+    latest = [
+        fetch_latest(
+            supabase_client, SLEEP_TABLE, ["ts_end"], [("neq", "value", "Awake")]
+        ),
+        fetch_latest(supabase_client, EAT_TABLE, ["ts_end"]),
     ]
-    df_sleep_duration_viz = fill_missing_dates(
-        df_sleep_duration_viz[["date", "delta_in_hours"]], fill_value=0
-    )
+    if any(row is None for row in latest):
+        return None
+    ts_from = min(row["ts_end"] for row in latest) - timedelta(days=days)
+    df_sleep = load_sleep_data_from_supabase(ts_from=ts_from, backend=backend)
+    df_eat = load_eat_data_from_supabase(ts_from=ts_from, backend=backend)
+    return df_sleep, df_eat
 
-    # When there are multiple sessions per day, we sum them up.
-    df_sleep_duration_viz = (
-        df_sleep_duration_viz.groupby("date").agg("sum").reset_index()
-    )
 
-    # TODO: When the duration is np.nan (because only in bed) we should keep it maybe at 0
-    # df_sleep_duration_viz.loc[df_sleep_duration_viz["delta_in_hours"] == 0, "delta_in_hours"] = np.nan
+# Sessions from the database
+# --------------------------
 
-    df_sleep_duration_viz["mean_delta_in_hours"] = (
-        df_sleep_duration_viz.delta_in_hours.rolling(7).mean()
-    )
 
-    return df_sleep_duration_viz
+@profiled
+def load_sleep_sessions_from_supabase(ts_from=None, refresh=True, backend="supabase"):
+    """Load the sleep sessions computed by the database.
 
+    Same columns as `identify_sessions` with `add_sleep_duration_in_hours`,
+    computed with the parameters in the session_params table. Only sessions
+    ending at or after `ts_from` are loaded, and the session numbers count
+    from the start of the whole history.
 
-# Deep fasting
-# ------------
+    Args:
+        ts_from (pd.Timestamp, optional): Defaults to None (all sessions).
+        refresh (bool, optional): Bring the sessions up to date first (only
+            the sessions after the earliest change are recomputed).
+            Defaults to True.
+        backend (str, optional): See `get_client`. Defaults to "supabase".
+    """
+    return _load_sessions(
+        SLEEP_SESSIONS_TABLE, SLEEP_SESSIONS_COLUMNS, ts_from, refresh, backend
+    )
 
 
-def evaluate_deep_fast_sessions(df_eat_sessions, dt_deep_fast_in_hours):
+@profiled
+def load_eat_sessions_from_supabase(ts_from=None, refresh=True, backend="supabase"):
+    """Load the eat sessions computed by the database.
 
-    # take as a ts_start the ts_start of the easting session + dt_deep_fast_in_hours
-    # take as a ts_end the ts_start of the next easting session
-    ser_ts_start = df_eat_sessions.ts_end + timedelta(hours=dt_deep_fast_in_hours)
-    ser_ts_end = pd.to_datetime(
-        df_eat_sessions.ts_start.shift(-1).fillna(datetime.now(tz=pytz.timezone("UTC")))
-    )
-    df_deep_fast_sessions = pd.DataFrame(
-        data={"ts_start": ser_ts_start, "ts_end": ser_ts_end}
+    See `load_sleep_sessions_from_supabase`.
+    """
+    return _load_sessions(
+        EAT_SESSIONS_TABLE, EAT_SESSIONS_COLUMNS, ts_from, refresh, backend
     )
 
-    # check the resulting fasting duration and drop the ones with a negative duration
-    df_deep_fast_sessions["delta_in_hours"] = (
-        (
-            df_deep_fast_sessions["ts_end"] - df_deep_fast_sessions["ts_start"]
-        ).dt.total_seconds()
-        / 60
-        / 60
-    )
-    df_deep_fast_sessions = df_deep_fast_sessions[
-        df_deep_fast_sessions["delta_in_hours"] > 0
-    ]
 
-    # add some infos
-    df_deep_fast_sessions["info_dict"] = df_deep_fast_sessions.apply(
-        lambda row: {"delta_in_hours": row.delta_in_hours}, axis=1
+def _load_sessions(table, columns, ts_from, refresh, backend):
+    supabase_client = get_client(backend)
+    if refresh:
+        supabase_client.rpc("refresh_sessions").execute()
+    filters = []
+    if ts_from is not None:
+        filters.append(("gte", "ts_end", pd.Timestamp(ts_from).isoformat()))
+    df_sessions = fetch_table(
+        supabase_client, table, columns, filters, order_by=["session"]
     )
+    df_sessions = df_sessions.astype(
+        {c: np.int64 if c == "session" else float for c in columns[3:] + ["session"]}
+    )
+    df_sessions.index = df_sessions.session.to_numpy()
+    return df_sessions
 
-    return df_deep_fast_sessions
 
+# Deep fasting
+# ------------
 
-def process_deep_fast_sessions_for_viz(df_deep_fast_sessions, timezone="UTC"):
 
-    # convert to desired timezone
-    df_deep_fast_sessions["ts_start"] = df_deep_fast_sessions.ts_start.apply(
-        lambda x: x.tz_convert(timezone)
-    )
-    df_deep_fast_sessions["ts_end"] = df_deep_fast_sessions.ts_end.apply(
-        lambda x: x.tz_convert(timezone)
-    )
-    df_deep_fast_sessions["date"] = df_deep_fast_sessions.ts_end.dt.date
+@profiled
+def evaluate_deep_fast_sessions(df_eat_sessions, dt_deep_fast_in_hours, ts_now=None):
 
-    df_deep_fast_duration = fill_missing_dates(
-        df_deep_fast_sessions[["date", "delta_in_hours"]], fill_value=0
-    )
+    if ts_now is None:
+        ts_now = datetime.now(tz=pytz.timezone("UTC"))
 
-    # When there are multiple deep fast sessions per date, take the larger one
-    df_deep_fast_duration = (
-        df_deep_fast_duration.sort_values(by="delta_in_hours")
-        .groupby("date")
-        .last()
-        .reset_index()
-        .sort_values(by="date")
-    )
+    # take as a ts_start the ts_start of the easting session + dt_deep_fast_in_hours
+    # take as a ts_end the ts_start of the next easting session (or now)
+    eat_start = to_epoch_ns(df_eat_sessions.ts_start)
+    eat_end = to_epoch_ns(df_eat_sessions.ts_end)
+    ts_start = eat_end + pd.Timedelta(hours=dt_deep_fast_in_hours).value
+    ts_end = np.append(eat_start[1:], to_epoch_ns(ts_now))[: len(eat_start)]
 
-    df_deep_fast_duration["mean_delta_in_hours"] = (
-        df_deep_fast_duration.delta_in_hours.rolling(7).mean()
+    # check the resulting fasting duration and drop the ones with a negative duration
+    delta_in_hours = _hours_between(ts_start, ts_end)
+    keep = delta_in_hours > 0
+    df_deep_fast_sessions = pd.DataFrame(
+        {
+            "ts_start": _from_epoch_ns(ts_start[keep], _tz(df_eat_sessions.ts_end)),
+            "ts_end": _from_epoch_ns(ts_end[keep], _tz(df_eat_sessions.ts_start)),
+            "delta_in_hours": delta_in_hours[keep],
+        },
+        index=df_eat_sessions.index[keep],
     )
 
-    return df_deep_fast_duration
+    return df_deep_fast_sessions
 
 
 # Meals before and after sleep sessions
 # -------------------------------------
 
 
+@profiled
 def evaluate_delta_to_first_and_last_meal(df_sleep_sessions, df_eat):
 
-    df = df_sleep_sessions.copy()
-
-    df["ts_start_first_meal_after"] = None
-    df["ts_end_last_meal_before"] = None
-
-    for idx, row in df.iterrows():
-
-        # find the first meal after the sleep session
-        ser = df_eat.ts_start - row.ts_end
-        ser = ser[ser > timedelta(seconds=0)]
-        if len(ser) == 0:
-            ts_start_first_meal_after = pd.to_datetime(np.nan)
-        else:
-            ts_start_first_meal_after = df_eat.loc[ser.idxmin()].ts_start
+    # sorted meal boundaries as int64 nanoseconds since epoch (UTC)
+    meal_starts = _sorted_epoch_ns(df_eat.ts_start)
+    meal_ends = _sorted_epoch_ns(df_eat.ts_end)
+    sleep_starts = to_epoch_ns(df_sleep_sessions.ts_start)
+    sleep_ends = to_epoch_ns(df_sleep_sessions.ts_end)
+
+    # find the first meal after the sleep session (strictly after ts_end)
+    idx = np.searchsorted(meal_starts, sleep_ends, side="right")
+    found = idx < len(meal_starts)
+    ts_start_first_meal_after = np.full(len(sleep_ends), _NAT_NS)
+    ts_start_first_meal_after[found] = meal_starts[idx[found]]
+
+    # find the last meal before sleep session (strictly before ts_start)
+    idx = np.searchsorted(meal_ends, sleep_starts, side="left") - 1
+    found = idx >= 0
+    ts_end_last_meal_before = np.full(len(sleep_ends), _NAT_NS)
+    ts_end_last_meal_before[found] = meal_ends[idx[found]]
+
+    # add to the columns of the sessions (building the frame at once is much
+    # cheaper than inserting the columns into a copy)
+    df = pd.DataFrame(
+        {
+            **{c: df_sleep_sessions[c].array for c in df_sleep_sessions},
+            "ts_start_first_meal_after": _from_epoch_ns(
+                ts_start_first_meal_after, _tz(df_eat.ts_start)
+            ),
+            "ts_end_last_meal_before": _from_epoch_ns(
+                ts_end_last_meal_before, _tz(df_eat.ts_end)
+            ),
+            "delta_first_meal_after_in_hours": _hours_between(
+                sleep_ends, ts_start_first_meal_after
+            ),
+            "delta_last_meal_before_in_hours": _hours_between(
+                ts_end_last_meal_before, sleep_starts
+            ),
+        },
+        index=df_sleep_sessions.index,
+    )
 
-        # find the last meal before sleep session
-        ser = row.ts_start - df_eat.ts_end
-        ser = ser[ser > timedelta(seconds=0)]
-        if len(ser) == 0:
-            ts_end_last_meal_before = pd.to_datetime(np.nan)
-        else:
-            ts_end_last_meal_before = df_eat.loc[ser.idxmin()].ts_end
+    return df
 
-        # add to dataframe
-        df.loc[idx, "ts_start_first_meal_after"] = ts_start_first_meal_after
-        df.loc[idx, "ts_end_last_meal_before"] = ts_end_last_meal_before
 
-    for k in ["ts_start_first_meal_after", "ts_end_last_meal_before"]:
-        df[k] = pd.to_datetime(df[k])
+# Daily metrics
+# -------------
+#
+# The daily values of all metrics share one calendar of consecutive (local)
+# days, as arrays of shape (days, metrics). A metric has a value on every day
+# from its first to its last day (0 if there is no row for a day) and NaN
+# outside of that range.
 
-    df["delta_first_meal_after_in_hours"] = (
-        (df.ts_start_first_meal_after - df.ts_end).dt.total_seconds() / 60 / 60
-    )
-    df["delta_last_meal_before_in_hours"] = (
-        (df.ts_start - df.ts_end_last_meal_before).dt.total_seconds() / 60 / 60
-    )
+DAILY_METRICS = ["fasting", "first_meal", "last_meal", "sleep"]
+DAILY_MEAN_DAYS = 7  # window of mean_delta_in_hours
 
-    return df
 
+@profiled
+def daily_cube(
+    df_deep_fast_sessions, df_first_and_last_meal, df_sleep_sessions, timezone="UTC"
+):
+    """Reduce the sessions to one value per metric (see `DAILY_METRICS`) and day.
 
-def process_first_and_last_meal_data_for_viz(df, timezone="UTC"):
+    The day of a row is the (local) day it ends on, or for the meals the day of
+    the meal. Per day, the longest deep fast, the smallest delta to the
+    first/last meal (if there are several sleep sessions) and the total sleep
+    duration are taken. Missing values count as 0.
 
-    # first convert all the timestamps to the desired timezone
-    for c in df.columns:
-        if c.startswith("ts_"):
-            df[c] = df[c].apply(lambda x: x.tz_convert(timezone))
+    Returns:
+        dict: "date" (pd.DatetimeIndex of the days), "delta_in_hours" and its
+            weekly average "mean_delta_in_hours" (arrays of shape (days, metrics)).
+    """
+    df_meals = df_first_and_last_meal
+    inputs = [
+        (
+            df_deep_fast_sessions.ts_end,
+            df_deep_fast_sessions.delta_in_hours,
+            np.maximum,
+        ),
+        (
+            df_meals.ts_start_first_meal_after,
+            df_meals.delta_first_meal_after_in_hours,
+            np.minimum,
+        ),
+        (
+            df_meals.ts_end_last_meal_before,
+            df_meals.delta_last_meal_before_in_hours,
+            np.minimum,
+        ),
+        (df_sleep_sessions.ts_end, df_sleep_sessions.sleep_duration_in_hours, np.add),
+    ]
 
-    # as a date we take ts_end_last_meal_before and ts_start_first_meal_after
-    df["date_first_meal_after"] = df.ts_start_first_meal_after.dt.date
-    df["date_last_meal_before"] = df.ts_end_last_meal_before.dt.date
+    # days since epoch of every row (rows without a day are dropped)
+    days, values = [], []
+    for ts, ser, _ in inputs:
+        index = pd.DatetimeIndex(ts)
+        valid = ~index.isna()
+        days.append(_local_days_and_minutes(index[valid].tz_convert(timezone))[0])
+        values.append(np.nan_to_num(ser.to_numpy(dtype=float)[valid]))
+    non_empty = [d for d in days if len(d) > 0]
+    day0 = min(d.min() for d in non_empty) if non_empty else 0
+    n_days = max(d.max() for d in non_empty) - day0 + 1 if non_empty else 0
+
+    delta = np.full((n_days, len(inputs)), np.nan)
+    for j, ((_, _, ufunc), d, v) in enumerate(zip(inputs, days, values)):
+        if len(d) == 0:
+            continue
+        first, last = d.min() - day0, d.max() - day0
+        pos = d - day0 - first
+        if ufunc is np.add:
+            col = np.bincount(pos, weights=v, minlength=last - first + 1)
+        else:
+            col = np.full(last - first + 1, np.inf if ufunc is np.minimum else -np.inf)
+            ufunc.at(col, pos, v)
+            col[np.isinf(col)] = 0  # days without a row
+        delta[first : last + 1, j] = col
+
+    return {
+        "date": _calendar(day0, n_days),
+        "delta_in_hours": delta,
+        "mean_delta_in_hours": _decayed_rolling_mean(delta, DAILY_MEAN_DAYS),
+    }
+
+
+def splice_daily_cube(daily, daily_tail, date):
+    """Replace the days of `daily` from `date` on with those of `daily_tail`.
+
+    `daily` is the `daily_cube` of rows of which only those on or after `date`
+    (by their day) changed, `daily_tail` the one of (at least) all new rows on
+    or after `date`. Returns the `daily_cube` of all new rows, only computing
+    the weekly averages of the changed days. Returns None if it can't be
+    spliced, i.e. if `date` isn't after the first day of `daily`, or if a
+    metric has no more rows on or after `date` but had some before.
+    """
+    dates, old = daily["date"], daily["delta_in_hours"]
+    pos = int(dates.searchsorted(date))
+    if pos == 0:
+        return None
+    i0 = int(daily_tail["date"].searchsorted(date))
+    tail = daily_tail["delta_in_hours"][i0:]
+    has_tail = ~np.isnan(tail)
+    if (~np.isnan(old[pos:]) & ~has_tail.any(axis=0)).any():
+        return None
+    if len(tail) == 0:
+        return daily  # nothing on or after `date`, before or now
+
+    offset = (daily_tail["date"][i0] - dates[0]).days
+    delta = np.full((offset + len(tail), old.shape[1]), np.nan)
+    delta[:pos], delta[offset:] = old[:pos], tail
+    changed = pos  # first day whose weekly average may differ
+    for j in range(delta.shape[1]):
+        before = np.flatnonzero(~np.isnan(old[:pos, j]))
+        after = np.flatnonzero(has_tail[:, j])
+        if len(before) == 0 or len(after) == 0:
+            continue
+        # the range of the metric now spans both parts, days without a row
+        # (in between or, from the tail, before its first row) count as 0
+        col = delta[before[0] : offset + after[-1] + 1, j]
+        missing = np.flatnonzero(np.isnan(col))
+        col[missing] = 0
+        if len(missing) > 0:
+            changed = min(changed, before[0] + missing[0])
+
+    start = max(changed - DAILY_MEAN_DAYS + 1, 0)
+    mean = np.empty_like(delta)
+    mean[:changed] = daily["mean_delta_in_hours"][:changed]
+    mean[changed:] = _decayed_rolling_mean(delta[start:], DAILY_MEAN_DAYS)[
+        changed - start :
+    ]
+    day0 = dates[0].to_datetime64().astype("datetime64[D]").astype(np.int64)
+    return {
+        "date": _calendar(day0, len(delta)),
+        "delta_in_hours": delta,
+        "mean_delta_in_hours": mean,
+    }
+
+
+def _calendar(day0, n_days):
+    return pd.DatetimeIndex(
+        (day0 + np.arange(n_days)).astype("datetime64[D]").astype("datetime64[ns]"),
+        name="date",
+    )
 
-    # derive individual dataframe from the last and the first meal
-    dfs = []
-    for k in ["first_meal_after", "last_meal_before"]:
-        col = {f"date_{k}": "date", f"delta_{k}_in_hours": "delta_in_hours"}
-        df_tmp = df[list(col.keys())].rename(columns=col).dropna(subset=["date"])
-        df_tmp = fill_missing_dates(df_tmp)
 
-        # if there were multiple sleep sessions per date, we take the smallest value
-        df_tmp = (
-            df_tmp.sort_values(by="delta_in_hours")
-            .groupby("date")
-            .first()
-            .reset_index()
-            .sort_values(by="date")
-        )
-        df_tmp["mean_delta_in_hours"] = df_tmp.delta_in_hours.rolling(7).mean()
-        dfs.append(df_tmp.copy())
+def daily_frame(daily, metric):
+    """The days of one metric of a `daily_cube` as a frame (e.g. to plot it).
 
-    return dfs
+    Columns: date, delta_in_hours and mean_delta_in_hours.
+    """
+    j = DAILY_METRICS.index(metric)
+    has_value = ~np.isnan(daily["delta_in_hours"][:, j])
+    return pd.DataFrame(
+        {
+            "date": daily["date"][has_value],
+            "delta_in_hours": daily["delta_in_hours"][has_value, j],
+            "mean_delta_in_hours": daily["mean_delta_in_hours"][has_value, j],
+        }
+    )
 
 
 # Score
 # -----
 
 
+@profiled
 def calculate_score(
-    df_deep_fast_viz,
-    df_first_meal_viz,
-    df_last_meal_viz,
-    df_sleep_duration_viz,
+    daily,
     target_delta_fasting=4,
     target_delta_first_meal=1,
     target_delta_last_meal=3,
     target_delta_sleep=7,
     rolling_window_days=7,
     gamma=1,
+    style=True,
 ):
     """Calculate the overall score.
 
@@ -310,79 +1004,250 @@ def calculate_score(
     the score of the current based on the history.
 
     Args:
-        df_deep_fast_viz (pd.DataFrame): Returned by `load_data`.
-        df_first_meal_viz (pd.DataFrame): Returned by `load_data`.
-        df_last_meal_viz (pd.DataFrame): Returned by `load_data`.
-        df_sleep_duration_viz (pd.DataFrame): Returned by `load_data`.
+        daily (dict): Daily metrics, returned by `daily_cube`.
         target_delta_fasting (int, optional): Fasting target. Defaults to 4.
         target_delta_first_meal (int, optional): First meal target. Defaults to 1.
         target_delta_last_meal (int, optional): Last meal target. Defaults to 3.
         target_delta_sleep (int, optional): Sleep target. Defaults to 7.
         rolling_window_days (int, optional): History taking into accound. Defaults to 7.
         gamma (int, optional): Decay factor. Defaults to 1.
+        style (bool, optional): Return the debug frames as Stylers (see
+            `style_debug_frame`), which is slow. Defaults to True.
     """
 
-    def _scoring(x, gamma=1):
-        weights = gamma ** np.arange(len(x))
-        weights = weights[::-1]
-        return (x * weights).sum() / weights.sum()
+    targets = [
+        target_delta_fasting,
+        target_delta_first_meal,
+        target_delta_last_meal,
+        target_delta_sleep,
+    ]
+    dates, deltas = daily["date"], daily["delta_in_hours"]
+
+    # calculate the individual score for each day
+    daily_scores = _daily_scores(deltas, targets)
 
+    # calculate the score based on last rolling_window_days taking the decay of gamma into account
+    scores = _decayed_rolling_mean(daily_scores, rolling_window_days, gamma=gamma)
+
+    # debug info: the last days of every metric, the latest first
     debug_info = {}
-    dfs = []
-
-    for name, target, df in zip(
-        ["fasting", "first_meal", "last_meal", "sleep"],
-        [
-            target_delta_fasting,
-            target_delta_first_meal,
-            target_delta_last_meal,
-            target_delta_sleep,
-        ],
-        [df_deep_fast_viz, df_first_meal_viz, df_last_meal_viz, df_sleep_duration_viz],
-    ):
-        # if only a single number is given set the target accordingly
-        if not isinstance(target, tuple):
-            target = (target, target)
-
-        df_tmp = df[["date", "delta_in_hours"]].copy()
-
-        # calculate the individual score for each day
-        df_tmp[f"_score_{name}"] = (
-            (df_tmp.delta_in_hours - min(target)) / (max(target) - min(target))
-        ).clip(0, 1)
-
-        # calculate the score based on last rolling_window_days taking the decay of gamma into account
-        df_tmp[f"score_{name}"] = (
-            df_tmp[f"_score_{name}"]
-            .rolling(rolling_window_days)
-            .apply(lambda x: _scoring(x, gamma=gamma))
+    for j, name in enumerate(DAILY_METRICS):
+        idx = np.flatnonzero(~np.isnan(deltas[:, j]))[-rolling_window_days:][::-1]
+        df_debug = pd.DataFrame(
+            {
+                "date": dates[idx],
+                "delta_in_hours": deltas[idx, j],
+                f"_score_{name}": daily_scores[idx, j],
+                f"score_{name}": scores[idx, j],
+            }
         )
+        debug_info[name] = style_debug_frame(df_debug) if style else df_debug
+
+    # the overall score is the mean of the days on which all scores are known
+    df = pd.DataFrame(
+        {
+            "date": dates,
+            **{f"score_{n}": scores[:, j] for j, n in enumerate(DAILY_METRICS)},
+            "score": scores.mean(axis=1),
+        }
+    )
 
-        # add debug info
-        df_debug = (
-            df_tmp.tail(rolling_window_days)
-            .sort_values(by="date", ascending=False)
-            .reset_index(drop=True)
-        )
-        df_debug = df_debug.style.background_gradient(
-            cmap="RdYlGn", subset=[f"_score_{name}"], vmin=0, vmax=1
+    return df, debug_info
+
+
+def style_debug_frame(df_debug):
+    """Color the daily scores of a debug frame of `calculate_score`."""
+    subset = [c for c in df_debug if c.startswith("_score_")]
+    return df_debug.style.background_gradient(
+        cmap="RdYlGn", subset=subset, vmin=0, vmax=1
+    )
+
+
+def _daily_scores(deltas, targets):
+    """Score of every day (rows of `deltas`) for one target per column.
+
+    (if only a single number is given set the target accordingly)
+    """
+    targets = [t if isinstance(t, tuple) else (t, t) for t in targets]
+    lo = np.array([min(t) for t in targets], dtype=float)
+    hi = np.array([max(t) for t in targets], dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.clip((deltas - lo) / (hi - lo), 0, 1)
+
+
+def _decayed_rolling_mean(x, window, gamma=1):
+    """Gamma-weighted rolling mean along the first axis of `x`.
+
+    The most recent day has weight 1, the day before `gamma`, and so on. Like
+    `pd.Series.rolling(window).apply(...)`, a window that is incomplete or
+    contains a NaN yields NaN.
+
+    Args:
+        x (np.ndarray): Array of shape (days, metrics) on a contiguous calendar.
+        window (int): Number of days in the window.
+        gamma (float, optional): Decay factor. Defaults to 1.
+    """
+    weights = float(gamma) ** np.arange(window)[::-1]
+    ret = np.full(x.shape, np.nan)
+    if len(x) >= window:
+        windows = np.lib.stride_tricks.sliding_window_view(x, window, axis=0)
+        ret[window - 1 :] = windows @ weights / weights.sum()
+    return ret
+
+
+# Parameter sweep
+# ---------------
+#
+# The score of a metric only depends on its own target, and the rolling mean
+# is linear. So the rolling scores are computed once per metric, target,
+# window and gamma, and the overall score of every combination is the mean of
+# four of them.
+
+SWEEP_STATS = ["score", "mean", "std", "min", "max"]
+CHUNK_ELEMENTS = 2**18  # days x combinations evaluated at once
+
+
+@profiled
+def sweep_scores(
+    daily,
+    target_delta_fasting=(4,),
+    target_delta_first_meal=(1,),
+    target_delta_last_meal=(3,),
+    target_delta_sleep=(7,),
+    rolling_window_days=(7,),
+    gamma=(1,),
+    last_days=None,
+    n_workers=1,
+):
+    """Evaluate the score history for every combination of the given parameters.
+
+    Every parameter is a list of values to try (a target can be a number or a
+    (min_target, max_target) tuple, see `calculate_score`), e.g.
+    `target_delta_sleep=[(6, 7), (6.5, 7), 7]`.
+
+    Args:
+        daily (dict): Daily metrics, returned by `daily_cube`.
+        target_delta_*, rolling_window_days, gamma (list, optional): Values of
+            the parameters of `calculate_score`. Default to its defaults.
+        last_days (int, optional): Only keep the scores of the last days.
+            Defaults to all days.
+        n_workers (int, optional): Number of worker processes, 1 computes in
+            this process. Defaults to 1.
+
+    Returns:
+        tuple: A data frame with one row per combination (the parameters and
+            the summary statistics `SWEEP_STATS` of its score: the current
+            score as in the app, and the mean, std, min and max of the daily
+            score) and the daily scores of all combinations, a float32 array of
+            shape (combinations, days) for the (last) days of `daily["date"]`.
+    """
+    grids = [
+        list(target_delta_fasting),
+        list(target_delta_first_meal),
+        list(target_delta_last_meal),
+        list(target_delta_sleep),
+    ]
+    windows, gammas = list(rolling_window_days), list(gamma)
+    deltas = daily["delta_in_hours"]
+    n_days = len(deltas) if last_days is None else min(last_days, len(deltas))
+
+    # rolling scores per metric: shape (windows, gammas, targets, days)
+    rolling = []
+    for j, targets in enumerate(grids):
+        daily_scores = _daily_scores(deltas[:, [j]], targets)
+        rolling.append(
+            np.array(
+                [
+                    [_decayed_rolling_mean(daily_scores, w, gamma=g).T for g in gammas]
+                    for w in windows
+                ]
+            )
         )
-        debug_info[name] = df_debug
 
-        df_tmp = df_tmp.drop(columns=["delta_in_hours", f"_score_{name}"])
-        dfs.append(df_tmp)
+    shape = (len(windows), len(gammas), *[len(t) for t in grids])
+    n_combinations = int(np.prod(shape))
+    chunk_size = max(1, CHUNK_ELEMENTS // max(len(deltas), 1))
+    tasks = [
+        (start, min(start + chunk_size, n_combinations))
+        for start in range(0, n_combinations, chunk_size)
+    ]
+    initargs = (rolling, [_last_valid(r) for r in rolling], shape, n_days)
 
-    df = (
-        dfs[0]
-        .merge(dfs[1], on="date", how="outer")
-        .merge(dfs[2], on="date", how="outer")
-        .merge(dfs[3], on="date", how="outer")
-        .set_index("date")
+    if n_workers == 1:
+        _init_sweep_worker(*initargs)
+        results = list(map(_sweep_chunk, tasks))
+    else:
+        with ProcessPoolExecutor(
+            n_workers, initializer=_init_sweep_worker, initargs=initargs
+        ) as executor:
+            results = list(executor.map(_sweep_chunk, tasks))
+
+    idx = np.unravel_index(np.arange(n_combinations), shape)
+    df = pd.DataFrame(
+        {
+            "rolling_window_days": np.asarray(windows)[idx[0]],
+            "gamma": np.asarray(gammas, dtype=float)[idx[1]],
+            "target_delta_fasting": _as_objects(grids[0])[idx[2]],
+            "target_delta_first_meal": _as_objects(grids[1])[idx[3]],
+            "target_delta_last_meal": _as_objects(grids[2])[idx[4]],
+            "target_delta_sleep": _as_objects(grids[3])[idx[5]],
+        }
     )
+    scores = np.empty((n_combinations, n_days), dtype=np.float32)
+    stats = np.empty((n_combinations, len(SWEEP_STATS)))
+    for (start, stop), (chunk_scores, chunk_stats) in zip(tasks, results):
+        scores[start:stop], stats[start:stop] = chunk_scores, chunk_stats
+    df[SWEEP_STATS] = stats
+    return df, scores
+
+
+def _as_objects(values):
+    # a list of tuples would become a 2d array
+    ret = np.empty(len(values), dtype=object)
+    ret[:] = values
+    return ret
+
+
+_SWEEP = {}
+
+
+def _init_sweep_worker(rolling, latest, shape, n_days):
+    _SWEEP.update(rolling=rolling, latest=latest, shape=shape, n_days=n_days)
 
-    df["score"] = df.mean(axis=1).where(df.notna().all(axis=1))
 
-    return df.reset_index(), debug_info
+def _sweep_chunk(task):
+    """Daily scores and summary statistics of the combinations start:stop."""
+    start, stop = task
+    rolling, n_days = _SWEEP["rolling"], _SWEEP["n_days"]
+    iw, ig, *it = np.unravel_index(np.arange(start, stop), _SWEEP["shape"])
+
+    # the overall score is NaN on the days on which any metric is NaN
+    score = sum(r[iw, ig, i] for r, i in zip(rolling, it)) / len(rolling)
+    valid = ~np.isnan(score)
+    n_valid = valid.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(valid, score, 0).sum(axis=1) / n_valid
+        std = np.sqrt(
+            np.where(valid, (score - mean[:, None]) ** 2, 0).sum(axis=1) / n_valid
+        )
+    vmin = np.where(valid, score, np.inf).min(axis=1, initial=np.inf)
+    vmax = np.where(valid, score, -np.inf).max(axis=1, initial=-np.inf)
+    vmin[n_valid == 0], vmax[n_valid == 0] = np.nan, np.nan
+
+    # current score (see `visualization.get_current_scores`): the mean of the
+    # latest score of every metric
+    current = sum(r[iw, ig, i] for r, i in zip(_SWEEP["latest"], it)) / len(rolling)
+
+    stats = np.stack([current, mean, std, vmin, vmax], axis=1)
+    return score[:, score.shape[1] - n_days :].astype(np.float32), stats
+
+
+def _last_valid(x):
+    """The last non-NaN value along the last axis of `x` (NaN if there is none)."""
+    valid = ~np.isnan(x)
+    pos = x.shape[-1] - 1 - np.argmax(valid[..., ::-1], axis=-1)
+    last = np.take_along_axis(x, pos[..., None], axis=-1)[..., 0]
+    return np.where(valid.any(axis=-1), last, np.nan)
 
 
 # def calculate_score(
@@ -419,136 +1284,204 @@ def calculate_score(
 # -------------
 
 
+_NAT_NS = np.iinfo(np.int64).min
+
+
+def _from_epoch_ns(values, tz=None):
+    """Inverse of `to_epoch_ns`, `_NAT_NS` entries become `NaT`."""
+    index = pd.DatetimeIndex(np.asarray(values, dtype=np.int64).view("datetime64[ns]"))
+    if tz is not None:
+        index = index.tz_localize("UTC").tz_convert(tz)
+    return index
+
+
+def _tz(ser):
+    """Timezone of a datetime series (None if naive), cheaper than `ser.dt.tz`."""
+    return getattr(ser.dtype, "tz", None)
+
+
+def _sorted_epoch_ns(ser):
+    """Sorted int64 nanoseconds of the timestamps in `ser`, without `NaT`.
+
+    The (tim)sort is linear on the mostly sorted timestamps of the raw data.
+    """
+    values = to_epoch_ns(ser)
+    return np.sort(values[values != _NAT_NS], kind="stable")
+
+
+def _hours_between(t1, t2):
+    """`t2 - t1` in hours, of int64 nanoseconds (NaN where one is `_NAT_NS`)."""
+    is_nat = (t1 == _NAT_NS) | (t2 == _NAT_NS)
+    return np.where(is_nat, np.nan, (t2 - t1) / 1e9 / 60 / 60)
+
+
+def _segment_starts(gap_to_next, min_gap):
+    """Return the positions at which a new session starts.
+
+    A new session starts after every row whose gap to the next row exceeds
+    `min_gap`. Missing gaps (e.g. the last row) never start a new session.
+    """
+    if len(gap_to_next) == 0:
+        return np.empty(0, dtype=np.intp)
+    breaks = np.flatnonzero(gap_to_next[:-1] > min_gap) + 1
+    return np.concatenate([[0], breaks]).astype(np.intp)
+
+
+@profiled
 def identify_sessions(
     df,
     min_gap_between_sessions_in_minutes=60 * 12,
     min_duration_of_session_in_minutes=0,
     add_sleep_duration_in_hours=False,
+    first_session=0,
 ):
+    """Merge intervals into sessions.
+
+    Sessions are numbered consecutively starting at `first_session` and the
+    session number is also used as index. A later part of the data can thus be
+    sessionized on its own (starting at a session boundary) and be appended to
+    the sessions of the earlier part.
 
-    df_agg = df.copy()
+    Returns a frame with the columns session, ts_start, ts_end,
+    sleep_duration_in_hours (only with `add_sleep_duration_in_hours`) and
+    duration_in_hours. Unlike before, there is no info_dict column, the hover
+    text is built from these columns (see `hover_info`).
+    """
 
-    # calculate gap to next sleep period
-    df_agg = df_agg.sort_values("ts_start").reset_index(drop=True)
-    df_agg["gap_to_next_in_minutes"] = (
-        df_agg["ts_start"].shift(-1) - df_agg["ts_end"]
-    ).dt.total_seconds() / 60
-    df_agg["sleep_duration_in_hours"] = np.where(
-        df_agg["value"] != "InBed",
-        (df_agg["ts_end"] - df_agg["ts_start"]).dt.total_seconds() / 60 / 60,
+    # calculate gap to next sleep period (on int64 nanoseconds, the Series
+    # arithmetic is slow on the few rows of an incremental update)
+    ts_start, ts_end = to_epoch_ns(df["ts_start"]), to_epoch_ns(df["ts_end"])
+    order = np.argsort(ts_start, kind="stable")
+    ts_start, ts_end = ts_start[order], ts_end[order]
+    gap_to_next_in_minutes = np.full(len(order), np.nan)
+    gap_to_next_in_minutes[:-1] = (ts_start[1:] - ts_end[:-1]) / 1e9 / 60
+    sleep_duration_in_hours = np.where(
+        df["value"].to_numpy()[order] != "InBed",
+        (ts_end - ts_start) / 1e9 / 60 / 60,
         np.nan,
     )
 
-    # assign sleep session
-    df_agg["session"] = np.nan
-    current_session = 0
-    for i in range(len(df_agg)):
-        df_agg.loc[i, "session"] = current_session
-        if (
-            df_agg.loc[i, "gap_to_next_in_minutes"]
-            > min_gap_between_sessions_in_minutes
-        ):
-            current_session += 1
-    df_agg["session"] = df_agg["session"].astype(int)
-
-    # group by sleep-session
-    df_agg = (
-        df_agg.groupby("session")
-        .agg(
-            ts_start=("ts_start", "min"),
-            ts_end=("ts_end", "max"),
-            sleep_duration_in_hours=(
-                "sleep_duration_in_hours",
-                lambda x: x.sum() if not x.isna().all() else np.nan,
-            ),
-        )
-        .reset_index()
-        .sort_values("ts_start")
+    # assign sleep session: a session ends wherever the gap is too large
+    starts = _segment_starts(
+        gap_to_next_in_minutes, min_gap_between_sessions_in_minutes
     )
 
+    # reduce per sleep-session (rows are sorted by ts_start, so the first
+    # ts_start of each segment is its minimum)
+    is_sleep = ~np.isnan(sleep_duration_in_hours)
+    sleep_sum = np.add.reduceat(np.where(is_sleep, sleep_duration_in_hours, 0), starts)
+    sleep_count = np.add.reduceat(is_sleep.astype(np.int64), starts)
+    session_start = ts_start[starts]
+    session_end = np.maximum.reduceat(ts_end, starts)
+
+    sessions = np.arange(first_session, first_session + len(starts), dtype=np.int64)
+    columns = {
+        "session": sessions,
+        "ts_start": _from_epoch_ns(session_start, _tz(df["ts_start"])),
+        "ts_end": _from_epoch_ns(session_end, _tz(df["ts_end"])),
+        "sleep_duration_in_hours": np.where(sleep_count > 0, sleep_sum, np.nan),
+        "duration_in_hours": (session_end - session_start) / 1e9 / 60 / 60,
+    }
+    if not add_sleep_duration_in_hours:
+        del columns["sleep_duration_in_hours"]
+
     # remove sessions that are too short (whatever the threshold is)
-    df_agg["duration_in_hours"] = (
-        (df_agg["ts_end"] - df_agg["ts_start"]).dt.total_seconds() / 60 / 60
+    keep = columns["duration_in_hours"] >= min_duration_of_session_in_minutes / 60
+    df_agg = pd.DataFrame(
+        {c: v[keep] for c, v in columns.items()}, index=sessions[keep]
     )
-    df_agg = df_agg[df_agg.duration_in_hours >= min_duration_of_session_in_minutes / 60]
-
-    if add_sleep_duration_in_hours:
-        df_agg["info_dict"] = df_agg.apply(
-            lambda row: {
-                "session": row.session,
-                "duration_in_hours": row.duration_in_hours,
-                "sleep_duration_in_hours": row.sleep_duration_in_hours,
-            },
-            axis=1,
-        )
-    else:
-        df_agg["info_dict"] = df_agg.apply(
-            lambda row: {
-                "session": row.session,
-                "duration_in_hours": row.duration_in_hours,
-            },
-            axis=1,
-        )
-        df_agg.drop(columns=["sleep_duration_in_hours"], inplace=True)
 
     return df_agg
 
 
+@profiled
 def process_for_visualization(df_sleep, tz):
+    """Split the intervals into one segment per (local) day they touch.
 
-    current_timezone = pytz.timezone(tz)
+    Every segment keeps ts_start and ts_end of its interval (in `tz`) and the
+    `HOVER_COLUMNS` of `df_sleep`, for the hover text (see `hover_info`).
+    """
 
-    data = []
+    # convert to the desired timezone (as indices, the Series accessors are
+    # slow on the few rows of an incremental update)
+    t1 = pd.DatetimeIndex(df_sleep["ts_start"]).tz_convert(tz)
+    t2 = pd.DatetimeIndex(df_sleep["ts_end"]).tz_convert(tz)
+    # Todo: Ensure a minimum...
+    n_invalid = (~(t1 <= t2)).sum()
+    if n_invalid > 0:
+        raise ValueError(f"t1 is larger than t2 in {n_invalid} rows!!!")
+
+    d1, m1 = _local_days_and_minutes(t1)
+    d2, m2 = _local_days_and_minutes(t2)
+    h1 = m1 // 60 + (m1 % 60) / 60
+    h2 = m2 // 60 + (m2 % 60) / 60
+
+    # expand every interval into one segment per day it touches: the first
+    # segment starts at h1, the last one ends at h2, all others span 0-24
+    n_segments = d2 - d1 + 1
+    row = np.repeat(np.arange(len(n_segments)), n_segments)
+    offset = np.arange(len(row)) - np.repeat(
+        np.cumsum(n_segments) - n_segments, n_segments
+    )
 
-    for _, row in df_sleep.iterrows():
+    seg_h1 = np.where(offset == 0, h1[row], 0.0)
+    seg_h2 = np.where(offset == n_segments[row] - 1, h2[row], 24.0)
+    seg_date = (d1[row] + offset).astype("datetime64[D]")
+
+    df_sleep_tz = pd.DataFrame(
+        {
+            "date": seg_date.astype(object),
+            "h1": seg_h1,
+            "h2": seg_h2,
+            "dh": seg_h2 - seg_h1,
+            "ts_start": t1[row],
+            "ts_end": t2[row],
+            **{c: df_sleep[c].to_numpy()[row] for c in HOVER_COLUMNS if c in df_sleep},
+        }
+    )
 
-        t1 = row["ts_start"].tz_convert(current_timezone)
-        t2 = row["ts_end"].tz_convert(current_timezone)
-        assert t1 <= t2, "t1 is larger or equal to t2!!!"  # Todo: Ensure a minimum...
+    return df_sleep_tz
 
-        d1 = t1.date()
-        h1 = t1.hour + t1.minute / 60
-        d2 = t2.date()
-        h2 = t2.hour + t2.minute / 60
 
-        if "info_dict" in row:
-            info_html = "<br>".join([f"{k}: {v}" for k, v in row.info_dict.items()])
-        else:
-            info_html = ""
-        info_html += f"<br>from: {t1}"
-        info_html += f"<br>to: {t2}"
+def hover_info(df, html=False):
+    """The hover text of every row of `df` as a dict (or html), for debugging.
 
-        if d1 != d2:
+    `df` is a frame of sessions or meals, or one returned by
+    `process_for_visualization`. The figure doesn't use this, it gets the
+    columns as customdata (see `visualization.visualize_data`).
+    """
+    columns = [c for c in HOVER_COLUMNS if c in df]
+    labels = columns + ["from", "to"]
+    values = zip(*[df[c] for c in columns + ["ts_start", "ts_end"]])
+    dicts = [dict(zip(labels, v)) for v in values]
+    if html:
+        return ["<br>".join(f"{k}: {v}" for k, v in d.items()) for d in dicts]
+    return dicts
 
-            data.append(
-                {"date": d1, "h1": h1, "h2": 24, "dh": 24 - h1, "info_html": info_html}
-            )
 
-            for i in range(1, (d2 - d1).days):
-                d = d1 + i * timedelta(days=1)
-                data.append(
-                    {"date": d, "h1": 0, "h2": 24, "dh": 24, "info_html": info_html}
-                )
+def _local_days_and_minutes(t):
+    """Local day (days since epoch) and minute of the day of a tz-aware index."""
+    ns = t.tz_localize(None).asi8
+    days = ns // (24 * 3600 * 10**9)
+    return days, (ns - days * (24 * 3600 * 10**9)) // (60 * 10**9)
 
-            data.append(
-                {"date": d2, "h1": 0, "h2": h2, "dh": h2, "info_html": info_html}
-            )
 
-        else:
-            data.append(
-                {"date": d1, "h1": h1, "h2": h2, "dh": h2 - h1, "info_html": info_html}
-            )
+def local_date(ser, tz):
+    """Calendar day (as naive midnight) of each timestamp in timezone `tz`."""
+    return ser.dt.tz_convert(tz).dt.tz_localize(None).dt.normalize()
 
-    df_sleep_tz = pd.DataFrame(data)
 
-    return df_sleep_tz
+def count_day_segments(df, tz):
+    """Number of rows `process_for_visualization(df, tz)` returns."""
+    d1, _ = _local_days_and_minutes(pd.DatetimeIndex(df["ts_start"]).tz_convert(tz))
+    d2, _ = _local_days_and_minutes(pd.DatetimeIndex(df["ts_end"]).tz_convert(tz))
+    return int((d2 - d1 + 1).sum())
 
 
-def fill_missing_dates(df, date_key="date", fill_value=0):
-    df = df.copy()
-    df[date_key] = pd.to_datetime(df[date_key])
-    df_tmp = pd.DataFrame(
-        pd.date_range(start=df[date_key].min(), end=df[date_key].max()),
-        columns=[date_key],
-    )
-    return df.merge(df_tmp, on=date_key, how="outer").fillna(fill_value)
+@profiled
+def hash_frames(*dfs):
+    """Return a hash of the content of the given data frames (ignoring the index)."""
+    hasher = hashlib.sha1()
+    for df in dfs:
+        hasher.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return hasher.hexdigest()
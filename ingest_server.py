@@ -0,0 +1,685 @@
+import io
+import os
+import re
+import csv
+import json
+import codecs
+import asyncio
+import logging
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from datetime import datetime
+import helper as h
+from health_export import DATE_FORMAT
+
+logger = logging.getLogger(__name__)
+
+# Health Auto Export metrics that are ingested, with the table they go to
+METRICS = {"sleep_analysis": h.SLEEP_TABLE}
+
+MAX_BODY_BYTES = 512 * 2**20
+READ_CHUNK_BYTES = 2**16
+STAGE_MEMORY_BYTES = 2**20  # rows of a request beyond this are staged on disk
+
+
+# Incremental parsing
+# -------------------
+
+_NEED_MORE = object()
+_WHITESPACE = " \t\n\r"
+_STRUCTURE = re.compile(r'[\[\]{}"\\]')
+_DECODER = json.JSONDecoder()
+
+
+class PayloadParser:
+    """Incremental parser of pushed payloads.
+
+    The body is fed chunk by chunk, and every `feed` returns the records that
+    are complete so far as (table, record) pairs. Only single records (e.g.
+    one datapoint) are ever decoded as a whole, so memory depends on the chunk
+    size and not on the size of the body.
+
+    Args:
+        kind (str, optional): "health" for Health Auto Export payloads
+            (`{"data": {"metrics": [...]}}` or `{"metrics": [...]}`), whose
+            datapoints of the `METRICS` are returned, or "foodlog" for a list
+            of meals. Defaults to "health".
+    """
+
+    def __init__(self, kind="health"):
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._done = False
+        self._records = []
+        self._parser = self._health() if kind == "health" else self._foodlog()
+        self._advance()
+
+    def feed(self, text):
+        self._buf = self._buf[self._pos :] + text
+        self._pos = 0
+        self._advance()
+        records, self._records = self._records, []
+        return records
+
+    def close(self):
+        """Returns the last records, raises ValueError if the payload is incomplete."""
+        self._eof = True
+        self._advance()
+        if self._buf[self._pos :].strip(_WHITESPACE):
+            raise ValueError("Unexpected data after the payload")
+        records, self._records = self._records, []
+        return records
+
+    def _advance(self):
+        # run the parser until it needs more data
+        if not self._done:
+            try:
+                next(self._parser)
+            except StopIteration:
+                self._done = True
+
+    # Primitives (generators that yield whenever they need more data)
+
+    def _peek(self):
+        while True:
+            buf = self._buf
+            while self._pos < len(buf) and buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(buf):
+                return buf[self._pos]
+            if self._eof:
+                raise ValueError("Unexpected end of the payload")
+            yield _NEED_MORE
+
+    def _expect(self, chars):
+        c = yield from self._peek()
+        if c not in chars:
+            raise ValueError(f"Expected one of {chars!r} but found {c!r}")
+        self._pos += 1
+        return c
+
+    def _value(self):
+        """Decode the next value, once it is complete."""
+        yield from self._peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._buf, self._pos)
+                # a number at the end of the buffer might not be complete yet
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self._eof:
+                    raise ValueError(f"Invalid payload: {e}")
+            yield _NEED_MORE
+
+    def _skip(self):
+        """Skip the next value without decoding it."""
+        c = yield from self._peek()
+        if c not in '[{"':
+            yield from self._value()
+            return
+        depth, in_string = 0, False
+        while True:
+            buf = self._buf
+            m = _STRUCTURE.search(buf, self._pos)
+            while m is not None:
+                ch, i = m.group(), m.end()
+                if ch == "\\":
+                    if i >= len(buf):
+                        break  # the escaped character is still to come
+                    i += 1
+                elif ch == '"':
+                    in_string = not in_string
+                elif not in_string:
+                    depth += 1 if ch in "[{" else -1
+                self._pos = i
+                if depth == 0 and not in_string:
+                    return
+                m = _STRUCTURE.search(buf, i)
+            else:
+                self._pos = len(buf)
+            if self._eof:
+                raise ValueError("Unexpected end of the payload")
+            yield _NEED_MORE
+
+    def _object(self, handlers):
+        """Parse an object, the values of the keys in `handlers` by them."""
+        yield from self._expect("{")
+        if (yield from self._peek()) == "}":
+            self._pos += 1
+            return
+        while True:
+            key = yield from self._value()
+            yield from self._expect(":")
+            yield from handlers.get(key, self._skip)()
+            if (yield from self._expect(",}")) == "}":
+                return
+
+    def _array(self, item):
+        yield from self._expect("[")
+        if (yield from self._peek()) == "]":
+            self._pos += 1
+            return
+        while True:
+            yield from item()
+            if (yield from self._expect(",]")) == "]":
+                return
+
+    # Payloads
+
+    def _health(self):
+        metrics = lambda: self._array(self._metric)  # noqa: E731
+        yield from self._object(
+            {"data": lambda: self._object({"metrics": metrics}), "metrics": metrics}
+        )
+
+    def _metric(self):
+        # the name usually comes first, otherwise the datapoints are kept until
+        # the name is known
+        metric = {"table": None, "name_seen": False, "pending": []}
+
+        def name():
+            name = yield from self._value()
+            metric["table"], metric["name_seen"] = METRICS.get(name), True
+            if metric["table"] is not None:
+                self._records.extend((metric["table"], r) for r in metric["pending"])
+            metric["pending"] = []
+
+        def datapoint():
+            record = yield from self._value()
+            if metric["table"] is not None:
+                self._records.append((metric["table"], record))
+            elif not metric["name_seen"]:
+                metric["pending"].append(record)
+
+        def data():
+            if metric["name_seen"] and metric["table"] is None:
+                yield from self._skip()
+            else:
+                yield from self._array(datapoint)
+
+        yield from self._object({"name": name, "data": data})
+
+    def _foodlog(self):
+        def meal():
+            record = yield from self._value()
+            self._records.append((h.EAT_TABLE, record))
+
+        yield from self._array(meal)
+
+
+def to_row(table, record):
+    """Row of `table` (a tuple in the order of its columns) from a record.
+
+    The values are checked like the sinks parse them, so that a bad record
+    fails its own request (with a ValueError, KeyError or TypeError) and not
+    the batch it would be written with.
+    """
+    if table == h.SLEEP_TABLE:
+        row = (record["startDate"], record["endDate"], record["value"])
+        ts_start, ts_end = (_parse_date(ts) for ts in row[:2])
+    else:
+        row = tuple(record[c] for c in h.EAT_COLUMNS)
+        if not isinstance(row[0], int) or isinstance(row[0], bool):
+            raise TypeError(f"The id of a meal must be an integer, not {row[0]!r}")
+        ts_start, ts_end = (datetime.fromisoformat(ts) for ts in row[1:3])
+    if not isinstance(row[-1], str):
+        raise TypeError(f"{h.SLEEP_COLUMNS[-1]} must be a string, not {row[-1]!r}")
+    if ts_end < ts_start:
+        raise ValueError(f"Interval ends before it starts: {row}")
+    return row
+
+
+# DATE_FORMAT, matched by hand (`datetime.strptime` is slow)
+_DATE_PATTERN = re.compile(r"(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) ([+-]\d\d)(\d\d)")
+
+
+def _parse_date(ts):
+    match = _DATE_PATTERN.fullmatch(ts)
+    if match is None:
+        raise ValueError(f"time data {ts!r} does not match format {DATE_FORMAT!r}")
+    return datetime.fromisoformat(f"{match[1]}{match[2]}:{match[3]}")
+
+
+class _Stage:
+    """The rows of one request for one table, as csv in a temporary file that
+    is kept in memory up to `STAGE_MEMORY_BYTES`."""
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(
+            STAGE_MEMORY_BYTES, mode="w+", newline=""
+        )
+        self._writer = csv.writer(self.file)
+        self.n_rows = 0
+
+    def add(self, row):
+        self._writer.writerow(row)
+        self.n_rows += 1
+
+    def close(self):
+        self.file.close()
+
+
+# Writing
+# -------
+
+
+class PostgresSink:
+    """Bulk-writes rows with COPY (through a staging table, to skip duplicates)."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def write(self, table, files):
+        """Write the rows of the csv `files` in one transaction."""
+        columns = h.SLEEP_COLUMNS if table == h.SLEEP_TABLE else h.EAT_COLUMNS
+        if table == h.SLEEP_TABLE:
+            insert = f"INSERT INTO {table} SELECT * FROM staging ON CONFLICT DO NOTHING"
+        else:
+            # foodlog has no unique index, so the rows are compared
+            insert = (
+                f"INSERT INTO {table} SELECT DISTINCT * FROM staging s "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE "
+                + " AND ".join(f"t.{c} = s.{c}" for c in columns)
+                + ")"
+            )
+        conn = self.pool.getconn()
+        try:
+            # one transaction (also on autocommit connections), rolled back on errors
+            with conn, conn.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE TEMP TABLE staging (LIKE {table}) ON COMMIT DROP"
+                )
+                for f in files:
+                    cursor.copy_expert(
+                        f"COPY staging ({', '.join(columns)}) FROM STDIN "
+                        "WITH (FORMAT csv)",
+                        f,
+                    )
+                cursor.execute(insert)
+        finally:
+            self.pool.putconn(conn)
+
+
+class StoreSink:
+    """Appends rows to the local interval stores (see `helper.open_interval_store`)."""
+
+    def __init__(self, store_dir=".store"):
+        self.store_dir = store_dir
+
+    def write(self, table, files):
+        """Append the rows of the csv `files`."""
+        if table == h.SLEEP_TABLE:
+            columns, ts_format, value_column = h.SLEEP_COLUMNS, DATE_FORMAT, "value"
+        else:
+            columns, ts_format, value_column = h.EAT_COLUMNS, "ISO8601", "description"
+        # one csv (parsing many small ones is slow), a batch is at most
+        # `Batcher.max_rows` rows or a single request
+        df = pd.read_csv(
+            io.StringIO("".join(f.read() for f in files)),
+            names=columns,
+            header=None,
+            dtype={c: np.int64 if c == "id" else str for c in columns},
+            keep_default_na=False,
+        )
+        for c in ["ts_start", "ts_end"]:
+            df[c] = pd.to_datetime(df[c], format=ts_format, utc=True)
+        h.open_interval_store(self.store_dir, table).append(df, value_column)
+
+
+class Batcher:
+    """Collects the rows of one table across requests and writes them in bulk.
+
+    The rows of a request are put at once, staged in a file (see `_Stage`).
+    They are written once `max_rows` are collected or `max_delay_in_seconds`
+    after the first of them arrived. At most `max_queued_rows` rows wait or are
+    being written: beyond that, `put` blocks, so requests stop being read
+    (backpressure). A larger request is only let through when the queue is
+    empty. Every `put` returns a future that is done once its rows are
+    written, with the exception of the write if it failed.
+    """
+
+    def __init__(
+        self,
+        sink,
+        table,
+        max_rows=10_000,
+        max_delay_in_seconds=1.0,
+        max_queued_rows=100_000,
+    ):
+        self.sink = sink
+        self.table = table
+        self.max_rows = max_rows
+        self.max_delay_in_seconds = max_delay_in_seconds
+        self.max_queued_rows = max_queued_rows
+        self.stats = {"rows_written": 0, "writes": 0, "write_errors": 0}
+        self._items = []  # (stage, future) of every put that waits
+        self._n_queued = 0  # rows that wait or are being written
+        self._changed = asyncio.Condition()
+        self._stopped = False
+
+    async def put(self, stage):
+        """Queue the rows of `stage` (and close it once they are written).
+
+        Returns the future of their write.
+        """
+        async with self._changed:
+            await self._changed.wait_for(
+                lambda: self._stopped
+                or self._n_queued == 0
+                or self._n_queued + stage.n_rows <= self.max_queued_rows
+            )
+            if self._stopped:
+                stage.close()
+                raise RuntimeError(f"The batcher of {self.table} is stopped")
+            future = asyncio.get_running_loop().create_future()
+            self._items.append((stage, future))
+            self._n_queued += stage.n_rows
+            self._changed.notify_all()
+        return future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._items or self._stopped)
+                if not self._items:
+                    return  # stopped and everything is written
+                deadline = loop.time() + self.max_delay_in_seconds
+                while not self._stopped and self._n_rows() < self.max_rows:
+                    try:
+                        await asyncio.wait_for(
+                            self._changed.wait(), deadline - loop.time()
+                        )
+                    except asyncio.TimeoutError:
+                        break
+                # the batch: the first puts up to max_rows (at least one)
+                n_rows, n_items = 0, 0
+                while n_items < len(self._items) and n_rows < self.max_rows:
+                    n_rows += self._items[n_items][0].n_rows
+                    n_items += 1
+                batch, self._items = self._items[:n_items], self._items[n_items:]
+
+            await self._write(batch, n_rows)
+            async with self._changed:
+                self._n_queued -= n_rows
+                self._changed.notify_all()
+
+    async def stop(self):
+        """Write the queued rows and stop, later puts raise a RuntimeError."""
+        async with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+
+    def _n_rows(self):
+        return sum(stage.n_rows for stage, _ in self._items)
+
+    async def _write(self, batch, n_rows):
+        files = [stage.file for stage, _ in batch]
+        for f in files:
+            f.seek(0)
+        try:
+            await asyncio.to_thread(self.sink.write, self.table, files)
+            self.stats["rows_written"] += n_rows
+            self.stats["writes"] += 1
+            error = None
+        except Exception as e:
+            self.stats["write_errors"] += 1
+            logger.exception(f"Writing {n_rows} rows to {self.table} failed")
+            error = e
+        for stage, future in batch:
+            stage.close()
+            if future.done():  # cancelled, the client is gone
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+
+# Server
+# ------
+
+
+class IngestServer:
+    """Asyncio HTTP server for Health Auto Export pushes.
+
+    POST / (or any path but /foodlog) takes a Health Auto Export payload,
+    POST /foodlog a list of meals (with the columns of the foodlog table).
+    The body is parsed while it is read, every record is checked (see
+    `to_row`) and staged in a file of the request (see `_Stage`), so memory
+    doesn't grow with the body. Once the body is complete, the rows are
+    batched across requests (see `Batcher`), and a response is sent once they
+    are written: 200, or 503 if the write failed (so that the client retries).
+    A request with a bad record, or that can't be parsed completely, is
+    answered with 400 and none of its rows are written. GET / returns the
+    stats.
+
+    Args:
+        sink: `PostgresSink` or `StoreSink`.
+        token (str, optional): If set, requests need the header
+            `Authorization: Bearer <token>`. Defaults to None.
+        **batch_kwargs: See `Batcher`.
+    """
+
+    def __init__(self, sink, token=None, **batch_kwargs):
+        self.token = token
+        self.batchers = {
+            t: Batcher(sink, t, **batch_kwargs) for t in [h.SLEEP_TABLE, h.EAT_TABLE]
+        }
+        self.stats = {
+            "requests": 0,
+            "bad_requests": 0,
+            "failed_requests": 0,
+            "records": 0,
+        }
+        self._server = None
+        self._tasks = []
+
+    async def start(self, host="127.0.0.1", port=8080):
+        self._tasks = [asyncio.create_task(b.run()) for b in self.batchers.values()]
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stop accepting requests and write all queued rows."""
+        self._server.close()
+        await self._server.wait_closed()
+        for b in self.batchers.values():
+            await b.stop()
+        await asyncio.gather(*self._tasks)
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                method, path, headers = _parse_head(head)
+                status, body = await self._respond(method, path, headers, reader)
+                # after a bad request, the rest of the body may still be unread
+                keep_alive = (
+                    headers.get("connection", "").lower() != "close" and status != 400
+                )
+                _write_response(writer, status, body, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except asyncio.LimitOverrunError:
+            _write_response(writer, 431, {"error": "Header too large"}, False)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, method, path, headers, reader):
+        if self.token is not None and (
+            headers.get("authorization") != f"Bearer {self.token}"
+        ):
+            await _drain_body(reader, headers)
+            return 401, {"error": "Unauthorized"}
+        if method == "GET":
+            stats = {t: b.stats for t, b in self.batchers.items()}
+            return 200, {**self.stats, **stats}
+        if method != "POST":
+            await _drain_body(reader, headers)
+            return 405, {"error": "Method not allowed"}
+
+        self.stats["requests"] += 1
+        parser = PayloadParser("foodlog" if path.startswith("/foodlog") else "health")
+        # the rows are staged until the whole body is parsed, a bad request
+        # writes none of them
+        stages = {}
+        try:
+            async for text in _iter_body(reader, headers):
+                _stage_rows(stages, parser.feed(text))
+            _stage_rows(stages, parser.close())
+        except BaseException as e:
+            for stage in stages.values():
+                stage.close()
+            if isinstance(e, (ValueError, KeyError, TypeError)):
+                self.stats["bad_requests"] += 1
+                return 400, {"error": str(e)}
+            raise
+
+        n = sum(stage.n_rows for stage in stages.values())
+        try:
+            # the batchers close the stages
+            futures = [await self.batchers[t].put(s) for t, s in stages.items()]
+            await asyncio.gather(*futures)
+        except Exception as e:
+            self.stats["failed_requests"] += 1
+            return 503, {"error": f"Writing the rows failed: {e}"}
+        self.stats["records"] += n
+        return 200, {"records": n}
+
+
+def _stage_rows(stages, records):
+    for table, record in records:
+        if table not in stages:
+            stages[table] = _Stage()
+        stages[table].add(to_row(table, record))
+
+
+def _parse_head(head):
+    lines = head.decode("latin-1").split("\r\n")
+    method, path, _ = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    return method, path, headers
+
+
+async def _iter_body(reader, headers):
+    """Decoded chunks of the body (plain or chunked transfer encoding)."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    n_read = 0
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            if size == 0:
+                await reader.readuntil(b"\r\n")  # (no trailers are sent)
+                break
+            n_read += size
+            if n_read > MAX_BODY_BYTES:
+                raise ValueError("Payload too large")
+            while size > 0:
+                data = await reader.read(min(size, READ_CHUNK_BYTES))
+                if not data:
+                    raise ValueError("Unexpected end of the body")
+                size -= len(data)
+                yield decoder.decode(data)
+            await reader.readexactly(2)
+    else:
+        remaining = int(headers.get("content-length", 0))
+        if remaining > MAX_BODY_BYTES:
+            raise ValueError("Payload too large")
+        while remaining > 0:
+            data = await reader.read(min(remaining, READ_CHUNK_BYTES))
+            if not data:
+                raise ValueError("Unexpected end of the body")
+            remaining -= len(data)
+            yield decoder.decode(data)
+    yield decoder.decode(b"", final=True)
+
+
+async def _drain_body(reader, headers):
+    try:
+        async for _ in _iter_body(reader, headers):
+            pass
+    except ValueError:
+        pass
+
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    405: "Method Not Allowed",
+    431: "Request Header Fields Too Large",
+    503: "Service Unavailable",
+}
+
+
+def _write_response(writer, status, body, keep_alive):
+    body = json.dumps(body).encode()
+    writer.write(
+        f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body
+    )
+
+
+# Main
+# ----
+
+
+async def serve(sink, host="0.0.0.0", port=8080, token=None, **batch_kwargs):
+    server = IngestServer(sink, token=token, **batch_kwargs)
+    port = await server.start(host, port)
+    logger.info(f"Listening on {host}:{port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Ingest Health Auto Export pushes")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--store-dir", help="write to the interval stores instead of Postgres"
+    )
+    parser.add_argument("--max-rows", type=int, default=10_000)
+    parser.add_argument("--max-delay", type=float, default=1.0)
+    parser.add_argument("--max-queued-rows", type=int, default=100_000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.store_dir is not None:
+        sink = StoreSink(args.store_dir)
+    else:
+        sink = PostgresSink(h.get_client("postgres").pool)
+    asyncio.run(
+        serve(
+            sink,
+            args.host,
+            args.port,
+            token=os.environ.get("INGEST_TOKEN"),
+            max_rows=args.max_rows,
+            max_delay_in_seconds=args.max_delay,
+            max_queued_rows=args.max_queued_rows,
+        )
+    )
@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+from interval_store import to_epoch_ns
+
+# Interval index
+# --------------
+#
+# Per kind of interval (e.g. sleep sessions), the intervals are kept sorted by
+# start together with the running maximum of their ends (and the position of
+# the interval reaching that far). An interval containing t, if any, is then
+# found with one binary search: among the intervals starting at or before t,
+# the one that ends last contains t if anything does.
+#
+# Appends overwrite the tail from the first new start on, so the running
+# maximum only needs to be extended from there.
+
+_NO_END = np.iinfo(np.int64).min
+
+
+class IntervalIndex:
+    """Point-in-time queries over intervals of several kinds.
+
+    An interval [ts_start, ts_end) contains the timestamps from its start up to
+    (excluding) its end. Positions refer to the intervals of a kind sorted by
+    start, i.e. to the rows of the frame the index was built from if that was
+    sorted by ts_start (like the session frames of the pipeline).
+    """
+
+    def __init__(self):
+        self._kinds = {}
+
+    @classmethod
+    def from_frames(cls, **dfs):
+        """Index the ts_start and ts_end columns of every frame, the keywords are
+        the kinds, e.g. `IntervalIndex.from_frames(sleep=df_sleep_sessions)`."""
+        index = cls()
+        for kind, df in dfs.items():
+            index.append(kind, df.ts_start, df.ts_end)
+        return index
+
+    @property
+    def kinds(self):
+        return list(self._kinds)
+
+    def __len__(self):
+        return sum(k["n"] for k in self._kinds.values())
+
+    def __eq__(self, other):
+        if not isinstance(other, IntervalIndex) or self.kinds != other.kinds:
+            return False
+        return all(
+            np.array_equal(self._column(kind, c), other._column(kind, c))
+            for kind in self.kinds
+            for c in ["start", "end"]
+        )
+
+    def copy(self):
+        index = IntervalIndex()
+        index._kinds = {
+            kind: {**k, **{c: k[c].copy() for c in _COLUMNS}}
+            for kind, k in self._kinds.items()
+        }
+        return index
+
+    # Writing
+    # -------
+
+    def append(self, kind, ts_start, ts_end, pos=None):
+        """Add intervals of `kind`, replacing the stored ones from `pos` on.
+
+        By default, the stored intervals starting after the earliest new start
+        are replaced. Pass `pos` to keep exactly the first `pos` ones,
+        e.g. the sessions before a cut (see `pipeline.update_pipeline`). Costs
+        O(log n + new intervals), amortized.
+
+        Raises:
+            ValueError: If a new interval starts before a kept one.
+        """
+        start, end = to_epoch_ns(ts_start), to_epoch_ns(ts_end)
+        order = np.argsort(start, kind="stable")
+        start, end = start[order], end[order]
+        if kind not in self._kinds:
+            self._kinds[kind] = {"n": 0, **{c: np.empty(0, np.int64) for c in _COLUMNS}}
+        k = self._kinds[kind]
+        stored = self._column(kind, "start")
+        if pos is None:
+            pos = (
+                int(np.searchsorted(stored, start[0], "right"))
+                if len(start) > 0
+                else k["n"]
+            )
+        pos = min(pos, k["n"])
+        if len(start) > 0 and pos > 0 and start[0] < stored[pos - 1]:
+            raise ValueError(f"New {kind} intervals start before the kept ones")
+
+        n = pos + len(start)
+        if n > len(k["start"]):  # grow the capacity geometrically
+            capacity = max(n, 2 * len(k["start"]), 16)
+            for c in _COLUMNS:
+                k[c] = np.concatenate([k[c][:pos], np.empty(capacity - pos, np.int64)])
+        k["start"][pos:n], k["end"][pos:n] = start, end
+
+        # running maximum of the ends (and its position) from pos on
+        max_end = np.maximum.accumulate(
+            np.concatenate([k["max_end"][pos - 1 : pos] if pos > 0 else [_NO_END], end])
+        )[1:]
+        argmax_end = np.maximum.accumulate(
+            np.concatenate(
+                [
+                    k["argmax_end"][pos - 1 : pos] if pos > 0 else [-1],
+                    np.where(end >= max_end, np.arange(pos, n), -1),
+                ]
+            )
+        )[1:]
+        k["max_end"][pos:n], k["argmax_end"][pos:n] = max_end, argmax_end
+        k["n"] = n
+
+    # Queries
+    # -------
+
+    def find(self, kind, ts):
+        """Position of an interval of `kind` containing `ts` (-1 if none).
+
+        `ts` is a timestamp or an array of them (naive ones are UTC), the
+        result an int or an int array. O(log n) per timestamp.
+        """
+        t = np.atleast_1d(to_epoch_ns(ts))
+        start = self._column(kind, "start")
+        if len(start) == 0:
+            pos = np.full(len(t), -1)
+        else:
+            i = np.searchsorted(start, t, side="right") - 1
+            i_valid = np.maximum(i, 0)
+            found = (i >= 0) & (self._column(kind, "max_end")[i_valid] > t)
+            pos = np.where(found, self._column(kind, "argmax_end")[i_valid], -1)
+        return int(pos[0]) if np.ndim(ts) == 0 else pos
+
+    def contains(self, kind, ts):
+        """Whether an interval of `kind` contains `ts` (a bool or a bool array)."""
+        pos = self.find(kind, ts)
+        return pos >= 0
+
+    def state_at(self, ts):
+        """Data frame with one row per timestamp and one bool column per kind."""
+        index = pd.DatetimeIndex(np.atleast_1d(ts), name="ts")
+        return pd.DataFrame(
+            {kind: self.contains(kind, index) for kind in self.kinds}, index=index
+        )
+
+    def interval(self, kind, pos):
+        """ts_start and ts_end (UTC) of the interval of `kind` at `pos`."""
+        return tuple(
+            pd.Timestamp(self._column(kind, c)[pos], tz="UTC") for c in ["start", "end"]
+        )
+
+    def last_end(self, kind):
+        """The latest end of all intervals of `kind` (UTC), None if there are none."""
+        max_end = self._column(kind, "max_end")
+        return pd.Timestamp(max_end[-1], tz="UTC") if len(max_end) > 0 else None
+
+    def _column(self, kind, c):
+        k = self._kinds[kind]
+        return k[c][: k["n"]]
+
+
+_COLUMNS = ["start", "end", "max_end", "argmax_end"]
@@ -0,0 +1,255 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# Interval store
+# --------------
+#
+# A directory with one flat binary file per column and a small json file with
+# the metadata:
+#
+#   ts_start.bin  int64, epoch ns (UTC), sorted
+#   ts_end.bin    int64, epoch ns (UTC)
+#   code.bin      small int, index into the categories (e.g. sleep stage)
+#   <extra>.bin   int64, optional extra columns (e.g. the id of a meal)
+#   meta.json     dtypes, categories and the longest interval
+#
+# The column files are memory-mapped for reading, so slicing a time range only
+# touches the pages of that range. Writes only ever append to (or truncate and
+# rewrite the tail of) the column files.
+
+
+class IntervalStore:
+    """Memory-mapped, append-only store of time intervals with a category.
+
+    Args:
+        path (str): Directory of the store, created if it doesn't exist.
+        code_dtype (str, optional): Dtype of the category codes of a new store.
+            Defaults to "int16".
+        extra_columns (tuple, optional): Additional int64 columns of a new
+            store. Defaults to ().
+    """
+
+    def __init__(self, path, code_dtype="int16", extra_columns=()):
+        self.path = path
+        fp = os.path.join(path, "meta.json")
+        if os.path.exists(fp):
+            with open(fp, "r") as f:
+                self.meta = json.load(f)
+        else:
+            os.makedirs(path, exist_ok=True)
+            dtypes = {"ts_start": "int64", "ts_end": "int64", "code": code_dtype}
+            dtypes.update({c: "int64" for c in extra_columns})
+            self.meta = {"dtypes": dtypes, "categories": [], "max_duration_ns": 0}
+            self._write_meta()
+
+    @property
+    def columns(self):
+        return list(self.meta["dtypes"])
+
+    @property
+    def categories(self):
+        return self.meta["categories"]
+
+    def __len__(self):
+        # a row only counts once all of its columns have been written
+        return min(
+            (
+                os.path.getsize(self._fp(c)) // np.dtype(dtype).itemsize
+                if os.path.exists(self._fp(c))
+                else 0
+            )
+            for c, dtype in self.meta["dtypes"].items()
+        )
+
+    # Reading
+    # -------
+
+    def arrays(self, ts_from=None, ts_to=None):
+        """Columns of all intervals that overlap [ts_from, ts_to).
+
+        Returns a dict of numpy arrays, which are read-only views into the
+        memory-mapped files as long as no filtering on `ts_end` is needed. The
+        views must not be used after an `append` that rewrote the tail.
+        """
+        n = len(self)
+        cols = {c: self._memmap(c, n) for c in self.columns}
+        if n == 0:
+            return cols
+
+        # ts_start is sorted, so the range is found by binary search (which only
+        # touches a few pages of the file). Intervals starting up to the longest
+        # duration before ts_from can still overlap it.
+        i0, i1 = 0, n
+        if ts_from is not None:
+            t = to_epoch_ns(ts_from)
+            i0 = np.searchsorted(
+                cols["ts_start"], t - self.meta["max_duration_ns"], side="left"
+            )
+        if ts_to is not None:
+            i1 = np.searchsorted(cols["ts_start"], to_epoch_ns(ts_to), side="left")
+        cols = {c: v[i0:i1] for c, v in cols.items()}
+
+        if ts_from is not None:
+            mask = cols["ts_end"] >= to_epoch_ns(ts_from)
+            if not mask.all():
+                cols = {c: v[mask] for c, v in cols.items()}
+        return cols
+
+    def read(self, ts_from=None, ts_to=None):
+        """Intervals that overlap [ts_from, ts_to) as a data frame.
+
+        Columns ts_start and ts_end (UTC), value (the category) and the extra
+        columns.
+        """
+        # copy, so that the frame doesn't depend on the mapped files
+        cols = {c: np.array(v) for c, v in self.arrays(ts_from, ts_to).items()}
+        df = pd.DataFrame(
+            {
+                "ts_start": _from_ns(cols["ts_start"]),
+                "ts_end": _from_ns(cols["ts_end"]),
+                "value": np.array(self.categories, dtype=object)[cols["code"]],
+            }
+        )
+        for c in self.columns[3:]:
+            df[c] = cols[c]
+        return df
+
+    # Writing
+    # -------
+
+    def append(self, df, value_column="value"):
+        """Append intervals (with columns ts_start, ts_end, value and extras).
+
+        Intervals that start after the last stored one are appended. If some
+        start earlier (e.g. late arrivals when re-syncing an overlapping
+        window), the stored tail from the earliest of them on is merged with
+        the new intervals, deduplicated, and rewritten. Returns the number of
+        intervals that were added.
+        """
+        if len(df) == 0:
+            return 0
+        n = len(self)
+        self._truncate(n)  # drop partially written rows
+
+        # encode the new intervals
+        cols = {
+            "ts_start": to_epoch_ns(df["ts_start"]),
+            "ts_end": to_epoch_ns(df["ts_end"]),
+            "code": self._encode(df[value_column]),
+        }
+        cols.update({c: df[c].to_numpy(dtype=np.int64) for c in self.columns[3:]})
+
+        # merge with the stored tail that overlaps the new intervals
+        i0 = n
+        if n > 0:
+            i0 = int(
+                np.searchsorted(
+                    self._memmap("ts_start", n), cols["ts_start"].min(), side="left"
+                )
+            )
+        if i0 < n:
+            cols = {
+                c: np.concatenate([self._memmap(c, n)[i0:], v]) for c, v in cols.items()
+            }
+
+        # sort and drop duplicates (which are neighbors after sorting)
+        order = np.lexsort([cols[c] for c in reversed(self.columns)])
+        cols = {c: v[order] for c, v in cols.items()}
+        is_duplicate = np.ones(len(order) - 1, dtype=bool)
+        for v in cols.values():
+            is_duplicate &= v[1:] == v[:-1]
+        keep = np.concatenate([[True], ~is_duplicate])
+        cols = {c: v[keep] for c, v in cols.items()}
+
+        # update the metadata first, codes and durations must be known to
+        # readers before rows referring to them become visible
+        duration = int((cols["ts_end"] - cols["ts_start"]).max())
+        self.meta["max_duration_ns"] = max(self.meta["max_duration_ns"], duration)
+        self._write_meta()
+
+        self._truncate(i0)
+        # ts_start last, it is the column that makes rows visible
+        for c in self.columns[1:] + ["ts_start"]:
+            dtype = self.meta["dtypes"][c]
+            with open(self._fp(c), "ab") as f:
+                f.write(cols[c].astype(dtype).tobytes())
+
+        return len(cols["ts_start"]) - (n - i0)
+
+    def last_ts_start(self):
+        """Start of the last interval, None for an empty store."""
+        n = len(self)
+        if n == 0:
+            return None
+        return _from_ns(self._memmap("ts_start", n)[-1:])[0]
+
+    # Internals
+    # ---------
+
+    def _fp(self, column):
+        return os.path.join(self.path, f"{column}.bin")
+
+    def _memmap(self, column, n):
+        dtype = self.meta["dtypes"][column]
+        if n == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self._fp(column), dtype=dtype, mode="r", shape=(n,))
+
+    def _truncate(self, n):
+        for c, dtype in self.meta["dtypes"].items():
+            with open(self._fp(c), "ab") as f:
+                f.truncate(n * np.dtype(dtype).itemsize)
+
+    def _encode(self, values):
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        categories = self.meta["categories"]
+        lookup = {v: i for i, v in enumerate(categories)}
+        for v in uniques:
+            if v not in lookup:
+                lookup[v] = len(categories)
+                categories.append(v)
+        max_code = np.iinfo(self.meta["dtypes"]["code"]).max
+        if len(categories) - 1 > max_code:
+            raise ValueError(
+                f"More than {max_code + 1} categories in {self.path}, "
+                "use a larger code_dtype."
+            )
+        return np.array([lookup[v] for v in uniques], dtype=np.int64)[codes]
+
+    def _write_meta(self):
+        fp = os.path.join(self.path, "meta.json")
+        with open(fp + ".tmp", "w") as f:
+            json.dump(self.meta, f)
+        os.replace(fp + ".tmp", fp)
+
+
+def to_epoch_ns(ts):
+    """Timestamp(s) as int64 nanoseconds since epoch (naive ones are UTC).
+
+    `ts` is a timestamp (returns an int) or a series, index or array of them
+    (returns an int64 array, NaT becomes the minimum int64).
+    """
+    if np.ndim(ts) == 0:
+        ts = pd.Timestamp(ts)
+        if ts.tz is None:
+            ts = ts.tz_localize("UTC")
+        return ts.value
+    if isinstance(ts, (pd.Series, pd.Index)) and (
+        ts.dtype == "datetime64[ns]"
+        or (isinstance(ts.dtype, pd.DatetimeTZDtype) and ts.dtype.unit == "ns")
+    ):
+        # stored as such already (aware ones in UTC), much cheaper than building
+        # and converting an index on the few rows of an incremental update
+        return ts.array.asi8
+    index = pd.DatetimeIndex(ts)
+    if index.tz is None:
+        index = index.tz_localize("UTC")
+    return index.tz_convert("UTC").as_unit("ns").asi8
+
+
+def _from_ns(values):
+    return pd.DatetimeIndex(
+        np.asarray(values, dtype=np.int64).view("datetime64[ns]")
+    ).tz_localize("UTC")
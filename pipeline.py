@@ -0,0 +1,536 @@
+import numpy as np
+import pandas as pd
+import helper as h
+from interval_index import IntervalIndex
+from interval_store import to_epoch_ns
+from profiling import profiled
+
+# The sleep sessions are built with fixed parameters, see `run_pipeline`.
+SLEEP_SESSION_KWARGS = dict(
+    min_gap_between_sessions_in_minutes=30,
+    min_duration_of_session_in_minutes=60,
+    add_sleep_duration_in_hours=True,
+)
+
+# Parts of the result that are computed in UTC and don't depend on the timezone
+SESSION_KEYS = [
+    "df_sleep",
+    "df_sleep_sessions",
+    "df_eat",
+    "df_eat_sessions",
+    "df_deep_fast_sessions",
+    "df_first_and_last_meal",
+    "index",
+]
+
+
+# Full pipeline
+# -------------
+
+
+@profiled
+def run_pipeline(
+    df_sleep,
+    df_eat,
+    tz="UTC",
+    target_delta_fasting=4,
+    target_delta_first_meal=1,
+    target_delta_last_meal=3,
+    target_delta_sleep=7,
+    rolling_window_days=7,
+    gamma=1,
+    dt_deep_fast_in_hours=12,
+    min_gap_between_sessions_in_minutes=60 * 12,
+    ts_now=None,
+    scores_only=False,
+):
+    """Compute all frames of the dashboard from the raw sleep and eat data.
+
+    Returns a dict with the raw, session, visualization, daily and score
+    frames (see `app.load_data`). The parameters are kept under "params", so
+    that the result can be updated with `update_pipeline` once new data
+    arrives.
+
+    Args:
+        df_sleep (pd.DataFrame): Sleep stage intervals.
+        df_eat (pd.DataFrame): Meals.
+        tz (str, optional): Timezone of the daily frames. Defaults to "UTC".
+        target_delta_* , rolling_window_days, gamma: See `helper.calculate_score`.
+        dt_deep_fast_in_hours (int, optional): Time after the last meal after
+            which deep fasting starts. Defaults to 12.
+        min_gap_between_sessions_in_minutes (int, optional): Gap that separates
+            two eat sessions. Defaults to 60 * 12.
+        ts_now (pd.Timestamp, optional): End of the ongoing deep fast session.
+            Defaults to now.
+        scores_only (bool, optional): Skip the visualization frames, e.g. when
+            only the scores are needed. Such a result can't be passed to
+            `update_pipeline`. Defaults to False.
+    """
+    params = dict(
+        tz=tz,
+        target_delta_fasting=target_delta_fasting,
+        target_delta_first_meal=target_delta_first_meal,
+        target_delta_last_meal=target_delta_last_meal,
+        target_delta_sleep=target_delta_sleep,
+        rolling_window_days=rolling_window_days,
+        gamma=gamma,
+        dt_deep_fast_in_hours=dt_deep_fast_in_hours,
+        min_gap_between_sessions_in_minutes=min_gap_between_sessions_in_minutes,
+    )
+    df_sleep, df_eat = _sort_by_time(df_sleep), _sort_by_time(df_eat)
+
+    # sessions (timezone independent)
+    df_sleep_sessions = h.identify_sessions(df_sleep, **SLEEP_SESSION_KWARGS)
+    df_eat_sessions = h.identify_sessions(
+        df_eat,
+        min_gap_between_sessions_in_minutes=min_gap_between_sessions_in_minutes,
+        min_duration_of_session_in_minutes=0,
+    )
+    df_deep_fast_sessions = h.evaluate_deep_fast_sessions(
+        df_eat_sessions, dt_deep_fast_in_hours, ts_now=ts_now
+    )
+    df_first_and_last_meal = h.evaluate_delta_to_first_and_last_meal(
+        df_sleep_sessions, df_eat
+    )
+
+    # point-in-time queries (e.g. the current state in the app)
+    index = IntervalIndex.from_frames(
+        sleep=df_sleep_sessions, eat=df_eat_sessions, deep_fast=df_deep_fast_sessions
+    )
+
+    return _run_view(
+        {
+            "df_sleep": df_sleep,
+            "df_sleep_sessions": df_sleep_sessions,
+            "df_eat": df_eat,
+            "df_eat_sessions": df_eat_sessions,
+            "df_deep_fast_sessions": df_deep_fast_sessions,
+            "df_first_and_last_meal": df_first_and_last_meal,
+            "index": index,
+        },
+        params,
+        scores_only,
+    )
+
+
+@profiled
+def localize(ret, tz):
+    """View of a result of `run_pipeline` (or `update_pipeline`) in timezone `tz`.
+
+    Only the visualization, daily and score frames depend on the timezone. The
+    sessions of `ret` are shared (not copied) with the returned view, so every
+    additional timezone only costs these frames.
+    """
+    if tz == ret["params"]["tz"]:
+        return ret
+    return _run_view({k: ret[k] for k in SESSION_KEYS}, {**ret["params"], "tz": tz})
+
+
+def _run_view(frames, params, scores_only=False):
+    tz = params["tz"]
+
+    daily = _daily_cube(frames, tz)
+    # the app styles the debug frames it shows (see `helper.style_debug_frame`)
+    df_score, debug_info = h.calculate_score(
+        daily, style=False, **_score_kwargs(params)
+    )
+    if scores_only:
+        return {
+            **frames,
+            "daily": daily,
+            "df_score": df_score,
+            "debug_info": debug_info,
+            "params": params,
+        }
+
+    return {
+        **frames,
+        "df_sleep_sessions_viz": h.process_for_visualization(
+            frames["df_sleep_sessions"], tz
+        ),
+        "df_eat_viz": h.process_for_visualization(frames["df_eat"], tz),
+        "df_eat_sessions_viz": h.process_for_visualization(
+            frames["df_eat_sessions"], tz
+        ),
+        "df_deep_fast_sessions_viz": h.process_for_visualization(
+            frames["df_deep_fast_sessions"], tz
+        ),
+        "daily": daily,
+        "df_score": df_score,
+        "debug_info": debug_info,
+        "params": params,
+    }
+
+
+def _sort_by_time(df):
+    if not _is_sorted_by_time(df):
+        return df.sort_values(
+            ["ts_start", "ts_end", "value"], kind="stable", ignore_index=True
+        )
+    return df.reset_index(drop=True)  # a copy, like the sorted frame
+
+
+def _is_sorted_by_time(df):
+    """Whether `df` is sorted like `_sort_by_time` sorts it (e.g. new rows are
+    usually appended), which is much cheaper to check than to sort."""
+    start, end, value = df.ts_start.values, df.ts_end.values, df.value.values
+    in_order = start[1:] > start[:-1]
+    tie = start[1:] == start[:-1]
+    in_order |= tie & (end[1:] > end[:-1])
+    tie &= end[1:] == end[:-1]
+    i = np.flatnonzero(tie)
+    try:
+        in_order[i] |= value[i + 1] >= value[i]
+    except TypeError:  # e.g. missing values, left to sort_values
+        return False
+    return bool(in_order.all())
+
+
+def _daily_cube(frames, tz):
+    return h.daily_cube(
+        frames["df_deep_fast_sessions"],
+        frames["df_first_and_last_meal"],
+        frames["df_sleep_sessions"],
+        tz,
+    )
+
+
+def _score_kwargs(params):
+    return {
+        k: params[k]
+        for k in [
+            "target_delta_fasting",
+            "target_delta_first_meal",
+            "target_delta_last_meal",
+            "target_delta_sleep",
+            "rolling_window_days",
+            "gamma",
+        ]
+    }
+
+
+# Tail of the history
+# -------------------
+
+# Complete days a tail needs before the window of the latest scores
+TAIL_MARGIN_DAYS = 2
+
+
+def covers_current_scores(ret, margin_days=TAIL_MARGIN_DAYS):
+    """Whether a result computed from a tail of the history only (see
+    `helper.load_tail_from_supabase`) has the current scores of the whole
+    history.
+
+    The first days of a tail can lack sessions (or meals) that started before
+    it, so every metric needs `margin_days` days before the window of its
+    latest score.
+    """
+    n_days = ret["params"]["rolling_window_days"] + margin_days
+    has_value = ~np.isnan(ret["daily"]["delta_in_hours"])
+    for c in has_value.T:
+        days = np.flatnonzero(c)
+        if len(days) == 0 or days[-1] - days[0] + 1 < n_days:
+            return False
+    return True
+
+
+# Incremental updates
+# -------------------
+
+
+# Marks that the raw data didn't change (see `_earliest_change`)
+_NO_CHANGE = pd.Timestamp.max.tz_localize("UTC")
+
+# The timestamps by which `helper.daily_cube` assigns the rows of the session
+# frames to days
+_DAY_COLUMNS = {
+    "df_deep_fast_sessions": ["ts_end"],
+    "df_first_and_last_meal": ["ts_start_first_meal_after", "ts_end_last_meal_before"],
+    "df_sleep_sessions": ["ts_end"],
+}
+
+
+@profiled
+def update_pipeline(ret, df_sleep, df_eat, ts_now=None, **params):
+    """Update the result of `run_pipeline` to new raw sleep and eat data.
+
+    Only the parts that depend on new, changed or removed intervals are
+    recomputed: the sessions from the last session that starts before the
+    earliest change, the meal deltas of the sleep sessions whose nearest meals
+    may have changed, the visualization segments of these rows, and the daily
+    metrics and scores from the first (local) day of a changed row (plus the
+    tail of the rolling windows). Everything else is taken from `ret`. The
+    result is identical to `run_pipeline(df_sleep, df_eat, ...)`, and is `ret`
+    itself if nothing changed (e.g. if only `ts_now` moved on while no deep
+    fast is ongoing).
+
+    Changes deep in the history are supported, but cost about as much as a
+    full recompute of everything after them. Falls back to `run_pipeline`
+    when the parameters differ from those of `ret`.
+
+    Args:
+        ret (dict): Previous result of `run_pipeline` or `update_pipeline`.
+        df_sleep (pd.DataFrame): All sleep stage intervals (not only new ones),
+            e.g. `ret["df_sleep"]` if they didn't change (which skips comparing
+            them).
+        df_eat (pd.DataFrame): All meals (not only new ones), as `df_sleep`.
+        ts_now (pd.Timestamp, optional): See `run_pipeline`.
+        **params: Parameters of `run_pipeline`. Defaults to the ones of `ret`.
+    """
+    params = {**ret["params"], **params}
+    if params != ret["params"]:
+        return run_pipeline(df_sleep, df_eat, ts_now=ts_now, **params)
+
+    tz = params["tz"]
+    if df_sleep is not ret["df_sleep"]:
+        df_sleep = _sort_by_time(df_sleep)
+    if df_eat is not ret["df_eat"]:
+        df_eat = _sort_by_time(df_eat)
+
+    # find the last session that starts before the earliest change of its input
+    t0_sleep = _earliest_change(ret["df_sleep"], df_sleep)
+    t0_eat = _earliest_change(ret["df_eat"], df_eat)
+    pos_sleep = _session_cut(ret["df_sleep_sessions"], t0_sleep)
+    pos_eat = _session_cut(ret["df_eat_sessions"], t0_eat)
+    if pos_sleep is None or pos_eat is None or pos_eat == 0:
+        return run_pipeline(df_sleep, df_eat, ts_now=ts_now, **params)
+
+    new = {"df_sleep": df_sleep, "df_eat": df_eat}
+
+    # sessions: re-sessionize the raw data from the cut on
+    new["df_sleep_sessions"] = _update_sessions(
+        ret["df_sleep_sessions"], df_sleep, pos_sleep, **SLEEP_SESSION_KWARGS
+    )
+    new["df_eat_sessions"] = _update_sessions(
+        ret["df_eat_sessions"],
+        df_eat,
+        pos_eat,
+        min_gap_between_sessions_in_minutes=params[
+            "min_gap_between_sessions_in_minutes"
+        ],
+        min_duration_of_session_in_minutes=0,
+    )
+
+    # deep fast sessions: also recompute the one before the cut, as it ends
+    # with the start of the first recomputed eat session (or with ts_now)
+    label = ret["df_eat_sessions"].index[pos_eat - 1]
+    n_deep_fast = int(ret["df_deep_fast_sessions"].index.searchsorted(label))
+    df_deep_fast_tail = h.evaluate_deep_fast_sessions(
+        new["df_eat_sessions"].iloc[pos_eat - 1 :],
+        params["dt_deep_fast_in_hours"],
+        ts_now=ts_now,
+    )
+    if t0_sleep == t0_eat == _NO_CHANGE and df_deep_fast_tail.equals(
+        ret["df_deep_fast_sessions"].iloc[n_deep_fast:]
+    ):
+        return ret
+    new["df_deep_fast_sessions"] = pd.concat(
+        [ret["df_deep_fast_sessions"].iloc[:n_deep_fast], df_deep_fast_tail]
+    )
+
+    # interval index: replace the recomputed sessions, the result is not shared
+    # with ret
+    new["index"] = ret["index"].copy()
+    for kind, key, n in [
+        ("sleep", "df_sleep_sessions", pos_sleep),
+        ("eat", "df_eat_sessions", pos_eat),
+        ("deep_fast", "df_deep_fast_sessions", n_deep_fast),
+    ]:
+        df_tail = new[key].iloc[n:]
+        new["index"].append(kind, df_tail.ts_start, df_tail.ts_end, pos=n)
+
+    # meal deltas: a sleep session before the cut keeps its nearest meals if
+    # the meals didn't change, or if it ends before an unchanged meal (all
+    # meals before that one are unchanged, too), the ones from the first other
+    # session on are recomputed
+    df_meals = ret["df_first_and_last_meal"]
+    n_eat = int(df_eat.ts_start.searchsorted(t0_eat))  # the unchanged meals
+    keep = np.arange(len(df_meals)) < pos_sleep
+    if t0_eat != _NO_CHANGE and n_eat == 0:
+        keep[:] = False
+    elif t0_eat != _NO_CHANGE:
+        keep &= (df_meals.ts_end < df_eat.ts_start.iloc[n_eat - 1]).to_numpy()
+    n_meals = int(np.argmin(keep)) if not keep.all() else len(keep)
+    if n_meals == len(df_meals) == len(new["df_sleep_sessions"]):
+        new["df_first_and_last_meal"] = df_meals
+    else:
+        new["df_first_and_last_meal"] = pd.concat(
+            [
+                df_meals.iloc[:n_meals],
+                h.evaluate_delta_to_first_and_last_meal(
+                    new["df_sleep_sessions"].iloc[n_meals:], df_eat
+                ),
+            ]
+        )
+
+    # visualization segments: keep the segments of the unchanged leading rows
+    # (counted on the recomputed rows of ret, which are few)
+    n_unchanged = {
+        "df_sleep_sessions": pos_sleep,
+        "df_eat": n_eat,
+        "df_eat_sessions": pos_eat,
+        "df_deep_fast_sessions": n_deep_fast,
+        "df_first_and_last_meal": n_meals,
+    }
+    for key in [
+        "df_sleep_sessions",
+        "df_eat",
+        "df_eat_sessions",
+        "df_deep_fast_sessions",
+    ]:
+        n, df_viz = n_unchanged[key], ret[f"{key}_viz"]
+        if n == len(ret[key]) == len(new[key]):
+            new[f"{key}_viz"] = df_viz
+            continue
+        n_segments = len(df_viz) - h.count_day_segments(ret[key].iloc[n:], tz)
+        new[f"{key}_viz"] = pd.concat(
+            [
+                df_viz.iloc[:n_segments],
+                h.process_for_visualization(new[key].iloc[n:], tz),
+            ],
+            ignore_index=True,
+        )
+
+    # daily metrics from the first day of a changed row on, the scores from
+    # the first day that changed, with enough history for the rolling window
+    # (and for the debug info, the last days of every metric)
+    new["daily"] = _update_daily(ret, new, n_unchanged, tz)
+    pos = _first_changed_day(ret["daily"], new["daily"])
+    if pos is None:
+        new["df_score"], new["debug_info"] = ret["df_score"], ret["debug_info"]
+    else:
+        w = params["rolling_window_days"] - 1
+        has_value = ~np.isnan(new["daily"]["delta_in_hours"])
+        last = [np.flatnonzero(c)[-1] for c in has_value.T if c.any()]
+        start = max(min([pos] + [p - w for p in last]) - w, 0)
+        df_score, new["debug_info"] = h.calculate_score(
+            {k: v[start:] for k, v in new["daily"].items()},
+            style=False,
+            **_score_kwargs(params),
+        )
+        # one row per day of the calendar, which starts on the same day
+        new["df_score"] = pd.concat(
+            [ret["df_score"].iloc[:pos], df_score.iloc[pos - start :]],
+            ignore_index=True,
+        )
+
+    new["params"] = params
+    return {k: new[k] for k in ret}
+
+
+def _earliest_change(df_old, df_new):
+    """Lower bound of the `ts_start` of all rows that were added, changed or removed.
+
+    Both frames are sorted by time (see `_sort_by_time`), so all rows before
+    the first position at which they differ are unchanged. `_NO_CHANGE` if
+    they are equal.
+    """
+    if df_new is df_old:
+        return _NO_CHANGE
+    n = min(len(df_old), len(df_new))
+    differs = np.zeros(n, dtype=bool)
+    for c in ["ts_start", "ts_end", "value"]:
+        differs |= df_old[c].values[:n] != df_new[c].values[:n]
+    pos = np.flatnonzero(differs)
+    pos = pos[0] if len(pos) > 0 else n
+    ts = [
+        df.ts_start.iloc[pos]
+        for df in [df_old, df_new]
+        if pos < len(df) and not pd.isna(df.ts_start.iloc[pos])
+    ]
+    return min(ts, default=_NO_CHANGE)
+
+
+def _session_cut(df_sessions, t0):
+    """Position of the last session that starts before `t0`.
+
+    The boundary in front of this session only depends on rows before `t0`,
+    so sessionizing the rows from its start on gives the same sessions. The
+    number of sessions if nothing changed, None if no session starts before
+    `t0`.
+    """
+    if t0 == _NO_CHANGE:
+        return len(df_sessions)
+    pos = int(df_sessions.ts_start.searchsorted(t0)) - 1
+    return pos if pos >= 0 else None
+
+
+def _update_sessions(df_sessions, df, pos, **kwargs):
+    if pos == len(df_sessions):
+        return df_sessions
+    start = int(df.ts_start.searchsorted(df_sessions.ts_start.iloc[pos]))
+    df_new = h.identify_sessions(
+        df.iloc[start:], first_session=df_sessions.index[pos], **kwargs
+    )
+    return pd.concat([df_sessions.iloc[:pos], df_new])
+
+
+def _update_daily(ret, new, n_unchanged, tz):
+    """`daily_cube` of the session frames of `new`, of which the first
+    `n_unchanged[key]` rows are the same as in `ret`.
+
+    Only the days from the first day of a changed (or removed) row on are
+    recomputed, from the rows on these days.
+    """
+    ts_changed = min(
+        _min_ns(df[c].iloc[n_unchanged[key] :])
+        for key, columns in _DAY_COLUMNS.items()
+        for df in [ret[key], new[key]]
+        for c in columns
+    )
+    if ts_changed == _NO_CHANGE.value:
+        return ret["daily"]
+    date = pd.Timestamp(ts_changed, tz="UTC").tz_convert(tz)
+    date = date.tz_localize(None).normalize()
+    # the rows on or after that day (and maybe the day before, the offset of
+    # a timezone is less than a day)
+    ns_from = to_epoch_ns(date - pd.Timedelta(days=1))
+    daily_tail = h.daily_cube(
+        *[
+            _rows_from(new[key], columns, ns_from)
+            for key, columns in _DAY_COLUMNS.items()
+        ],
+        tz,
+    )
+    daily = h.splice_daily_cube(ret["daily"], daily_tail, date)
+    return daily if daily is not None else _daily_cube(new, tz)
+
+
+def _min_ns(ser):
+    """Earliest timestamp of `ser` in nanoseconds (`_NO_CHANGE` if there is none)."""
+    ns = to_epoch_ns(ser)
+    return ns[ns != pd.NaT.value].min(initial=_NO_CHANGE.value)
+
+
+def _rows_from(df, columns, ns):
+    """The rows from the first one with a timestamp at or after `ns` on.
+
+    Rows in between that are before `ns` are on earlier days, which
+    `helper.splice_daily_cube` doesn't take from the tail.
+    """
+    is_after = np.zeros(len(df), dtype=bool)
+    for c in columns:
+        is_after |= to_epoch_ns(df[c]) >= ns
+    pos = np.flatnonzero(is_after)
+    return df.iloc[pos[0] if len(pos) > 0 else len(df) :]
+
+
+def _first_changed_day(daily_old, daily_new):
+    """Position of the first day of `daily_new` that differs from `daily_old`.
+
+    None if both are the same, 0 if the calendar starts on another day or got
+    shorter.
+    """
+    old, new = daily_old["delta_in_hours"], daily_new["delta_in_hours"]
+    if (
+        len(new) < len(old)
+        or len(old) == 0
+        or (daily_old["date"][0] != daily_new["date"][0])
+    ):
+        return 0
+    n = len(old)
+    same = (old == new[:n]) | (np.isnan(old) & np.isnan(new[:n]))
+    pos = np.flatnonzero(~same.all(axis=1))
+    if len(pos) > 0:
+        return int(pos[0])
+    return n if len(new) > n else None
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import threading
+import functools
+import tracemalloc
+import pandas as pd
+from contextlib import contextmanager
+
+# Per-stage profiling
+# -------------------
+#
+# Opt-in: nothing is recorded until `enable` is called. While disabled, a
+# profiled function only pays for one dict lookup per call.
+
+_STATE = {"enabled": False, "trace_memory": False, "started_tracemalloc": False}
+_RECORDS = []
+_RECORDS_LOCK = threading.Lock()
+_LOCAL = threading.local()  # depth of the nested stages (and capture) per thread
+
+
+def enable(trace_memory=False):
+    """Start recording stages.
+
+    Args:
+        trace_memory (bool, optional): Also record the allocation delta of
+            every stage. This traces all allocations of the process
+            (tracemalloc), which slows all threads down noticeably. Defaults
+            to False.
+    """
+    _STATE["enabled"] = True
+    _STATE["trace_memory"] = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _STATE["started_tracemalloc"] = True
+
+
+def disable():
+    """Stop recording stages (the records are kept until `reset`)."""
+    _STATE["enabled"] = False
+    _STATE["trace_memory"] = False
+    if _STATE["started_tracemalloc"]:
+        tracemalloc.stop()
+        _STATE["started_tracemalloc"] = False
+
+
+def is_enabled():
+    return _STATE["enabled"]
+
+
+def reset():
+    """Drop all records."""
+    with _RECORDS_LOCK:
+        _RECORDS.clear()
+
+
+@contextmanager
+def capture():
+    """Collect the stages of the enclosed block in a list of their own.
+
+    Only the stages of the calling thread are collected, and they are not
+    added to the shared records, e.g. to keep a background job apart from
+    page loads. Yields the list, which can be passed to `records` and
+    `chrome_trace`.
+    """
+    previous = getattr(_LOCAL, "records", None)
+    recs = start_capture()
+    try:
+        yield recs
+    finally:
+        _LOCAL.records = previous
+
+
+def start_capture():
+    """Like `capture`, for code that can't be wrapped in a block (e.g. a
+    Streamlit script): collects the stages of the calling thread from now on,
+    until the next `start_capture` in the same thread. Returns the list."""
+    _LOCAL.records = recs = []
+    return recs
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """Record the wall time (and allocations) of the enclosed block.
+
+    Yields the record (a dict, or None while disabled), so that the block can
+    set `rows_out` itself.
+    """
+    if not _STATE["enabled"]:
+        yield None
+        return
+
+    depth = getattr(_LOCAL, "depth", 0)
+    record = {
+        "name": name,
+        "depth": depth,
+        "rows_in": rows_in,
+        "rows_out": None,
+        "alloc_bytes": None,
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+    }
+    trace_memory = _STATE["trace_memory"] and tracemalloc.is_tracing()
+    if trace_memory:
+        mem_start = tracemalloc.get_traced_memory()[0]
+    _LOCAL.depth = depth + 1
+    record["ts_start_ns"] = time.perf_counter_ns()
+    try:
+        yield record
+    finally:
+        record["duration_ns"] = time.perf_counter_ns() - record["ts_start_ns"]
+        _LOCAL.depth = depth
+        if trace_memory:
+            record["alloc_bytes"] = tracemalloc.get_traced_memory()[0] - mem_start
+        captured = getattr(_LOCAL, "records", None)
+        if captured is not None:
+            captured.append(record)
+        else:
+            with _RECORDS_LOCK:
+                _RECORDS.append(record)
+
+
+def profiled(func=None, name=None):
+    """Decorator recording every call of `func` as a stage.
+
+    The rows in are the rows of all data frame arguments, the rows out the
+    rows of the returned data frame(s).
+    """
+    if func is None:
+        return functools.partial(profiled, name=name)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _STATE["enabled"]:
+            return func(*args, **kwargs)
+        rows_in = count_rows(*args, *kwargs.values())
+        with stage(name or func.__name__, rows_in) as record:
+            ret = func(*args, **kwargs)
+            record["rows_out"] = count_rows(ret)
+        return ret
+
+    return wrapper
+
+
+def count_rows(*objs):
+    """Total number of rows of the data frames (and series) in `objs`.
+
+    Tuples, lists and dicts are searched one level deep. None if there are no
+    data frames at all.
+    """
+    n = None
+    for obj in objs:
+        if isinstance(obj, (tuple, list)):
+            items = obj
+        elif isinstance(obj, dict):
+            items = obj.values()
+        else:
+            items = [obj]
+        for item in items:
+            if isinstance(item, (pd.DataFrame, pd.Series)):
+                n = (n or 0) + len(item)
+    return n
+
+
+# Reporting
+# ---------
+
+
+def records(recs=None):
+    """All records (or `recs`, see `capture`) as a data frame, in the order the
+    stages started."""
+    recs = _copy_records(recs)
+    columns = ["name", "depth", "duration_ms", "rows_in", "rows_out", "alloc_mib"]
+    if len(recs) == 0:
+        return pd.DataFrame(columns=columns)
+    df = pd.DataFrame(recs).sort_values("ts_start_ns", ignore_index=True)
+    df["duration_ms"] = df.duration_ns / 1e6
+    df["alloc_mib"] = df.alloc_bytes.astype(float) / 2**20
+    df["name"] = ["  " * d + n for d, n in zip(df.depth, df.name)]
+    for c in ["rows_in", "rows_out"]:
+        df[c] = df[c].astype("Int64")
+    return df[columns]
+
+
+def chrome_trace(recs=None):
+    """All records (or `recs`, see `capture`) in the Chrome trace event format.
+
+    The returned dict can be dumped to json and opened in chrome://tracing,
+    Perfetto or speedscope.
+    """
+    recs = _copy_records(recs)
+    t0 = min((r["ts_start_ns"] for r in recs), default=0)
+    events = []
+    for r in recs:
+        args = {k: r[k] for k in ["rows_in", "rows_out", "alloc_bytes"]}
+        events.append(
+            {
+                "name": r["name"],
+                "cat": "health-monitor",
+                "ph": "X",  # complete event, with a start and a duration
+                "ts": (r["ts_start_ns"] - t0) / 1e3,  # microseconds
+                "dur": r["duration_ns"] / 1e3,
+                "pid": r["pid"],
+                "tid": r["tid"],
+                "args": {k: v for k, v in args.items() if v is not None},
+            }
+        )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def save_chrome_trace(fp, recs=None):
+    with open(fp, "w") as f:
+        json.dump(chrome_trace(recs), f)
+
+
+def _copy_records(recs):
+    if recs is not None:
+        return list(recs)
+    with _RECORDS_LOCK:
+        return list(_RECORDS)
@@ -0,0 +1,213 @@
+import logging
+import threading
+import time
+import pandas as pd
+import helper as h
+import pipeline
+import profiling
+
+logger = logging.getLogger(__name__)
+
+# Background refresh
+# ------------------
+#
+# One daemon thread polls the data source and rebuilds the derived frames off
+# the request path. Its result is published as a snapshot that is never
+# changed afterwards: publishing only replaces the reference to the latest
+# snapshot, so readers get a complete one without locking, and keep using it
+# while the next one is built.
+
+
+class Snapshot:
+    """Result of `pipeline.run_pipeline` for the data of one fetch at `ts_now`.
+
+    Attributes:
+        ret (dict): The result, don't modify it (it's shared by all readers).
+        data_version (str): Hash of the fetched data, see `helper.hash_frames`.
+        ts_fetched (pd.Timestamp): When the data was fetched (UTC).
+        ts_now (pd.Timestamp): End of the ongoing deep fast session (UTC).
+        trace (list): Profiling records of the refresh that built the snapshot,
+            empty unless profiling is enabled (see `profiling.capture`).
+    """
+
+    def __init__(self, ret, data_version, ts_fetched, ts_now, trace=()):
+        self.ret = ret
+        self.data_version = data_version
+        self.ts_fetched = ts_fetched
+        self.ts_now = ts_now
+        self.trace = list(trace)
+
+    @property
+    def version(self):
+        """Identifies `ret`: it changes with the data and with `ts_now`."""
+        return f"{self.data_version}-{self.ts_now.value}"
+
+    def age(self, ts_now=None):
+        """Time since the data was fetched."""
+        if ts_now is None:
+            ts_now = pd.Timestamp.now(tz="UTC")
+        return ts_now - self.ts_fetched
+
+
+class Refresher:
+    """Keeps a warm snapshot of the derived frames, refreshed in the background.
+
+    Every `interval_in_seconds` (or at once after `refresh`), a daemon thread
+    fetches the data, updates the frames of the latest snapshot incrementally
+    (see `pipeline.update_pipeline`) and publishes them as the next snapshot.
+    The ongoing deep fast session and today's scores depend on the current
+    time, so they are recomputed on every fetch, and in between every
+    `advance_interval_in_seconds` without fetching (see `advance`). A failed
+    refresh is logged and keeps the latest snapshot, the next one is tried
+    after the interval.
+
+    Args:
+        fetch (callable): Returns all rows as `(df_sleep, df_eat)`, called with
+            `full_resync=True` after `refresh(full_resync=True)`.
+        interval_in_seconds (float, optional): Time between two fetches.
+            Defaults to 300.
+        advance_interval_in_seconds (float, optional): Time between two
+            updates to the current time. Defaults to 60.
+        **params: Parameters of `pipeline.run_pipeline`. A `ts_now` is kept
+            fixed instead of following the current time (e.g. for tests).
+    """
+
+    def __init__(
+        self, fetch, interval_in_seconds=300, advance_interval_in_seconds=60, **params
+    ):
+        self.fetch = fetch
+        self.interval_in_seconds = interval_in_seconds
+        self.advance_interval_in_seconds = advance_interval_in_seconds
+        self.ts_now = params.pop("ts_now", None)
+        self.params = params
+        self.error = None  # of the latest refresh, None if it succeeded
+        self.stats = {"refreshes": 0, "updates": 0, "errors": 0}
+        self._snapshot = None
+        self._refreshing = False
+        self._full_resync = False
+        self._tried = threading.Event()  # set after the first refresh
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="refresher", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def refresh(self, full_resync=False):
+        """Fetch now instead of after the interval. Returns at once."""
+        self._full_resync = self._full_resync or full_resync
+        self._wake.set()
+
+    def snapshot(self, timeout=None):
+        """The latest snapshot.
+
+        Waits for the first refresh (at most `timeout` seconds). Returns None
+        if there is no snapshot yet, e.g. because the first refresh failed.
+        """
+        self._tried.wait(timeout)
+        return self._snapshot
+
+    def is_ready(self):
+        return self._snapshot is not None
+
+    def is_refreshing(self):
+        """Whether a refresh is running or requested."""
+        return self._refreshing or self._wake.is_set()
+
+    def refresh_once(self):
+        """Fetch and publish the next snapshot in the calling thread."""
+        full_resync, self._full_resync = self._full_resync, False
+        ts_fetched = pd.Timestamp.now(tz="UTC")
+        with profiling.capture() as trace:
+            df_sleep, df_eat = self.fetch(full_resync=full_resync)
+            data_version = h.hash_frames(
+                df_sleep[["ts_start", "ts_end", "value"]],
+                df_eat[["ts_start", "ts_end", "value"]],
+            )
+
+            ts_now = self._now()
+            last = self._snapshot
+            if last is not None:
+                # also for unchanged data: the tail moves on to ts_now (from
+                # the frames of the snapshot, which skips comparing them)
+                if data_version == last.data_version:
+                    df_sleep, df_eat = last.ret["df_sleep"], last.ret["df_eat"]
+                ret = pipeline.update_pipeline(
+                    last.ret, df_sleep, df_eat, ts_now=ts_now, **self.params
+                )
+                if data_version != last.data_version:
+                    self.stats["updates"] += 1
+            else:
+                ret = pipeline.run_pipeline(
+                    df_sleep, df_eat, ts_now=ts_now, **self.params
+                )
+        self._snapshot = Snapshot(ret, data_version, ts_fetched, ts_now, trace)
+        self.stats["refreshes"] += 1
+        return self._snapshot
+
+    def advance(self):
+        """Move the latest snapshot on to the current time, without fetching.
+
+        Only the last sessions and the scores of the last days are recomputed,
+        from the data of the snapshot. Returns the published snapshot, None if
+        there is none yet.
+        """
+        last = self._snapshot
+        ts_now = self._now()
+        if last is None or last.ts_now == ts_now:
+            return last
+        with profiling.capture() as trace:
+            ret = pipeline.update_pipeline(
+                last.ret,
+                last.ret["df_sleep"],
+                last.ret["df_eat"],
+                ts_now=ts_now,
+                **self.params,
+            )
+        self._snapshot = Snapshot(
+            ret, last.data_version, last.ts_fetched, ts_now, trace
+        )
+        return self._snapshot
+
+    def _now(self):
+        return self.ts_now if self.ts_now is not None else pd.Timestamp.now(tz="UTC")
+
+    def _run(self):
+        t_next_fetch = time.monotonic()
+        while not self._stopped.is_set():
+            fetch = self._wake.is_set() or time.monotonic() >= t_next_fetch
+            self._refreshing = fetch
+            self._wake.clear()
+            try:
+                if fetch:
+                    self.refresh_once()
+                    self.error = None
+                else:
+                    self.advance()
+            except Exception as e:
+                if fetch:
+                    self.error = e
+                self.stats["errors"] += 1
+                logger.exception("Refreshing the data failed")
+            finally:
+                if fetch:
+                    t_next_fetch = time.monotonic() + self.interval_in_seconds
+                self._refreshing = False
+                self._tried.set()
+            self._wake.wait(
+                min(
+                    self.advance_interval_in_seconds,
+                    max(t_next_fetch - time.monotonic(), 0),
+                )
+            )
@@ -28,37 +28,82 @@ CREATE TABLE IF NOT EXISTS foodlog (
 );
 
 
--- Create or replace the trigger function that extracts "sleep_analysis" data
+-- The latest rows and the tail of the history are read by ts_end (see
+-- load_tail_from_supabase in helper.py)
+CREATE INDEX IF NOT EXISTS idx_sleep_analysis_ts_end
+  ON apple_health_sleep_analysis (ts_end);
+CREATE INDEX IF NOT EXISTS idx_foodlog_ts_end
+  ON foodlog (ts_end);
+
+
+-- Sleep analysis datapoints of a Health Auto Export payload, as rows
+CREATE OR REPLACE FUNCTION extract_sleep_analysis(data JSONB)
+RETURNS TABLE (
+  ts_start TIMESTAMPTZ,
+  ts_end   TIMESTAMPTZ,
+  value    TEXT
+) AS $$
+  -- the datapoints are expanded into typed columns at once, which is about
+  -- twice as fast as looking up every field with ->>
+  SELECT
+    datapoint."startDate"::timestamptz,
+    datapoint."endDate"::timestamptz,
+    datapoint.value
+  FROM jsonb_array_elements(data->'metrics') AS metric,
+       jsonb_to_recordset(metric->'data')
+         AS datapoint ("startDate" TEXT, "endDate" TEXT, value TEXT)
+  WHERE metric->>'name' = 'sleep_analysis';
+$$ LANGUAGE sql STABLE;
+
+
+-- Create or replace the trigger function that extracts "sleep_analysis" data.
+-- All datapoints of a payload are inserted with one statement, in the order of
+-- the unique index (which keeps the index updates local).
 CREATE OR REPLACE FUNCTION transform_sleep_analysis()
 RETURNS TRIGGER AS $$
-DECLARE
-  metric    JSONB;
-  datapoint JSONB;
 BEGIN
-  -- Loop over each metric in NEW.data (cast to jsonb)
-  FOR metric IN
-    SELECT * FROM jsonb_array_elements(NEW.data::jsonb->'metrics')
-  LOOP
-    IF metric->>'name' = 'sleep_analysis' THEN
-      FOR datapoint IN
-        SELECT * FROM jsonb_array_elements(metric->'data')
-      LOOP
-        INSERT INTO apple_health_sleep_analysis (ts_start, ts_end, value)
-        VALUES (
-          (datapoint->>'startDate')::timestamptz,
-          (datapoint->>'endDate')::timestamptz,
-          datapoint->>'value'
-        )
-        ON CONFLICT DO NOTHING;
-      END LOOP;
-    END IF;
-  END LOOP;
+  INSERT INTO apple_health_sleep_analysis (ts_start, ts_end, value)
+  SELECT * FROM extract_sleep_analysis(NEW.data::jsonb)
+  ORDER BY 1, 2, 3
+  ON CONFLICT DO NOTHING;
 
   RETURN NEW;
 END;
 $$ LANGUAGE plpgsql;
 
 
+-- Reprocess the raw payloads with an id above after_id, batch_size payloads
+-- at a time (e.g. after changing the transformation). Returns the last id of
+-- the batch (NULL once all payloads are done) and the number of inserted
+-- rows. Every call is a transaction of its own, so locks are only held for
+-- one batch; see helper.backfill_sleep_analysis for the loop.
+CREATE OR REPLACE FUNCTION backfill_sleep_analysis(
+  after_id   BIGINT DEFAULT 0,
+  batch_size INT DEFAULT 100
+)
+RETURNS TABLE (
+  last_id    BIGINT,
+  n_inserted BIGINT
+) AS $$
+  WITH batch AS (
+    SELECT r.id, r.data
+    FROM apple_health_raw r
+    WHERE r.id > after_id
+    ORDER BY r.id
+    LIMIT batch_size
+  ),
+  inserted AS (
+    INSERT INTO apple_health_sleep_analysis (ts_start, ts_end, value)
+    SELECT e.*
+    FROM batch b, extract_sleep_analysis(b.data::jsonb) e
+    ORDER BY 1, 2, 3
+    ON CONFLICT DO NOTHING
+    RETURNING 1
+  )
+  SELECT (SELECT max(id) FROM batch), (SELECT count(*) FROM inserted);
+$$ LANGUAGE sql;
+
+
 -- Drop the old trigger if it exists, then recreate it
 DROP TRIGGER IF EXISTS after_insert_apple_health_raw ON apple_health_raw;
 
@@ -66,3 +111,263 @@ CREATE TRIGGER after_insert_apple_health_raw
 AFTER INSERT ON apple_health_raw
 FOR EACH ROW
 EXECUTE FUNCTION transform_sleep_analysis();
+
+
+-- Sessions
+-- --------
+--
+-- Sleep sessions and eating windows with the semantics of
+-- helper.identify_sessions: the intervals are ordered by their start, a session
+-- ends after every interval whose gap to the start of the next one exceeds
+-- min_gap_in_minutes, and sessions shorter than min_duration_in_minutes are
+-- dropped (their numbers are skipped). Only the rows the loaders return are
+-- used, i.e. no Awake stages, and meals last at least min_eat_duration_in_minutes.
+
+CREATE OR REPLACE FUNCTION compute_sleep_sessions(
+  min_gap_in_minutes      DOUBLE PRECISION DEFAULT 30,
+  min_duration_in_minutes DOUBLE PRECISION DEFAULT 60,
+  ts_from                 TIMESTAMPTZ DEFAULT '-infinity',  -- rows ending after
+  ts_start_from           TIMESTAMPTZ DEFAULT '-infinity',  -- rows starting after
+  first_session           BIGINT DEFAULT 0
+)
+RETURNS TABLE (
+  session                 BIGINT,
+  ts_start                TIMESTAMPTZ,
+  ts_end                  TIMESTAMPTZ,
+  sleep_duration_in_hours DOUBLE PRECISION,
+  duration_in_hours       DOUBLE PRECISION
+) AS $$
+  WITH intervals AS (
+    SELECT
+      s.ts_start,
+      s.ts_end,
+      s.value,
+      -- the gap to the next interval ends the session
+      lead(s.ts_start) OVER w - s.ts_end > min_gap_in_minutes * INTERVAL '1 minute'
+        AS is_last
+    FROM apple_health_sleep_analysis s
+    WHERE s.value <> 'Awake' AND s.ts_end >= ts_from AND s.ts_start >= ts_start_from
+    WINDOW w AS (ORDER BY s.ts_start, s.ts_end, s.value)
+  ),
+  numbered AS (
+    -- running count of the session ends before each interval
+    SELECT
+      i.*,
+      first_session + count(*) FILTER (WHERE i.is_last) OVER (
+        ORDER BY i.ts_start, i.ts_end, i.value
+        ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+      ) AS session
+    FROM intervals i
+  ),
+  sessions AS (
+    SELECT
+      n.session,
+      min(n.ts_start) AS ts_start,
+      max(n.ts_end) AS ts_end,
+      sum(extract(epoch FROM n.ts_end - n.ts_start) / 3600)
+        FILTER (WHERE n.value <> 'InBed') AS sleep_duration_in_hours
+    FROM numbered n
+    GROUP BY n.session
+  )
+  SELECT
+    s.session,
+    s.ts_start,
+    s.ts_end,
+    s.sleep_duration_in_hours::DOUBLE PRECISION,
+    (extract(epoch FROM s.ts_end - s.ts_start) / 3600)::DOUBLE PRECISION
+  FROM sessions s
+  WHERE s.ts_end - s.ts_start >= min_duration_in_minutes * INTERVAL '1 minute'
+  ORDER BY s.session;
+$$ LANGUAGE sql STABLE;
+
+
+CREATE OR REPLACE FUNCTION compute_eat_sessions(
+  min_gap_in_minutes          DOUBLE PRECISION DEFAULT 720,
+  min_duration_in_minutes     DOUBLE PRECISION DEFAULT 0,
+  min_eat_duration_in_minutes DOUBLE PRECISION DEFAULT 15,
+  ts_from                     TIMESTAMPTZ DEFAULT '-infinity',
+  ts_start_from               TIMESTAMPTZ DEFAULT '-infinity',
+  first_session               BIGINT DEFAULT 0
+)
+RETURNS TABLE (
+  session           BIGINT,
+  ts_start          TIMESTAMPTZ,
+  ts_end            TIMESTAMPTZ,
+  duration_in_hours DOUBLE PRECISION
+) AS $$
+  WITH meals AS (
+    SELECT
+      f.ts_start,
+      greatest(f.ts_end, f.ts_start + min_eat_duration_in_minutes * INTERVAL '1 minute')
+        AS ts_end,
+      f.description AS value
+    FROM foodlog f
+    WHERE f.ts_end >= ts_from AND f.ts_start >= ts_start_from
+  ),
+  intervals AS (
+    SELECT
+      m.*,
+      lead(m.ts_start) OVER w - m.ts_end > min_gap_in_minutes * INTERVAL '1 minute'
+        AS is_last
+    FROM meals m
+    WINDOW w AS (ORDER BY m.ts_start, m.ts_end, m.value)
+  ),
+  numbered AS (
+    SELECT
+      i.*,
+      first_session + count(*) FILTER (WHERE i.is_last) OVER (
+        ORDER BY i.ts_start, i.ts_end, i.value
+        ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+      ) AS session
+    FROM intervals i
+  ),
+  sessions AS (
+    SELECT n.session, min(n.ts_start) AS ts_start, max(n.ts_end) AS ts_end
+    FROM numbered n
+    GROUP BY n.session
+  )
+  SELECT
+    s.session,
+    s.ts_start,
+    s.ts_end,
+    (extract(epoch FROM s.ts_end - s.ts_start) / 3600)::DOUBLE PRECISION
+  FROM sessions s
+  WHERE s.ts_end - s.ts_start >= min_duration_in_minutes * INTERVAL '1 minute'
+  ORDER BY s.session;
+$$ LANGUAGE sql STABLE;
+
+
+-- Materialized sessions, one row per session. The parameters are kept in
+-- session_params (defaults of the app); set dirty_from to '-infinity' after
+-- changing them to recompute everything on the next refresh.
+CREATE TABLE IF NOT EXISTS session_params (
+  kind                        TEXT PRIMARY KEY,  -- 'sleep' or 'eat'
+  min_gap_in_minutes          DOUBLE PRECISION NOT NULL,
+  min_duration_in_minutes     DOUBLE PRECISION NOT NULL,
+  min_eat_duration_in_minutes DOUBLE PRECISION,
+  dirty_from                  TIMESTAMPTZ  -- earliest changed start, NULL if none
+);
+
+INSERT INTO session_params VALUES
+  ('sleep', 30, 60, NULL, '-infinity'),
+  ('eat', 720, 0, 15, '-infinity')
+ON CONFLICT DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS sleep_sessions (
+  session                 BIGINT PRIMARY KEY,
+  ts_start                TIMESTAMPTZ NOT NULL,
+  ts_end                  TIMESTAMPTZ NOT NULL,
+  sleep_duration_in_hours DOUBLE PRECISION,
+  duration_in_hours       DOUBLE PRECISION NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS eat_sessions (
+  session           BIGINT PRIMARY KEY,
+  ts_start          TIMESTAMPTZ NOT NULL,
+  ts_end            TIMESTAMPTZ NOT NULL,
+  duration_in_hours DOUBLE PRECISION NOT NULL
+);
+
+
+-- Remember the earliest start of all inserted, updated or deleted rows
+CREATE OR REPLACE FUNCTION mark_sessions_dirty()
+RETURNS TRIGGER AS $$
+BEGIN
+  UPDATE session_params
+  SET dirty_from = least(dirty_from, (SELECT min(ts_start) FROM changed_rows))
+  WHERE kind = TG_ARGV[0];
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- One statement level trigger per table, event and transition table (a
+-- trigger function can only read transition tables of one name)
+DO $$
+DECLARE
+  t RECORD;
+  name TEXT;
+BEGIN
+  FOR t IN
+    SELECT * FROM (VALUES
+      ('apple_health_sleep_analysis', 'sleep', 'INSERT', 'NEW'),
+      ('apple_health_sleep_analysis', 'sleep', 'UPDATE', 'OLD'),
+      ('apple_health_sleep_analysis', 'sleep', 'UPDATE', 'NEW'),
+      ('apple_health_sleep_analysis', 'sleep', 'DELETE', 'OLD'),
+      ('foodlog', 'eat', 'INSERT', 'NEW'),
+      ('foodlog', 'eat', 'UPDATE', 'OLD'),
+      ('foodlog', 'eat', 'UPDATE', 'NEW'),
+      ('foodlog', 'eat', 'DELETE', 'OLD')
+    ) AS v (table_name, kind, event, transition)
+  LOOP
+    name := lower(format('mark_%s_sessions_dirty_%s_%s', t.kind, t.event, t.transition));
+    EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', name, t.table_name);
+    EXECUTE format(
+      'CREATE TRIGGER %I AFTER %s ON %I REFERENCING %s TABLE AS changed_rows '
+      'FOR EACH STATEMENT EXECUTE FUNCTION mark_sessions_dirty(%L)',
+      name, t.event, t.table_name, t.transition, t.kind
+    );
+  END LOOP;
+END;
+$$;
+
+
+-- Incremental refresh: sessions are recomputed from the last session that
+-- starts before the earliest change (the boundary in front of it only depends
+-- on unchanged rows), everything before it is kept.
+CREATE OR REPLACE FUNCTION refresh_sessions()
+RETURNS VOID AS $$
+DECLARE
+  p             session_params;
+  cut_session   BIGINT;
+  cut_start     TIMESTAMPTZ;
+BEGIN
+  -- the row lock serializes refreshes, changes during a refresh wait for it
+  FOR p IN
+    SELECT * FROM session_params WHERE dirty_from IS NOT NULL ORDER BY kind FOR UPDATE
+  LOOP
+    IF p.kind = 'sleep' THEN
+      SELECT s.session, s.ts_start INTO cut_session, cut_start
+      FROM sleep_sessions s
+      WHERE s.ts_start < p.dirty_from
+      ORDER BY s.ts_start DESC
+      LIMIT 1;
+      IF NOT FOUND THEN
+        cut_session := 0;
+        cut_start := '-infinity';
+      END IF;
+
+      DELETE FROM sleep_sessions WHERE session >= cut_session;
+      INSERT INTO sleep_sessions
+      SELECT * FROM compute_sleep_sessions(
+        p.min_gap_in_minutes,
+        p.min_duration_in_minutes,
+        ts_start_from => cut_start,
+        first_session => cut_session
+      );
+    ELSE
+      SELECT s.session, s.ts_start INTO cut_session, cut_start
+      FROM eat_sessions s
+      WHERE s.ts_start < p.dirty_from
+      ORDER BY s.ts_start DESC
+      LIMIT 1;
+      IF NOT FOUND THEN
+        cut_session := 0;
+        cut_start := '-infinity';
+      END IF;
+
+      DELETE FROM eat_sessions WHERE session >= cut_session;
+      INSERT INTO eat_sessions
+      SELECT * FROM compute_eat_sessions(
+        p.min_gap_in_minutes,
+        p.min_duration_in_minutes,
+        p.min_eat_duration_in_minutes,
+        ts_start_from => cut_start,
+        first_session => cut_session
+      );
+    END IF;
+
+    UPDATE session_params SET dirty_from = NULL WHERE kind = p.kind;
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,404 @@
+import pandas as pd
+import numpy as np
+from plotly.subplots import make_subplots
+from helper import DAILY_METRICS, HOVER_COLUMNS, daily_frame
+from profiling import profiled
+
+# Scores
+# ------
+
+
+def get_current_scores(df_score):
+    ret = {}
+    cols = ["score_fasting", "score_first_meal", "score_last_meal", "score_sleep"]
+    for c in cols:
+        ser_tmp = df_score[c].dropna()
+        if len(ser_tmp) > 0:
+            ret[c] = ser_tmp.iloc[-1]
+        else:
+            ret[c] = np.nan
+    ret["score"] = np.mean(list(ret.values()))
+    return ret
+
+
+def get_current_and_last_score(df_score):
+
+    score_current = get_current_scores(df_score)["score"]
+    ts_current = df_score.date.dropna().iloc[-1]
+
+    # Last valid
+    row = df_score.dropna().iloc[-1]
+    score_last = row.score
+    ts_last = row.date
+
+    return score_current, ts_current, score_last, ts_last
+
+
+# Figure
+# ------
+
+
+@profiled
+def visualize_data(
+    df_sleep_sessions_viz=None,
+    df_eat_viz=None,
+    df_eat_sessions_viz=None,
+    df_deep_fast_sessions_viz=None,
+    daily=None,
+    df_score=None,
+    params=None,
+    x_range=None,
+    window=None,
+    webgl=False,
+    **kwargs,
+):
+    """Plot the frames returned by `pipeline.run_pipeline` (pass them as kwargs).
+
+    The targets are taken from `params`. `x_range` defaults to the whole
+    history up to now.
+
+    For long histories, pass a `window` (from, to) a bit wider than `x_range`:
+    only the days within it are plotted, so the size of the figure doesn't
+    grow with the history. With `webgl` the daily lines are drawn with WebGL.
+    Dates and values are passed as numpy arrays, which plotly sends to the
+    browser as typed arrays.
+    """
+    if x_range is None:
+        x_range = [df_score.date.min(), pd.Timestamp.now()]
+    add_scatter = "add_scattergl" if webgl else "add_scatter"
+
+    fig = make_subplots(rows=6, cols=1, shared_xaxes=True, vertical_spacing=0.025)
+
+    # Adding annotations to each subplot using the layout annotations list
+    fig.update_layout(
+        annotations=[
+            dict(
+                text="Deep Fast",
+                x=0,
+                y=1,
+                xref="x2 domain",
+                yref="y2 domain",
+                showarrow=False,
+                font=dict(color="aqua", size=12),
+            ),
+            dict(
+                text="First Meal After Sleep",
+                x=0,
+                y=1,
+                xref="x3 domain",
+                yref="y3 domain",
+                showarrow=False,
+                font=dict(color="orange", size=12),
+            ),
+            dict(
+                text="Last Meal Before Sleep",
+                x=0,
+                y=1,
+                xref="x4 domain",
+                yref="y4 domain",
+                showarrow=False,
+                font=dict(color="yellow", size=12),
+            ),
+            dict(
+                text="Sleep Duration",
+                x=0,
+                y=1,
+                xref="x5 domain",
+                yref="y5 domain",
+                showarrow=False,
+                font=dict(color="white", size=12),
+            ),
+            dict(
+                text="Score",
+                x=0,
+                y=1,
+                xref="x6 domain",
+                yref="y6 domain",
+                showarrow=False,
+                font=dict(color="red", size=12),
+            ),
+        ]
+    )
+
+    # Sleep sessions
+    df = _window(df_sleep_sessions_viz, window)
+    fig.add_bar(
+        x=_to_ms(df.date),
+        y=df.dh.to_numpy(np.float64),
+        base=df.h1.to_numpy(np.float64),
+        opacity=0.8,
+        marker_color="gray",
+        **_hover(df),
+        name="Asleep",
+        row=1,
+        col=1,
+    )
+
+    # East Sessions
+    df = _window(df_eat_sessions_viz, window)
+    fig.add_bar(
+        x=_to_ms(df.date),
+        y=df.dh.to_numpy(np.float64),
+        base=df.h1.to_numpy(np.float64),
+        opacity=0.2,
+        marker_color="darkgreen",
+        **_hover(df),
+        name="Feeding Windows",
+        row=1,
+        col=1,
+    )
+
+    df = _window(df_eat_viz, window)
+    fig.add_bar(
+        x=_to_ms(df.date),
+        y=df.dh.to_numpy(np.float64),
+        base=df.h1.to_numpy(np.float64),
+        opacity=1.0,
+        marker_color="darkgreen",
+        **_hover(df),
+        name="Meals",
+        row=1,
+        col=1,
+    )
+
+    # Fast windows
+    df = _window(df_deep_fast_sessions_viz, window)
+    fig.add_bar(
+        x=_to_ms(df.date),
+        y=df.dh.to_numpy(np.float64),
+        base=df.h1.to_numpy(np.float64),
+        opacity=0.5,
+        marker_color="aqua",
+        **_hover(df),
+        name="Deep Fast",
+        row=1,
+        col=1,
+    )
+
+    fig.add_hline(y=7, line_dash="dot", line_color="white", row=5, col=1)
+
+    for metric, name, color, row in zip(
+        DAILY_METRICS,
+        [
+            "Deep Fasting Duration",
+            "First Meal After Sleep",
+            "Last Meal Before Sleep",
+            "Sleep Duration",
+        ],
+        ["aqua", "orange", "yellow", "white"],
+        [2, 3, 4, 5],
+    ):
+
+        df = _window(daily_frame(daily, metric), window)
+        getattr(fig, add_scatter)(
+            x=_to_ms(df.date),
+            y=df.delta_in_hours.to_numpy(np.float64),
+            mode="lines+markers",
+            name=name,
+            opacity=0.2,
+            marker_color=color,
+            row=row,
+            col=1,
+        )
+
+        getattr(fig, add_scatter)(
+            x=_to_ms(df.date),
+            y=df.mean_delta_in_hours.to_numpy(np.float64),
+            mode="lines",
+            name=name + (" Weekly Average"),
+            marker_color=color,
+            row=row,
+            col=1,
+        )
+
+    # Add target lines
+    for y, row in zip(
+        [
+            params["target_delta_fasting"],
+            params["target_delta_first_meal"],
+            params["target_delta_last_meal"],
+            params["target_delta_sleep"],
+        ],
+        [2, 3, 4, 5],
+    ):
+
+        if not isinstance(y, tuple):
+            y = [y]
+
+        for _y in y:
+            fig.add_hline(
+                y=_y, line_dash="dot", line_color="white", line_width=1, row=row, col=1
+            )
+
+    # Add max and min score lines
+    max_score = df_score.score.max()
+    min_score = df_score.score.min()
+
+    # Add the score line first
+    df = _window(df_score, window)
+    getattr(fig, add_scatter)(
+        x=_to_ms(df.date),
+        y=df.score.to_numpy(np.float64),
+        mode="lines",
+        name="Score",
+        opacity=1,
+        marker_color="red",
+        row=6,
+        col=1,
+    )
+
+    fig.add_hline(
+        y=0.80,
+        line_dash="dot",
+        line_color="white",
+        line_width=0.5,
+        row=6,
+        col=1,
+    )
+
+    # Then add the max and min lines on top
+    fig.add_hline(
+        y=max_score,
+        line_dash="dot",
+        line_color="red",
+        line_width=0.5,
+        row=6,
+        col=1,
+        annotation=dict(
+            text=f"Max: {max_score:.1%}",
+            font=dict(color="red"),
+            yshift=0,
+            xanchor="right",
+            yanchor="bottom",
+        ),
+    )
+
+    fig.add_hline(
+        y=min_score,
+        line_dash="dot",
+        line_color="red",
+        line_width=0.5,
+        row=6,
+        col=1,
+        annotation=dict(
+            text=f"Min: {min_score:.1%}",
+            font=dict(color="red"),
+            yshift=0,
+            xanchor="right",
+            yanchor="top",
+        ),
+    )
+
+    score_current, ts_current, score_last, ts_last = get_current_and_last_score(
+        df_score
+    )
+
+    fig.add_scatter(
+        x=[ts_last, ts_current],
+        y=[score_last, score_current],
+        mode="lines",
+        line=dict(color="red", dash="dot"),
+        row=6,
+        col=1,
+        showlegend=False,
+    )
+
+    fig.add_scatter(
+        x=[ts_current],
+        y=[score_current],
+        mode="markers",
+        name="Current Score",
+        marker=dict(color="red", size=6),
+        row=6,
+        col=1,
+    )
+
+    # Disable zooming
+    fig.update_yaxes(fixedrange=True)
+    fig.update_xaxes(
+        showline=True,
+        mirror=True,
+        showgrid=True,
+        type="date",  # the dates are numbers (epoch milliseconds)
+        range=x_range,
+    )
+    fig.update_yaxes(
+        showline=True, mirror=True, showgrid=False, range=[0, 24], row=1, col=1
+    )
+    for row in [2, 3, 4]:
+        fig.update_yaxes(
+            showline=True, mirror=True, showgrid=False, range=[0, 8], row=row, col=1
+        )
+    fig.update_yaxes(
+        showline=True, mirror=True, showgrid=False, range=[4, 10], row=5, col=1
+    )
+
+    ymin = max(min_score - 0.05, 0)
+    ymax = min(max_score + 0.05, 1)
+    fig.update_yaxes(
+        showline=True,
+        mirror=True,
+        showgrid=True,
+        range=[ymin, ymax],
+        tickformat=",.0%",
+        row=6,
+        col=1,
+    )
+
+    fig.update_yaxes(
+        automargin=False  # prevents extra margin adjustments, because of e.g. yticklabels
+    )
+
+    fig.update_layout(
+        margin=dict(l=40, r=40, t=40, b=10),
+        showlegend=True,
+        legend=dict(orientation="h", yanchor="top", y=-0.05, xanchor="left", x=0.0),
+    )
+
+    # Layout
+    fig.update_layout(
+        barmode="overlay",
+        template="plotly_dark",
+        bargap=0.05,
+        width=1000,
+        height=1000,
+    )
+
+    # Set default drag mode to pan
+    fig.update_layout(dragmode="pan")
+
+    return fig
+
+
+def _window(df, window):
+    """The rows of `df` with a date within `window` (all rows if it is None)."""
+    if window is None:
+        return df
+    dates = pd.to_datetime(df.date)
+    return df[(dates >= window[0]) & (dates <= window[1])]
+
+
+def _to_ms(dates):
+    return (
+        pd.to_datetime(dates).to_numpy("datetime64[ms]").astype(np.int64).astype(float)
+    )
+
+
+def _hover(df):
+    """customdata and the hovertemplate (shared by all bars) of a trace."""
+    columns = [c for c in HOVER_COLUMNS if c in df]
+    lines = [
+        f"{c}: %{{customdata[{i}]{':.2f' if df[c].dtype.kind == 'f' else ''}}}"
+        for i, c in enumerate(columns)
+    ]
+    lines += [f"from: %{{customdata[{len(columns)}]}}"]
+    lines += [f"to: %{{customdata[{len(columns) + 1}]}}"]
+    data = [df[c].to_numpy() for c in columns]
+    data += [
+        df[c].dt.strftime("%Y-%m-%d %H:%M %Z").to_numpy()
+        for c in ["ts_start", "ts_end"]
+    ]
+    return {
+        "customdata": np.stack(data, axis=-1) if len(df) > 0 else None,
+        "hovertemplate": "<br>".join(lines),
+    }